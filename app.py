@@ -1,4 +1,5 @@
 import os
+from functools import partial
 
 from dotenv import load_dotenv
 
@@ -7,11 +8,19 @@ import dbtos3
 APP_ROOT = os.path.join(os.path.dirname(__file__))  # refers to application_top
 load_dotenv(os.path.join(APP_ROOT, '.env'))
 
+###
+# Setting up the job runner, tables and projects are loaded concurrently
+# every running job has its own connection to a source, limit caps the connections per source
+###
+
+runner = dbtos3.JobRunner(max_workers=8)
+
 ###
 # Setting up PostgreSQL Replication and full-load
 ###
 
-website_db = dbtos3.ReplicationMethodsPostgreSQL(
+website_db = partial(
+    dbtos3.ReplicationMethodsPostgreSQL,
     host=os.getenv('POSTGRES_HOST'),
     database=os.getenv('POSTGRES_DATABASE'),
     user=os.getenv('POSTGRES_USER'),
@@ -23,25 +32,27 @@ website_db = dbtos3.ReplicationMethodsPostgreSQL(
     main_key=os.getenv('POSTGRES_S3_MAIN_KEY'),
     port=os.getenv('POSTGRES_PORT')
 )
+runner.add_source('website-db', website_db, limit=4)
 
 
 def website_db_full_load_methods(args):
     for k, v in args.items():
         print('--   new process {}  ----------------------------'.format(k))
-        website_db.day_level_full_load(days=10, table=k, column=v)
+        runner.add_job('website-db', 'day_level_full_load', days=10, table=k, column=v)
 
 
 def website_db_replicate_methods(args):
     for k, v in args.items():
         print('--   new process {}  ----------------------------'.format(k))
-        website_db.replicate_table(table=k, column=v)
+        runner.add_job('website-db', 'replicate_table', table=k, column=v)
 
 
 ###
 # Setting up MySQL Replication and full-load
 ###
 
-mysql_db = dbtos3.ReplicationMethodsMySQL(
+mysql_db = partial(
+    dbtos3.ReplicationMethodsMySQL,
     host=os.getenv('MYSQL_HOST'),
     database=os.getenv('MYSQL_DATABASE'),
     user=os.getenv('MYSQL_USER'),
@@ -53,24 +64,26 @@ mysql_db = dbtos3.ReplicationMethodsMySQL(
     main_key=os.getenv('MYSQL_S3_MAIN_KEY'),
     port=os.getenv('MYSQL_PORT')
 )
+runner.add_source('mysql-db', mysql_db, limit=4)
 
 
 def mysql_db_full_load_methods(args):
     for k, v in args.items():
         print('--   new process {}  ----------------------------'.format(k))
-        mysql_db.day_level_full_load(days=10, table=k, column=v)
+        runner.add_job('mysql-db', 'day_level_full_load', days=10, table=k, column=v)
 
 
 def mysql_db_replicate_methods(args):
     for k, v in args.items():
         print('--   new process {}  ----------------------------'.format(k))
-        mysql_db.replicate_table(table=k, column=v)
+        runner.add_job('mysql-db', 'replicate_table', table=k, column=v)
 
 
 ###
 # Setting up Sentry Replication and full-load
 ###
-sentry = dbtos3.SentryReplicationMethod(
+sentry = partial(
+    dbtos3.SentryReplicationMethod,
     region_name=os.getenv('AWS_REGION'),
     aws_access_key_id=os.getenv('AWS_SECRET_KEY_ID'),
     aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY'),
@@ -79,18 +92,19 @@ sentry = dbtos3.SentryReplicationMethod(
     auth_token=os.getenv('SENTRY_AUTH_TOKEN'),
     organization=os.getenv('SENTRY_ORGANIZATION'),
 )
+runner.add_source('sentry', sentry, limit=2)
 
 
 def sentry_full_load_methods(args):
     for a in args:
         print('--   new process {}  ----------------------------'.format(a))
-        sentry.full_load(project=a)
+        runner.add_job('sentry', 'full_load', project=a)
 
 
 def sentry_replicate_methods(args):
     for a in args:
         print('--   new process {}  ----------------------------'.format(a))
-        sentry.replicate(project=a)
+        runner.add_job('sentry', 'replicate', project=a)
 
 
 ###
@@ -120,16 +134,17 @@ if __name__ == '__main__':
     website_db_tables = {'users': 'updated_at'}
     website_db_full_load_methods(website_db_tables)
     # website_db_replicate_methods(website_db_tables)
-    website_db.close_connection()
 
     mysql_tables = {'tasks': 'updated_at'}
     # mysql_db_full_load_methods(mysql_tables)/
     # mysql_db_replicate_methods(mysql_tables)
-    mysql_db.close_connection()
 
     sentry_projects = ['website-frontend']
     sentry_full_load_methods(sentry_projects)
     # sentry_replicate_methods(sentry_projects)
 
+    # runs all queued jobs and closes every worker's connections
+    print(runner.run())
+
     exchange_rates_full_load_methods()
     # exchange_rates_replication_methods()
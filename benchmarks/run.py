@@ -0,0 +1,353 @@
+"""
+Runs the replication paths against the local stand-ins and reports their throughput.
+
+Every scenario runs in its own fresh process, so its peak memory is its own, inside a temporary
+directory that holds its catalogue, cache and sqlite sources:
+
+python -m benchmarks.run --rows 100000 --width 10
+python -m benchmarks.run --rows 20000 --scenarios postgres-replicate,sentry-replicate --json results.json
+
+The datasets are synthetic, sized by --rows and --width (columns per row, tags per event, currencies per day),
+and generated with a fixed seed so runs can be compared. Throughput leaves out generating the data and
+any set up a scenario needs, for instance the full load that precedes a replication.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from datetime import date, timedelta
+
+import boto3
+
+BUCKET = 'dbtos3-benchmark'
+MAIN_KEY = 'benchmark'
+TABLE = 'bench'
+
+# stages of a scenario that are not counted in its throughput
+SET_UP_STAGES = ('generate', 'set up')
+
+
+class Stages:
+    """
+    wall time per stage of a scenario, and the bytes written to s3 in the stages that are measured
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.times = {}
+        self.written = 0
+
+    def objects(self):
+        """
+        :return: dict of key to (etag, size) of the objects in the benchmark bucket
+        """
+        return {item['Key']: (item['ETag'], item['Size'])
+                for page in self.client.get_paginator('list_objects_v2').paginate(Bucket=BUCKET)
+                for item in page.get('Contents', [])}
+
+    @contextmanager
+    def stage(self, name):
+        measured = name not in SET_UP_STAGES
+        # objects are listed outside the timed part, keys only have a resolution of seconds so an
+        # overwritten object counts as written as well
+        before = self.objects() if measured else None
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.times[name] = self.times.get(name, 0) + time.perf_counter() - started
+            if measured:
+                self.written += sum(size for key, (etag, size) in self.objects().items()
+                                    if before.get(key) != (etag, size))
+
+
+def model_settings():
+    return dict(region_name='us-east-1', aws_access_key_id='testing', aws_secret_access_key='testing',
+                s3bucket=BUCKET, main_key=MAIN_KEY, raise_errors=True)
+
+
+def database_model(model_class, path):
+    return model_class(host='localhost', database=path, user='benchmark', password='benchmark', port=0,
+                       **model_settings())
+
+
+def s3_service():
+    from dbtos3.s3_model.service import S3ServiceMethod
+
+    return S3ServiceMethod(**model_settings())
+
+
+def synthetic_records(rows, width):
+    return [dict({'id': i, 'updated_at': '2020-01-01 00:00:00'},
+                 **{'c{}'.format(c): 'value-{}-{}'.format(i, c) for c in range(max(width - 2, 0))})
+            for i in range(rows)]
+
+
+def s3_write_json(options, stages):
+    with stages.stage('generate'):
+        records = synthetic_records(options['rows'], options['width'])
+    s3 = s3_service()
+    with stages.stage('write'):
+        for part, start in enumerate(range(0, len(records), options['batch_size'])):
+            s3.write_to_s3(local=TABLE, data=records[start:start + options['batch_size']], part=part)
+    return len(records)
+
+
+def s3_write_ndjson(options, stages):
+    from dbtos3.s3_model import formats
+
+    with stages.stage('generate'):
+        records = synthetic_records(options['rows'], options['width'])
+        columns = list(records[0])
+        rows = [tuple(record.values()) for record in records]
+    s3 = s3_service()
+    description = [(column,) for column in columns]
+    batches = ((description, rows[start:start + options['batch_size']])
+               for start in range(0, len(rows), options['batch_size']))
+    with stages.stage('write'):
+        s3.write_batches_to_s3(local=TABLE, batches=batches, output_format=formats.NdjsonFormat())
+    return len(rows)
+
+
+def database_full_load(model_class, **kwargs):
+    def scenario(options, stages):
+        from benchmarks import stand_ins
+
+        path = os.path.abspath('source.db')
+        with stages.stage('generate'):
+            stand_ins.create_table(path, TABLE, options['rows'], options['width'])
+        with stages.stage('connect'):
+            model = database_model(model_class, path)
+        with stages.stage('full load'):
+            model.day_level_full_load(days=10, table=TABLE, column='updated_at', **kwargs)
+        model.close_connection()
+        return options['rows']
+
+    return scenario
+
+
+def database_replicate(model_class, **kwargs):
+    def scenario(options, stages):
+        from benchmarks import stand_ins
+
+        path = os.path.abspath('source.db')
+        changed = max(options['rows'] // 10, 1)
+        with stages.stage('generate'):
+            stand_ins.create_table(path, TABLE, options['rows'], options['width'])
+        with stages.stage('set up'):
+            model = database_model(model_class, path)
+            model.day_level_full_load(days=10, table=TABLE, column='updated_at')
+            stand_ins.touch_rows(path, TABLE, changed)
+        with stages.stage('replicate'):
+            model.replicate_table(table=TABLE, column='updated_at', **kwargs)
+        model.close_connection()
+        return changed
+
+    return scenario
+
+
+def sentry_replicate(options, stages):
+    from benchmarks import stand_ins
+    from dbtos3.sentry_model.api import SentryReplicationMethod
+
+    events_per_issue = 200
+    issues = max(options['rows'] // 2 // events_per_issue, 1)
+    project_events = max(options['rows'] - issues * events_per_issue, 0)
+    api = stand_ins.FakeApi(issues=issues, events_per_issue=events_per_issue, project_events=project_events,
+                            width=options['width'])
+    base_url = api.start()
+    try:
+        with stages.stage('connect'):
+            model = SentryReplicationMethod(auth_token='benchmark', organization='benchmark', **model_settings())
+            stand_ins.route(model.sentry.session, 'sentry.io', base_url, pool_size=max(model.max_workers, 10))
+        with stages.stage('replicate'):
+            model.replicate(project='benchmark')
+        model.close_connection()
+    finally:
+        api.stop()
+    return issues * events_per_issue + project_events
+
+
+def exchangerates_load_missing(options, stages):
+    from benchmarks import stand_ins
+    from dbtos3.exchangeratesapi_model.api import ExchangesRatesReplicationMethod
+
+    currencies = max(options['width'], 1)
+    # weekdays only, as the api publishes no rates on weekends
+    days = max(options['rows'] // currencies * 7 // 5, 1)
+    end_at = date.today() - timedelta(days=1)
+    start_at = end_at - timedelta(days=days - 1)
+    api = stand_ins.FakeApi(currencies=currencies)
+    base_url = api.start()
+    try:
+        with stages.stage('connect'):
+            model = ExchangesRatesReplicationMethod(organization='benchmark', **model_settings())
+            stand_ins.route(model.session, 'api.exchangeratesapi.io', base_url)
+        with stages.stage('load missing'):
+            model.load_missing(start_at=str(start_at), end_at=str(end_at))
+    finally:
+        api.stop()
+    weekdays = sum(1 for i in range(days) if (start_at + timedelta(days=i)).weekday() < 5)
+    return weekdays * currencies
+
+
+def postgres_scenarios():
+    from benchmarks.stand_ins import LocalPostgreSQL
+    from dbtos3.s3_model import formats
+
+    return {
+        'postgres-full-load': database_full_load(LocalPostgreSQL),
+        'postgres-full-load-streamed': database_full_load(LocalPostgreSQL, batch_size=10000,
+                                                          output_format=formats.NdjsonFormat()),
+        'postgres-replicate': database_replicate(LocalPostgreSQL),
+        'postgres-replicate-keyset': database_replicate(LocalPostgreSQL, page_size=10000, key_column='id'),
+    }
+
+
+def mysql_scenarios():
+    from benchmarks.stand_ins import LocalMySQL
+    from dbtos3.s3_model import formats
+
+    return {
+        'mysql-full-load': database_full_load(LocalMySQL),
+        'mysql-full-load-streamed': database_full_load(LocalMySQL, batch_size=10000,
+                                                       output_format=formats.NdjsonFormat()),
+        'mysql-replicate': database_replicate(LocalMySQL),
+    }
+
+
+def scenarios():
+    """
+    :return: dict of scenario name to a function of (options, stages) returning the amount of rows it loaded
+    """
+    return dict(
+        **{'s3-write-json': s3_write_json, 's3-write-ndjson': s3_write_ndjson},
+        **postgres_scenarios(),
+        **mysql_scenarios(),
+        **{'sentry-replicate': sentry_replicate, 'exchangerates-load-missing': exchangerates_load_missing},
+    )
+
+
+SCENARIO_NAMES = ['s3-write-json', 's3-write-ndjson', 'postgres-full-load', 'postgres-full-load-streamed',
+                  'postgres-replicate', 'postgres-replicate-keyset', 'mysql-full-load', 'mysql-full-load-streamed',
+                  'mysql-replicate', 'sentry-replicate', 'exchangerates-load-missing']
+
+
+def run_scenario(name, options):
+    """
+    runs one scenario in the current process, meant to be called in a fresh process per scenario
+    :param name: string. name of the scenario
+    :param options: dict of rows, width, batch_size and s3 endpoint, none for moto in memory
+    :return: dict of the scenario's results
+    """
+    os.environ.update(AWS_ACCESS_KEY_ID='testing', AWS_SECRET_ACCESS_KEY='testing', AWS_DEFAULT_REGION='us-east-1')
+    mock = None
+    if options['endpoint'] is not None:
+        os.environ['AWS_ENDPOINT_URL_S3'] = options['endpoint']
+    else:
+        from moto import mock_aws
+        mock = mock_aws()
+        mock.start()
+
+    workdir = tempfile.mkdtemp(prefix='dbtos3-benchmark-')
+    os.chdir(workdir)
+    try:
+        client = boto3.client('s3', region_name='us-east-1')
+        try:
+            client.create_bucket(Bucket=BUCKET)
+        except client.exceptions.BucketAlreadyOwnedByYou:
+            pass
+
+        from dbtos3.metrics_model import metrics
+
+        stages = Stages(client)
+        rows = scenarios()[name](options, stages)
+
+        measured = sum(seconds for stage, seconds in stages.times.items() if stage not in SET_UP_STAGES)
+        written = stages.written
+        return {
+            'scenario': name,
+            'rows': rows,
+            'seconds': measured,
+            'rows_per_second': rows / measured if measured else None,
+            'mb_written': written / 1e6,
+            'mb_per_second': written / 1e6 / measured if measured else None,
+            # ru_maxrss is in kilobytes on linux and in bytes on macos
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1e6 if sys.platform == 'darwin'
+                                                                                 else 1e3),
+            'stages': stages.times,
+            # what the models recorded themselves, per job
+            'metrics': metrics.registry.snapshot(),
+        }
+    finally:
+        if mock is not None:
+            mock.stop()
+
+
+def report(results):
+    """
+    :param results: list of scenario result dicts
+    :return: string. the results as a table
+    """
+    header = '{:<30} {:>9} {:>12} {:>9} {:>9} {:>9}  {}'.format('scenario', 'rows', 'rows/s', 'MB/s', 'peak MB',
+                                                              'seconds', 'stages')
+    lines = [header, '-' * len(header)]
+    for result in results:
+        lines.append('{:<30} {:>9} {:>12.0f} {:>9.2f} {:>9.1f} {:>9.2f}  {}'.format(
+            result['scenario'], result['rows'], result['rows_per_second'] or 0, result['mb_per_second'] or 0,
+            result['peak_rss_mb'], result['seconds'],
+            ', '.join('{} {:.2f}s'.format(stage, seconds) for stage, seconds in result['stages'].items())))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='benchmarks dbtos3 against local stand-ins of its sources and s3')
+    parser.add_argument('--rows', type=int, default=100000, help='rows, events or rates per scenario')
+    parser.add_argument('--width', type=int, default=10, help='columns per row, tags per event or currencies per day')
+    parser.add_argument('--batch-size', type=int, default=10000, help='rows per batch of the s3 write scenarios')
+    parser.add_argument('--scenarios', default=','.join(SCENARIO_NAMES),
+                        help='comma separated scenarios, of {}'.format(', '.join(SCENARIO_NAMES)))
+    parser.add_argument('--s3', choices=['server', 'memory'], default='server',
+                        help='moto as a local server, which needs moto[server], or in memory in each scenario')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args(argv)
+
+    names = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = set(names) - set(SCENARIO_NAMES)
+    if unknown:
+        parser.error('unknown scenarios: {}'.format(', '.join(sorted(unknown))))
+
+    server = None
+    endpoint = None
+    if args.s3 == 'server':
+        from benchmarks import stand_ins
+        server, endpoint = stand_ins.start_s3_server()
+
+    options = {'rows': args.rows, 'width': args.width, 'batch_size': args.batch_size, 'endpoint': endpoint}
+    results = []
+    try:
+        for name in names:
+            # a fresh process per scenario, so peak memory is not carried over from the previous one
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+                result = executor.submit(run_scenario, name, options).result()
+            results.append(result)
+            print(report([result]).splitlines()[-1] if len(results) > 1 else report([result]), flush=True)
+    finally:
+        if server is not None:
+            server.stop()
+
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump({'rows': args.rows, 'width': args.width, 'results': results}, json_file, indent=2)
+
+    return results
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,348 @@
+"""
+Local stand-ins for every source and for s3, so the models can be benchmarked without a live endpoint.
+
+- postgres and mysql are sqlite files behind a connection that speaks the parts of psycopg2 and
+  mysql.connector the models use, LocalPostgreSQL and LocalMySQL only swap the connect method
+- sentry and exchangeratesapi are served by FakeApi on a local port, route() points a requests
+  session at it
+- s3 is a moto server on a local port, or moto in memory when the server extras are not installed
+"""
+import random
+import re
+import socket
+import sqlite3
+import string
+import threading
+from datetime import datetime, timedelta, date
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs, urlencode
+import json
+
+import requests
+
+from dbtos3.mysql_model.db import ReplicationMethodsMySQL
+from dbtos3.postgres_model.db import ReplicationMethodsPostgreSQL
+
+# postgres and mysql syntax used by the models, rewritten for sqlite
+SQL_REWRITES = [
+    (re.compile(r"now\(\) - interval '(\d+) days'"), r"datetime('now', '-\1 days')"),
+    (re.compile(r"now\(\) - interval (\d+) day"), r"datetime('now', '-\1 days')"),
+    (re.compile(r"select column_name from information_schema\.columns where table_name = '(\w+)';?"),
+     r"select name from pragma_table_info('\1')"),
+    (re.compile(r"show columns from (\w+)"), r"select name from pragma_table_info('\1')"),
+    (re.compile(r"%s"), '?'),
+]
+
+# kinds of the generated columns after id and updated_at, repeated up to the width of the table
+COLUMN_KINDS = ['text', 'real', 'integer']
+
+PAGE_SIZE = 100
+
+
+class SQLiteCursor:
+    """
+    cursor over sqlite with the methods of a psycopg2 or mysql.connector cursor the models use
+    """
+
+    def __init__(self, connection):
+        self.cursor = connection.cursor()
+        self.itersize = 2000
+
+    def execute(self, query, params=()):
+        for pattern, replacement in SQL_REWRITES:
+            query = pattern.sub(replacement, query)
+        self.cursor.execute(query, params or ())
+
+    @property
+    def description(self):
+        return self.cursor.description
+
+    @property
+    def rowcount(self):
+        return self.cursor.rowcount
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def fetchmany(self, size):
+        return self.cursor.fetchmany(size)
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    def close(self):
+        self.cursor.close()
+
+
+class SQLiteConnection:
+    """
+    connection over a sqlite file with the methods of a psycopg2 or mysql.connector connection the models use
+    """
+    unread_result = False
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+
+    def cursor(self, name=None, buffered=None):
+        # named (server side) and unbuffered cursors read lazily in sqlite anyway
+        return SQLiteCursor(self.connection)
+
+    def commit(self):
+        self.connection.commit()
+
+    def rollback(self):
+        self.connection.rollback()
+
+    def consume_results(self):
+        pass
+
+    def close(self):
+        self.connection.close()
+
+
+class LocalPostgreSQL(ReplicationMethodsPostgreSQL):
+    """
+    postgres model reading from the sqlite file given as its database
+    """
+
+    def connect(self):
+        return SQLiteConnection(self.database)
+
+
+class LocalMySQL(ReplicationMethodsMySQL):
+    """
+    mysql model reading from the sqlite file given as its database
+    """
+
+    def connect(self):
+        return SQLiteConnection(self.database)
+
+
+def random_text(generator, length):
+    return ''.join(generator.choice(string.ascii_letters) for _ in range(length))
+
+
+def create_table(path, table, rows, width, days=5, seed=0):
+    """
+    creates a table of synthetic rows, updated within the last days
+    :param path: string. the sqlite file
+    :param table: string. name of the table
+    :param rows: integer. amount of rows
+    :param width: integer. amount of columns, at least id and updated_at
+    :param days: integer. updated_at is spread over this many days up to now
+    :param seed: integer. seed of the generated values
+    :return: none
+    """
+    generator = random.Random(seed)
+    kinds = [COLUMN_KINDS[i % len(COLUMN_KINDS)] for i in range(max(width - 2, 0))]
+    now = datetime.utcnow()
+
+    connection = sqlite3.connect(path)
+    connection.execute('drop table if exists {}'.format(table))
+    connection.execute('create table {} (id integer primary key, updated_at text{})'.format(
+        table, ''.join(', c{} {}'.format(i, kind) for i, kind in enumerate(kinds))))
+
+    def values(row_id):
+        updated_at = now - timedelta(seconds=generator.uniform(60, days * 86400))
+        row = [row_id, updated_at.strftime('%Y-%m-%d %H:%M:%S.%f')]
+        for kind in kinds:
+            if kind == 'text':
+                row.append(random_text(generator, 16))
+            elif kind == 'real':
+                row.append(generator.uniform(0, 1e6))
+            else:
+                row.append(generator.randint(0, 1 << 40))
+        return row
+
+    insert = 'insert into {} values ({})'.format(table, ', '.join('?' * (len(kinds) + 2)))
+    for start in range(0, rows, 10000):
+        connection.executemany(insert, [values(row_id) for row_id in range(start + 1, min(start + 10000, rows) + 1)])
+    connection.commit()
+    connection.close()
+
+
+def touch_rows(path, table, count):
+    """
+    moves updated_at of count rows to now, so a replication has new rows to pick up
+    :return: none
+    """
+    connection = sqlite3.connect(path)
+    connection.execute("update {} set updated_at = strftime('%Y-%m-%d %H:%M:%f', 'now') where id <= ?"
+                       .format(table), (count,))
+    connection.commit()
+    connection.close()
+
+
+class LocalAdapter(requests.adapters.HTTPAdapter):
+    """
+    transport adapter that sends the requests for a public api to a local server instead
+    """
+
+    def __init__(self, base_url, **kwargs):
+        super().__init__(**kwargs)
+        self.base_url = base_url
+
+    def send(self, request, **kwargs):
+        parsed = urlparse(request.url)
+        request.url = self.base_url + parsed.path + ('?' + parsed.query if parsed.query else '')
+        return super().send(request, **kwargs)
+
+
+def route(session, host, base_url, pool_size=10):
+    """
+    points the requests a session makes to https://host at a local server
+    :param session: requests session
+    :param host: string. the public host, for instance sentry.io
+    :param base_url: string. the local server, for instance http://127.0.0.1:8000
+    :param pool_size: integer. connections kept alive to the local server
+    :return: none
+    """
+    session.mount('https://{}'.format(host), LocalAdapter(base_url, pool_connections=1, pool_maxsize=pool_size))
+
+
+class FakeApi:
+    """
+    serves sentry and exchangeratesapi endpoints with synthetic data, sentry lists are paged with link cursors
+    """
+
+    def __init__(self, issues=10, events_per_issue=200, project_events=1000, width=10, currencies=30):
+        """
+        :param issues: integer. amount of issues per project
+        :param events_per_issue: integer. amount of events per issue
+        :param project_events: integer. amount of events per project
+        :param width: integer. amount of tags per event
+        :param currencies: integer. amount of currencies per day of rates
+        """
+        self.issues = issues
+        self.events_per_issue = events_per_issue
+        self.project_events = project_events
+        self.width = width
+        self.currencies = ['C{:03d}'.format(i) for i in range(currencies)]
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.started = datetime.utcnow()
+        self.server = None
+
+    def event(self, event_id, age):
+        """
+        :return: dict of a synthetic event, age seconds old
+        """
+        event = {'eventID': event_id, 'id': event_id,
+                 'dateCreated': (self.started - timedelta(seconds=age)).strftime('%Y-%m-%dT%H:%M:%SZ'),
+                 'message': 'synthetic event {}'.format(event_id)}
+        event.update(('tag{}'.format(i), 'value-{}-{}'.format(event_id, i)) for i in range(self.width))
+        return event
+
+    def listing(self, path):
+        """
+        :param path: string. the path of a sentry list endpoint
+        :return: tuple of (amount of items, function building item i), none if the path is unknown
+        """
+        parts = [part for part in path.split('/') if part]
+        if parts[-1] == 'issues' and 'projects' in parts:
+            return self.issues, lambda i: {'id': str(i), 'title': 'synthetic issue {}'.format(i)}
+        if parts[-1] == 'events' and 'projects' in parts:
+            return self.project_events, lambda i: self.event('p{}'.format(i), i)
+        if parts[-1] == 'events' and 'issues' in parts:
+            issue = parts[-2]
+            # events are listed newest first, as sentry does
+            return self.events_per_issue, lambda i: self.event('{}-{}'.format(issue, i), i)
+        return None
+
+    def rates(self, query):
+        """
+        :return: dict of the history endpoint for the weekdays of the requested range
+        """
+        start_at = date.fromisoformat(query['start_at'][0])
+        end_at = date.fromisoformat(query['end_at'][0])
+        rates = {}
+        day = start_at
+        while day <= end_at:
+            if day.weekday() < 5:
+                rates[str(day)] = {currency: 1 + (day.toordinal() * 31 + i) % 1000 / 1000
+                                   for i, currency in enumerate(self.currencies)}
+            day += timedelta(days=1)
+        return {'base': 'EUR', 'start_at': str(start_at), 'end_at': str(end_at), 'rates': rates}
+
+    def handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # headers and body are written separately, with nagle every keep alive response waits on a delayed ack
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def reply(self, body, headers=None):
+                data = json.dumps(body).encode('UTF-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                with api.lock:
+                    api.requests += 1
+                parsed = urlparse(self.path)
+                query = parse_qs(parsed.query)
+
+                if parsed.path.endswith('/history'):
+                    return self.reply(api.rates(query))
+
+                listing = api.listing(parsed.path)
+                if listing is None:
+                    self.send_error(404)
+                    return
+
+                count, item = listing
+                offset = int(query.pop('cursor', ['0'])[0])
+                end = min(offset + PAGE_SIZE, count)
+                query['cursor'] = [str(end)]
+                link = '<https://sentry.io{}?{}>; rel="next"; results="{}"; cursor="{}"'.format(
+                    parsed.path, urlencode(query, doseq=True), 'true' if end < count else 'false', end)
+                self.reply([item(i) for i in range(offset, end)], {'Link': link})
+
+        return Handler
+
+    def start(self):
+        """
+        starts serving on a free local port
+        :return: string. base url of the server
+        """
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.handler())
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+def start_s3_server():
+    """
+    starts a moto s3 server on a free local port, requires pip install dbtos3[benchmark]
+    :return: tuple of (server, endpoint url)
+    """
+    try:
+        from moto.server import ThreadedMotoServer
+    except ImportError:
+        raise ImportError('moto[server] is required for a local s3 server, install it with '
+                          'pip install dbtos3[benchmark] or run the benchmarks with --s3 memory')
+
+    port = free_port()
+    server = ThreadedMotoServer(ip_address='127.0.0.1', port=port, verbose=False)
+    server.start()
+    return server, 'http://127.0.0.1:{}'.format(port)
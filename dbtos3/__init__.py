@@ -13,8 +13,13 @@
 
 
 from dbtos3.exchangeratesapi_model.api import ExchangesRatesReplicationMethod
+from dbtos3.metrics_model.metrics import MetricsRegistry
+from dbtos3.mysql_model.cdc import ChangeDataCaptureMySQL
 from dbtos3.mysql_model.db import ReplicationMethodsMySQL
+from dbtos3.postgres_model.cdc import ChangeDataCapturePostgreSQL
+from dbtos3.pool_model.pools import PoolRegistry
 from dbtos3.postgres_model.db import ReplicationMethodsPostgreSQL
 from dbtos3.s3_model.service import S3ServiceMethod
+from dbtos3.scheduler_model.runner import JobRunner
 from dbtos3.sentry_model.api import SentryReplicationMethod, GetSentryEventsData
 from dbtos3.sqlite_model.catalogue import CatalogueMethods
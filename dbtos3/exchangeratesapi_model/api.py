@@ -1,11 +1,13 @@
 import json
 import logging
 import os
-from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
 
 import pandas as pd
 import requests
 
+from dbtos3.metrics_model import metrics
 from dbtos3.s3_model import service
 from dbtos3.sqlite_model import catalogue
 
@@ -21,6 +23,13 @@ logging.basicConfig(filename='Logs/logs-{}.log'.format(datetime.now().strftime('
                     filemode='w', datefmt='%d-%b-%y %H:%M:%S', level=logging.INFO)
 
 
+# responses of ranges that lie in the past never change, they are kept in this directory
+CACHE_PATH = 'Cache'
+
+# columns of the long table rates are written as, one row per day and currency
+RATE_COLUMNS = ['date', 'base', 'currency', 'rate']
+
+
 def get_current_rates():
     """
     gets today's exchange rates at the time of the request
@@ -31,7 +40,8 @@ def get_current_rates():
         datetime.now().strftime('%Y-%m-%d')
     )
     logging.info('[exchangeratesapi.api] called : {} [{}]'.format(url, datetime.now()))
-    return requests.get(url).json()
+    with metrics.timer('request'):
+        return requests.get(url).json()
 
 
 def get_ranged_rates(start_at):
@@ -44,7 +54,56 @@ def get_ranged_rates(start_at):
         start_at, datetime.now().strftime('%Y-%m-%d')
     )
     logging.info('[exchangeratesapi.api] called : {} [{}]'.format(url, datetime.now()))
-    return requests.get(url).json()
+    with metrics.timer('request'):
+        return requests.get(url).json()
+
+
+def get_rates(start_at, end_at, session=None):
+    """
+    gets the exchange rates of a range of days
+    :param start_at: date. first day of the range
+    :param end_at: date. last day of the range
+    :param session: requests session to reuse connections with, none for a single request
+    :return: json
+    """
+    url = 'https://api.exchangeratesapi.io/history?start_at={}&end_at={}'.format(start_at, end_at)
+    logging.info('[exchangeratesapi.api] called : {} [{}]'.format(url, datetime.now()))
+    with metrics.timer('request'):
+        response = (session or requests).get(url)
+    response.raise_for_status()
+    return response.json()
+
+
+def year_chunks(start_at, end_at):
+    """
+    splits a range of days at the turn of every year, so the same chunks are asked for on every run
+    :param start_at: date. first day of the range
+    :param end_at: date. last day of the range
+    :return: list of (start date, end date), both inclusive
+    """
+    chunks = []
+    while start_at <= end_at:
+        chunk_end = min(date(start_at.year, 12, 31), end_at)
+        chunks.append((start_at, chunk_end))
+        start_at = chunk_end + timedelta(days=1)
+    return chunks
+
+
+def flatten_rates(payload):
+    """
+    flattens the nested {rates: {date: {currency: rate}}} payload of the api into a long table
+    :param payload: json. response of the history endpoint
+    :return: data frame with the columns date, base, currency and rate, sorted by date and currency
+    """
+    rates = payload.get('rates') or {}
+    if not rates:
+        return pd.DataFrame(columns=RATE_COLUMNS)
+
+    # one wide frame of days by currencies, stacked into a row per day and currency in one go
+    wide = pd.DataFrame.from_dict(rates, orient='index', dtype='float64')
+    long = wide.stack().dropna().rename('rate').rename_axis(['date', 'currency']).reset_index()
+    long.insert(1, 'base', payload.get('base'))
+    return long.sort_values(['date', 'currency'], ignore_index=True)
 
 
 class ExchangesRatesReplicationMethod:
@@ -52,76 +111,111 @@ class ExchangesRatesReplicationMethod:
     :param kwargs:
     no token needed
     organisation=your company or organisation
+    raise_errors=errors are logged and swallowed by default, if true they are passed on to the caller
+    cache_path=directory past ranges are cached in, defaults to Cache
+    max_workers=amount of ranges fetched at the same time, defaults to 4
+    output_format=an output format from dbtos3.s3_model.formats, defaults to json
     """
 
     def __init__(self, **kwargs):
+        self.raise_errors = kwargs.get('raise_errors', False)
+
+        self.cache_path = os.path.join(kwargs.get('cache_path', CACHE_PATH), 'exchangeratesapi')
+        self.max_workers = kwargs.get('max_workers', 4)
+        self.output_format = kwargs.get('output_format')
+        self.session = requests.Session()
+
         self.s3_service = service.S3ServiceMethod(
             region_name=kwargs['region_name'],
             aws_access_key_id=kwargs['aws_access_key_id'],
             aws_secret_access_key=kwargs['aws_secret_access_key'],
             s3bucket=kwargs['s3bucket'],
-            main_key=kwargs['main_key']
+            main_key=kwargs['main_key'],
+            raise_errors=self.raise_errors
         )
 
+        # ensures the catalogue exists, it holds the ranges that were loaded
+        catalogue.CatalogueMethods().set_up_catalogue()
+
     @staticmethod
     def update_catalogue(column_name, column_time, table_name, app_run_time, database):
         update_catalogue = catalogue.CatalogueMethods()
         update_catalogue.update_catalogue(column_name=column_name, column_time=column_time, table_name=table_name,
                                           app_run_time=app_run_time, data_source=database)
 
+    @staticmethod
+    def add_loaded_range(start_at, end_at, max_day):
+        """
+        remembers a range of days as loaded, so load_missing does not fetch and write it again
+        a range up to today only counts as loaded up to the last day that had rates
+        :param start_at: date. first day of the range
+        :param end_at: date. last day of the range
+        :param max_day: date. the latest day that had rates, none if there were none
+        :return: none
+        """
+        loaded_end = end_at if end_at < date.today() else max_day
+        if loaded_end is not None and loaded_end >= start_at:
+            catalogue.CatalogueMethods().add_loaded_range(data_source='exchangeratesmodel.io', start_at=start_at,
+                                                          end_at=loaded_end, app_run_time=datetime.now())
+
     def full_load(self, start_at):
         """
         full loads data from start date to current GMT date
         :param start_at: 'yyyy-mm-dd' format for the start date of replication
         :return: writes json data of global exchange rates
         """
+        previous_job = metrics.begin_job('exchangeratesapi', 'exchangeratesapi')
         try:
             logging.info('[exchangerates.api] attempting full load of exchangeratesapi.io [{}]'.format(datetime.now()))
-            df = pd.DataFrame(json.loads(json.dumps(get_ranged_rates(start_at=start_at))))
-
-            # write to catalog with max timestamp
-            self.update_catalogue(column_name='end_at', column_time=df['end_at'].max(),
-                                  table_name='exchangeratesmodel', app_run_time=datetime.now(),
-                                  database='exchangeratesmodel.io')
+            rates = flatten_rates(get_ranged_rates(start_at=start_at))
 
             # write data to s3
-            self.s3_service.write_to_s3(
-                data=df.to_dict(orient='records'),
-                local='exchangeratesapi'
-            )
+            max_day = self.write_rates(rates)
+            self.add_loaded_range(start_at=date.fromisoformat(start_at), end_at=date.today(), max_day=max_day)
+
+            # write to catalog with max timestamp
+            if max_day is not None:
+                self.update_catalogue(column_name='end_at', column_time=max_day,
+                                      table_name='exchangeratesmodel', app_run_time=datetime.now(),
+                                      database='exchangeratesmodel.io')
 
         except Exception as error:
             logging.info(
                 '[exchangerates.api] error while doing a exchangeratesapi full load: {} [{}]'.format(error,
                                                                                                      datetime.now()))
+            if self.raise_errors:
+                raise
+
+        finally:
+            metrics.end_job(previous_job)
 
     def replicate(self):
         """
         replicates the current exchange rate of the day
         :return: writes json data of global exchange rates
         """
+        previous_job = metrics.begin_job('exchangeratesapi', 'exchangeratesapi')
         try:
             logging.info('[exchangerates.api] attempting replication of exchangeratesapi.io [{}]'.format(
                 datetime.now()))
 
-            df = pd.DataFrame(json.loads(json.dumps(get_current_rates())))
+            rates = flatten_rates(get_current_rates())
 
-            # test to see if replication is needed
+            # test to see if replication is needed, only days after the catalogue's are written
             catalog_max_time = catalogue.CatalogueMethods() \
                 .get_max_time_from_catalogue(table='exchangeratesmodel', data_source='exchangeratesmodel.io')
-            df_max_time = df['end_at'].max()
+            if catalog_max_time is not None:
+                rates = rates[rates['date'] > catalog_max_time.strftime('%Y-%m-%d')]
+
+            if len(rates):
+                # write data to s3, the days of the response before the catalogue's were written before
+                max_day = self.write_rates(rates)
+                self.add_loaded_range(start_at=date.today() - timedelta(days=1), end_at=date.today(), max_day=max_day)
 
-            if catalog_max_time < df_max_time:
                 # write to catalog with new max timestamp
-                self.update_catalogue(column_name='end_at', column_time=df['end_at'].max(),
+                self.update_catalogue(column_name='end_at', column_time=max_day,
                                       table_name='exchangeratesmodel', app_run_time=datetime.now(),
                                       database='exchangeratesmodel.io')
-
-                # write data to s3
-                self.s3_service.write_to_s3(
-                    data=df.to_dict(orient='records'),
-                    local='exchangeratesapi'
-                )
             else:
                 logging.info('[exchangerates.api] no need to exchange rates! [{}]'.format(datetime.now()))
 
@@ -129,3 +223,99 @@ class ExchangesRatesReplicationMethod:
             logging.info(
                 '[exchangerates.api] error while doing a exchangeratesapi replication: {} [{}]'.format(error,
                                                                                                        datetime.now()))
+            if self.raise_errors:
+                raise
+
+        finally:
+            metrics.end_job(previous_job)
+
+    def write_rates(self, rates):
+        """
+        writes a long table of rates to s3 partitioned by month, one object per month in exchangeratesapi/month=yyyy-mm/
+        folders, so readers can prune the months they do not need without a load of years writing thousands of
+        objects of a day each
+        :param rates: data frame as given by flatten_rates
+        :return: the latest day written as a date, or none if there were no rates
+        """
+        metrics.record('rows', len(rates))
+        # the objects of the months are encoded and uploaded on worker threads while the next month is split off
+        with service.S3PartWriter(s3_service=self.s3_service, output_format=self.output_format) as month_writer:
+            for month, month_rates in rates.groupby(rates['date'].str[:7], sort=True):
+                month_writer.write_specific(records=month_rates.to_dict(orient='records'),
+                                            folder='exchangeratesapi/month={}'.format(month), file='exchangeratesapi')
+        return date.fromisoformat(rates['date'].max()) if len(rates) else None
+
+    def cached_rates(self, start_at, end_at):
+        """
+        gets the rates of a range from the on disk cache, or from the api when the range was not cached yet
+        only ranges that ended before today are cached, the rates of today may still be published
+        :param start_at: date. first day of the range
+        :param end_at: date. last day of the range
+        :return: json
+        """
+        path = os.path.join(self.cache_path, '{}_{}.json'.format(start_at, end_at))
+        if os.path.exists(path):
+            logging.info('[exchangerates.api] {} to {} read from cache [{}]'.format(start_at, end_at, datetime.now()))
+            with open(path) as cache_file:
+                return json.load(cache_file)
+
+        rates = get_rates(start_at=start_at, end_at=end_at, session=self.session)
+
+        if end_at < date.today():
+            os.makedirs(self.cache_path, exist_ok=True)
+            # written next to the cache file and moved in place, so a reader never sees half a file
+            with open(path + '.tmp', 'w') as cache_file:
+                json.dump(rates, cache_file)
+            os.replace(path + '.tmp', path)
+
+        return rates
+
+    def load_missing(self, start_at, end_at=None):
+        """
+        loads only the days from start_at to end_at that the catalogue has no rates for yet, the missing
+        ranges are split into years which are fetched in parallel and written partitioned by month
+        :param start_at: 'yyyy-mm-dd' format for the start date
+        :param end_at: 'yyyy-mm-dd' format for the end date, defaults to today
+        :return: writes json data of global exchange rates
+        """
+        previous_job = metrics.begin_job('exchangeratesapi', 'exchangeratesapi')
+        try:
+            logging.info('[exchangerates.api] attempting load of missing exchange rates [{}]'.format(datetime.now()))
+            start_at = date.fromisoformat(start_at)
+            end_at = date.fromisoformat(end_at) if end_at is not None else date.today()
+
+            loaded = catalogue.CatalogueMethods()
+            chunks = [chunk for gap in loaded.missing_ranges(data_source='exchangeratesmodel.io', start_at=start_at,
+                                                             end_at=end_at)
+                      for chunk in year_chunks(*gap)]
+            if not chunks:
+                logging.info('[exchangerates.api] no need to exchange rates! [{}]'.format(datetime.now()))
+                return
+
+            max_day = None
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                futures = [executor.submit(metrics.bind(self.cached_rates), chunk_start, chunk_end)
+                           for chunk_start, chunk_end in chunks]
+
+                for (chunk_start, chunk_end), future in zip(chunks, futures):
+                    # write data to s3
+                    chunk_max_day = self.write_rates(flatten_rates(future.result()))
+                    self.add_loaded_range(start_at=chunk_start, end_at=chunk_end, max_day=chunk_max_day)
+                    if chunk_max_day is not None and (max_day is None or chunk_max_day > max_day):
+                        max_day = chunk_max_day
+
+            # write to catalog with max timestamp
+            if max_day is not None:
+                self.update_catalogue(column_name='end_at', column_time=max_day,
+                                      table_name='exchangeratesmodel', app_run_time=datetime.now(),
+                                      database='exchangeratesmodel.io')
+
+        except Exception as error:
+            logging.info(
+                '[exchangerates.api] error while loading missing exchange rates: {} [{}]'.format(error,
+                                                                                                  datetime.now()))
+            if self.raise_errors:
+                raise
+
+        finally:
+            metrics.end_job(previous_job)
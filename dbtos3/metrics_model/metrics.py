@@ -0,0 +1,231 @@
+"""
+Timing and throughput metrics of table jobs.
+
+Every model method that loads a table runs as a job, labelled with its source and table. While it runs,
+the models and the s3 service add to the metrics of that job: seconds spent per stage (query, fetch,
+encode, upload and api requests) and the rows, bytes, objects and retries it produced. The metrics of a
+process are kept in one registry, which reports them as json or in the prometheus text format:
+
+ReplicationMethodsPostgreSQL(...).replicate_table(table='users', column='updated_at')
+print(metrics.registry.report_prometheus())
+
+A sink is called with (source, table, metric, value) for every value recorded, to pass them on elsewhere:
+
+metrics.registry.add_sink(lambda source, table, metric, value: statsd.incr(metric, value))
+
+Stage seconds are summed over all threads of a job, so parts uploaded in parallel can add up to more
+than the wall time of the job.
+"""
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+STAGES = ['query', 'fetch', 'encode', 'upload', 'request']
+
+COUNTERS = ['rows', 'bytes', 'objects', 'retries']
+
+METRICS = ['{}_seconds'.format(stage) for stage in STAGES] + COUNTERS
+
+# metrics recorded outside of a job, for instance by an s3 service used on its own
+UNLABELLED_JOB = ('unknown', 'unknown')
+
+# the job of the current thread, set by begin_job and passed on to worker threads with bind
+current = threading.local()
+
+
+class MetricsRegistry:
+    """
+    thread safe totals of the metrics of every job in a process
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.sinks = []
+
+    def add_sink(self, sink):
+        """
+        :param sink: callable of (source, table, metric, value), called for every value recorded.
+        errors of a sink are logged and never fail the job
+        :return: none
+        """
+        self.sinks.append(sink)
+
+    def record(self, metric, value, job=None):
+        """
+        adds a value to a metric of a job
+        :param metric: string. one of METRICS, for instance rows or upload_seconds
+        :param value: number. the amount to add
+        :param job: tuple of (source, table), defaults to the job of the current thread
+        :return: none
+        """
+        if metric not in METRICS:
+            raise ValueError('unknown metric {}, use one of {}'.format(metric, ', '.join(METRICS)))
+
+        source, table = job or current_job()
+        with self.lock:
+            totals = self.jobs.setdefault((source, table), dict.fromkeys(METRICS, 0))
+            totals[metric] += value
+
+        for sink in self.sinks:
+            try:
+                sink(source, table, metric, value)
+            except Exception as error:
+                logging.info('[metrics.metrics] error in metrics sink: {} [{}]'.format(error, datetime.now()))
+
+    @contextmanager
+    def timer(self, stage, job=None):
+        """
+        records the seconds spent in the block as a stage of a job, also when the block raises
+        :param stage: string. one of STAGES
+        :param job: tuple of (source, table), defaults to the job of the current thread
+        :return: context manager
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record('{}_seconds'.format(stage), time.perf_counter() - started, job=job)
+
+    def snapshot(self):
+        """
+        :return: list of dicts with the source, table and totals of every job
+        """
+        with self.lock:
+            return [dict(source=source, table=table, **totals)
+                    for (source, table), totals in sorted(self.jobs.items())]
+
+    def drain(self):
+        """
+        returns the totals and resets them, used to hand the metrics of a worker process to its parent
+        :return: list of dicts as given by snapshot
+        """
+        with self.lock:
+            jobs, self.jobs = self.jobs, {}
+        return [dict(source=source, table=table, **totals) for (source, table), totals in sorted(jobs.items())]
+
+    def merge(self, snapshot):
+        """
+        adds the totals of a snapshot, for instance one drained in a worker process
+        :param snapshot: list of dicts as given by snapshot
+        :return: none
+        """
+        with self.lock:
+            for job in snapshot:
+                totals = self.jobs.setdefault((job['source'], job['table']), dict.fromkeys(METRICS, 0))
+                for metric in METRICS:
+                    totals[metric] += job.get(metric, 0)
+
+    def reset(self):
+        with self.lock:
+            self.jobs = {}
+
+    def report_json(self):
+        """
+        :return: string. the totals of every job as json
+        """
+        return json.dumps({'generated': datetime.now().isoformat(), 'jobs': self.snapshot()}, indent=2)
+
+    def report_prometheus(self):
+        """
+        :return: string. the totals of every job in the prometheus text exposition format
+        """
+        jobs = self.snapshot()
+        lines = ['# HELP dbtos3_stage_seconds_total seconds spent per stage of a table job',
+                 '# TYPE dbtos3_stage_seconds_total counter']
+        for job in jobs:
+            for stage in STAGES:
+                lines.append('dbtos3_stage_seconds_total{{source="{}",table="{}",stage="{}"}} {}'.format(
+                    escape_label(job['source']), escape_label(job['table']), stage, job['{}_seconds'.format(stage)]))
+
+        for counter in COUNTERS:
+            lines.append('# HELP dbtos3_{0}_total {0} of a table job'.format(counter))
+            lines.append('# TYPE dbtos3_{}_total counter'.format(counter))
+            for job in jobs:
+                lines.append('dbtos3_{}_total{{source="{}",table="{}"}} {}'.format(
+                    counter, escape_label(job['source']), escape_label(job['table']), job[counter]))
+
+        return '\n'.join(lines) + '\n'
+
+    def write_report(self, path, report_format='json'):
+        """
+        writes a report to a file, for instance for the textfile collector of the prometheus node exporter
+        :param path: string. the file to write
+        :param report_format: string. json or prometheus
+        :return: none
+        """
+        if report_format not in ('json', 'prometheus'):
+            raise ValueError('unknown report format {}, use json or prometheus'.format(report_format))
+
+        report = self.report_json() if report_format == 'json' else self.report_prometheus()
+        # written next to the report and moved in place, so a collector never reads half a report
+        with open(path + '.tmp', 'w') as report_file:
+            report_file.write(report)
+        os.replace(path + '.tmp', path)
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+# the registry of this process, every model records into it
+registry = MetricsRegistry()
+
+
+def current_job():
+    """
+    :return: tuple of (source, table) of the job running on the current thread
+    """
+    return getattr(current, 'job', None) or UNLABELLED_JOB
+
+
+def begin_job(source, table):
+    """
+    labels everything recorded on the current thread with a job until end_job is called
+    :param source: string. the kind of source, for instance postgres or sentry
+    :param table: string. the table, project or api being loaded
+    :return: the job that was running before, to be passed to end_job
+    """
+    previous = getattr(current, 'job', None)
+    current.job = (source, table)
+    return previous
+
+
+def end_job(previous):
+    """
+    :param previous: the job returned by begin_job
+    :return: none
+    """
+    current.job = previous
+
+
+def bind(function):
+    """
+    binds a function to the job of the current thread, so what it records on a worker thread counts for that job
+    :param function: callable
+    :return: callable
+    """
+    job = getattr(current, 'job', None)
+
+    @functools.wraps(function)
+    def bound(*args, **kwargs):
+        previous = begin_job(*job) if job is not None else getattr(current, 'job', None)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            end_job(previous)
+
+    return bound
+
+
+def record(metric, value, job=None):
+    registry.record(metric=metric, value=value, job=job)
+
+
+def timer(stage, job=None):
+    return registry.timer(stage=stage, job=job)
@@ -0,0 +1,275 @@
+"""
+Change data capture from the MySQL binary log.
+
+Instead of a timestamp query per table, one sequential read of the binlog gives every insert,
+update and delete of the captured tables. The server needs binlog_format = ROW and
+binlog_row_image = FULL, and the user the replication slave and replication client privileges:
+
+capture = ChangeDataCaptureMySQL(..., server_id=4321)
+capture.set_up_capture()
+capture.capture_to_s3(tables=['users', 'orders'])
+
+The position read up to is kept in the catalogue, as file:position or, with use_gtid, as a gtid set.
+"""
+import logging
+import os
+from datetime import datetime
+
+import mysql.connector
+
+from dbtos3.metrics_model import metrics
+from dbtos3.s3_model import service
+from dbtos3.sqlite_model import catalogue
+
+try:
+    from pymysqlreplication import BinLogStreamReader
+    from pymysqlreplication.event import GtidEvent, XidEvent
+    from pymysqlreplication.gtid import Gtid, GtidSet
+    from pymysqlreplication.row_event import WriteRowsEvent, UpdateRowsEvent, DeleteRowsEvent
+except ImportError:
+    BinLogStreamReader = None
+
+try:
+    os.mkdir('Logs')
+except FileExistsError:
+    pass
+
+for handler in logging.root.handlers[:]:
+    logging.root.removeHandler(handler)
+
+logging.basicConfig(filename='Logs/logs-{}.log'.format(datetime.now().strftime('%d%m%y%H%M')),
+                    filemode='w', datefmt='%d-%b-%y %H:%M:%S', level=logging.INFO)
+
+
+class ChangeDataCaptureMySQL:
+    """
+    mySQL_Model change data capture methods, requires mysql-replication
+    """
+
+    def __init__(self, host, database, user, password, region_name, aws_access_key_id, aws_secret_access_key, s3bucket,
+                 main_key, port, server_id=4321, use_gtid=False, raise_errors=False):
+        """
+        :param host: host name for db
+        :param database: db name, only tables of this database are captured
+        :param user: user name
+        :param password: user password
+        :param port: host port
+        :param region_name: aws region
+        :param aws_access_key_id: aws user key
+        :param aws_secret_access_key: aws user password
+        :param s3bucket: bucket to write to
+        :param main_key: folder to write to
+        :param server_id: integer. replica id the binlog is read as, unique among the replicas of the server
+        :param use_gtid: boolean. keep the position as a gtid set, which survives a fail over to another server
+        :param raise_errors: errors are logged and swallowed by default, if true they are passed on to the caller
+        """
+        if BinLogStreamReader is None:
+            raise ImportError('mysql-replication is required for binlog capture, '
+                              'install it with pip install dbtos3[binlog]')
+
+        self.raise_errors = raise_errors
+
+        self.host = host
+        self.database = database
+        self.user = user
+        self.password = password
+        self.port = port
+
+        self.server_id = server_id
+        self.use_gtid = use_gtid
+        self.data_source = 'mysql-cdc-{}'.format(database)
+
+        self.s3_service = service.S3ServiceMethod(
+            region_name=region_name,
+            aws_access_key_id=aws_access_key_id,
+            aws_secret_access_key=aws_secret_access_key,
+            s3bucket=s3bucket,
+            main_key=main_key,
+            # a position is only stored once its changes are written, so a failed write has to stop the capture
+            raise_errors=True
+        )
+
+        # ensures the catalogue exists
+        catalogue.CatalogueMethods().set_up_catalogue()
+
+    def set_up_capture(self):
+        """
+        stores the current binlog position of the server as the start of the capture,
+        if no position was stored yet. changes from this moment on are captured
+        :return: none
+        """
+        try:
+            if catalogue.CatalogueMethods().get_log_position(data_source=self.data_source) is not None:
+                logging.info('[mysql.cdc] capture of {} already set up [{}]'.format(self.database, datetime.now()))
+                return
+
+            connection = mysql.connector.connect(host=self.host, user=self.user, passwd=self.password,
+                                                 port=self.port)
+            try:
+                cursor = connection.cursor()
+                cursor.execute('show master status')
+                row = cursor.fetchall()[0]
+            finally:
+                connection.close()
+
+            # file, position, binlog do db, binlog ignore db, executed gtid set
+            position = row[4].replace('\n', '') if self.use_gtid else '{}:{}'.format(row[0], row[1])
+            catalogue.CatalogueMethods().update_log_position(data_source=self.data_source, position=position,
+                                                             app_run_time=datetime.now())
+
+        except Exception as error:
+            logging.info('[mysql.cdc] error while setting up capture: {} [{}]'.format(error, datetime.now()))
+            if self.raise_errors:
+                raise
+
+    def stream_reader(self, tables, position):
+        """
+        :param tables: list of strings. the tables to capture
+        :param position: string. file:position or gtid set to resume after
+        :return: BinLogStreamReader that stops at the end of the binlog
+        """
+        kwargs = {}
+        if self.use_gtid:
+            kwargs['auto_position'] = position
+        else:
+            log_file, log_pos = position.rsplit(':', 1)
+            kwargs.update(log_file=log_file, log_pos=int(log_pos), resume_stream=True)
+
+        return BinLogStreamReader(
+            connection_settings={'host': self.host, 'port': int(self.port), 'user': self.user,
+                                 'passwd': self.password},
+            server_id=self.server_id,
+            only_events=[WriteRowsEvent, UpdateRowsEvent, DeleteRowsEvent, GtidEvent, XidEvent],
+            only_schemas=[self.database],
+            only_tables=tables,
+            blocking=False,
+            **kwargs
+        )
+
+    def capture_to_s3(self, tables, batch_size=10000, max_changes=None, output_format=None):
+        """
+        reads the binlog from the stored position to its end and writes the changes of the tables to s3
+        in batches. a batch is only written at the end of a transaction, after which its position is
+        stored in the catalogue, so a capture that is interrupted resumes after the last batch that was written
+        every change is written as {position, action, table, data, identity}, where identity is the old
+        row of an updated or deleted row
+
+        :param tables: list of strings. the tables to capture
+        :param batch_size: integer. amount of changes held in memory before they are written
+        :param max_changes: integer. stop after this many changes, none reads to the end of the binlog
+        :param output_format: an output format from dbtos3.s3_model.formats, for instance NdjsonFormat('gzip')
+        :return: the amount of changes written
+        """
+        captured = 0
+        stream = None
+        previous_job = metrics.begin_job('mysql-cdc', self.database)
+        try:
+            position = catalogue.CatalogueMethods().get_log_position(data_source=self.data_source)
+            if position is None:
+                raise ValueError('no binlog position stored for {}, run set_up_capture first'.format(self.database))
+            logging.info('[mysql.cdc] capturing {} from {} [{}]'.format(', '.join(tables), position, datetime.now()))
+
+            stream = self.stream_reader(tables=tables, position=position)
+            gtid_set = GtidSet(position) if self.use_gtid else None
+            gtid = None
+
+            # changes of committed transactions, and of the transaction being read
+            changes = []
+            pending = []
+            part = 0
+            committed_position = flushed_position = position
+
+            for event in stream:
+                if isinstance(event, GtidEvent):
+                    gtid = event.gtid
+                    continue
+
+                if isinstance(event, XidEvent):
+                    changes.extend(pending)
+                    pending = []
+                    if self.use_gtid:
+                        if gtid is not None:
+                            gtid_set = gtid_set + Gtid(gtid)
+                        committed_position = str(gtid_set)
+                    else:
+                        # the reader is positioned after the commit event
+                        committed_position = '{}:{}'.format(stream.log_file, stream.log_pos)
+
+                    if len(changes) >= batch_size:
+                        captured += self.flush(changes=changes, part=part, position=committed_position,
+                                               output_format=output_format)
+                        flushed_position = committed_position
+                        changes = []
+                        part += 1
+
+                    if max_changes is not None and captured + len(changes) >= max_changes:
+                        break
+                    continue
+
+                pending.extend(self.event_changes(event=event, position=committed_position))
+
+            # changes of a transaction that was not committed in the read part of the binlog are read again
+            if committed_position != flushed_position:
+                captured += self.flush(changes=changes, part=part, position=committed_position,
+                                       output_format=output_format)
+
+            return captured
+
+        except Exception as error:
+            logging.info('[mysql.cdc] error while capturing changes: {} [{}]'.format(error, datetime.now()))
+            if self.raise_errors:
+                raise
+
+        finally:
+            metrics.end_job(previous_job)
+            if stream is not None:
+                stream.close()
+            logging.info('[mysql.cdc] captured {} changes from {} [{}]'.format(captured, self.database,
+                                                                               datetime.now()))
+
+    @staticmethod
+    def event_changes(event, position):
+        """
+        :param event: a row event of the binlog
+        :param position: string. position of the last commit before the event
+        :return: list of change dicts, one per row of the event
+        """
+        if isinstance(event, WriteRowsEvent):
+            return [{'position': position, 'action': 'insert', 'table': event.table, 'data': row['values'],
+                     'identity': None} for row in event.rows]
+        if isinstance(event, UpdateRowsEvent):
+            return [{'position': position, 'action': 'update', 'table': event.table, 'data': row['after_values'],
+                     'identity': row['before_values']} for row in event.rows]
+        return [{'position': position, 'action': 'delete', 'table': event.table, 'data': None,
+                 'identity': row['values']} for row in event.rows]
+
+    def flush(self, changes, part, position, output_format=None):
+        """
+        writes the changes up to a commit, one object per table, and stores the position of the commit
+        :param changes: list of change dicts
+        :param part: integer. number of the batch in this capture
+        :param position: string. file:position or gtid set of the commit the changes end with
+        :param output_format: an output format from dbtos3.s3_model.formats
+        :return: the amount of changes written
+        """
+        by_table = {}
+        for change in changes:
+            by_table.setdefault(change['table'], []).append(change)
+
+        for table, table_changes in by_table.items():
+            self.s3_service.write_to_s3(data=table_changes, local='{}-changes'.format(table), part=part,
+                                        output_format=output_format)
+        metrics.record('rows', len(changes))
+
+        catalogue.CatalogueMethods().update_log_position(data_source=self.data_source, position=position,
+                                                         app_run_time=datetime.now())
+        return len(changes)
+
+    @staticmethod
+    def close_connection():
+        """
+        closes the catalogue connection, the binlog connection is closed after every capture
+        :return: none
+        """
+        logging.info('[mysql.cdc] closing all connections [{}]'.format(datetime.now()))
+        catalogue.close_catalogue_connection()
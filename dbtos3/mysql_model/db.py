@@ -2,10 +2,10 @@ import logging
 import os
 from datetime import datetime
 
-import mysql.connector
-import pandas as pd
-
-from dbtos3.s3_model import service
+from dbtos3.metrics_model import metrics
+from dbtos3.pool_model import pools
+from dbtos3.s3_model import formats, service
+from dbtos3.sql_model import methods
 from dbtos3.sqlite_model import catalogue
 
 try:
@@ -20,13 +20,16 @@ logging.basicConfig(filename='Logs/logs-{}.log'.format(datetime.now().strftime('
                     filemode='w', datefmt='%d-%b-%y %H:%M:%S', level=logging.INFO)
 
 
-class ReplicationMethodsMySQL:
+class ReplicationMethodsMySQL(methods.ReplicationMethodsSQL):
     """
     mySQL_Model replication methods
     """
 
+    log_name = 'mysql.db'
+    source_name = 'mysql'
+
     def __init__(self, host, database, user, password, region_name, aws_access_key_id, aws_secret_access_key, s3bucket,
-                 main_key, port):
+                 main_key, port, raise_errors=False):
         """
         :param host: host name for db
         :param database: db name
@@ -38,7 +41,10 @@ class ReplicationMethodsMySQL:
         :param aws_secret_access_key: aws user password
         :param s3bucket: bucket to write to
         :param main_key: folder to write to
+        :param raise_errors: errors are logged and swallowed by default, if true they are passed on to the caller
         """
+        self.raise_errors = raise_errors
+
         self.host = host
         self.database = database
         self.user = user
@@ -57,83 +63,154 @@ class ReplicationMethodsMySQL:
             aws_access_key_id=aws_access_key_id,
             aws_secret_access_key=aws_secret_access_key,
             s3bucket=s3bucket,
-            main_key=main_key
+            main_key=main_key,
+            raise_errors=raise_errors
         )
 
-        self.connection = mysql.connector.connect(
+        self.connection = self.connect()
+
+        self.cursor = self.connection.cursor()
+
+        # ensures the catalogue exists
+        catalogue.CatalogueMethods().set_up_catalogue()
+
+    def connect(self):
+        """
+        borrows a connection to the database of this model from the pool of the process,
+        it is given back by close_connection or release_connection
+        :return: mysql.connector connection
+        """
+        return pools.registry.mysql_connection(
             host=self.host,
-            user=self.user,
-            passwd=self.password,
             database=self.database,
+            user=self.user,
+            password=self.password,
             port=self.port
         )
 
-        self.cursor = self.connection.cursor()
+    def fetch_batches(self, query, batch_size):
+        """
+        streams the result of a query through an unbuffered cursor, so that rows are read
+        off the socket in chunks of batch_size instead of being pulled into the client at once
+        :param query: string. the query to be executed
+        :param batch_size: integer. amount of rows read from the server per chunk
+        :return: generator of (cursor description, list of row tuples)
+        """
+        stream_cursor = self.connection.cursor(buffered=False)
 
-        # ensures the catalogue exists
-        catalogue.CatalogueMethods().set_up_catalogue()
+        try:
+            with metrics.timer('query'):
+                stream_cursor.execute(query)
+            while True:
+                with metrics.timer('fetch'):
+                    rows = stream_cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                metrics.record('rows', len(rows))
+                yield stream_cursor.description, rows
 
-    @staticmethod
-    def update_catalogue(column_name, column_time, table_name, app_run_time, data_source):
-        update_catalogue = catalogue.CatalogueMethods()
-        update_catalogue.update_catalogue(column_name=column_name, column_time=column_time, table_name=table_name,
-                                          app_run_time=app_run_time, data_source=data_source)
+        finally:
+            # an unbuffered result has to be read to the end before the connection can be used again
+            if self.connection.unread_result:
+                self.connection.consume_results()
+            stream_cursor.close()
 
-    def day_level_full_load(self, days, table, column):
+    def get_primary_key(self, table):
+        """
+        :param table: string. the table of which the primary key is needed
+        :return: the name of the primary key column, raises if the table has no single column primary key
+        """
+        # column_name is the fifth column of show keys
+        self.cursor.execute("show keys from {} where Key_name = 'PRIMARY'".format(table))
+        keys = [row[4] for row in self.cursor.fetchall()]
+        if len(keys) != 1:
+            raise ValueError('{} has no single column primary key, set a split_column to partition it'.format(table))
+        return keys[0]
+
+    def day_level_full_load(self, days, table, column, batch_size=None, output_format=None, partitions=None,
+                            split_column=None):
+        """
+        full load of data from database to s3 bucket
+        method is "select * from {} where {} > now() - interval {} day"
+
+        :param days: integer. total amount of historical days to be replicated
+        :param table: string. the table that will be replicated
+        :param column: string. the column that satisfies the historical timestamp
+        :param batch_size: integer. if given, the table is read through an unbuffered cursor
+        and written to s3 in objects of batch_size rows as they arrive
+        :param output_format: an output format from dbtos3.s3_model.formats, for instance ParquetFormat().
+        if given, the rows are streamed into a single object of that format instead of json
+        :param partitions: integer. if given, the rows are split into this many key ranges of split_column
+        which are extracted in parallel, each on its own connection and into its own s3 object
+        :param split_column: string. integer or timestamp column to split on, defaults to the primary key
+        :return: writes directly to s3 bucket
+        """
+        previous_job = metrics.begin_job('mysql', table)
         try:
             logging.info(
                 '[mysql.db] loading data from {} at {} days based on column {} [{}]'.format(table, days, column,
                                                                                             datetime.now()))
 
-            table_columns = []
             # construct query to get nth days of data from table & all column names of that table
             data_query = "select * from {} where {} > now() - interval {} day".format(table, column, days)
-            column_query = "show columns from {}".format(table)
-
-            # execute queries and allocate them to objects
-
-            # gather all column names for data frame
-            self.cursor.execute(column_query)
-            for c in self.cursor.fetchall():
-                table_columns.append(c[0])
-
-            # substitute for real dictionary cursor to preserve the column names of the table
-            # querying from the database and simply parsing to json loses vital data, so the
-            # steps below gather the data, and generates a dict that zips column names to relevant data
-            # this is as efficient as I can develop, so will need to look for something better in future
-            self.cursor.execute(data_query)
-            columns = [desc[0] for desc in self.cursor.description]
-            data = [dict(zip(columns, row)) for row in self.cursor.fetchall()]
-
-            # create data frame to easily gather values using pandas
-            data_frame = pd.DataFrame(data, columns=table_columns)
 
-            # updates catalogue
-            self.update_catalogue(column_name=column, column_time=data_frame[column].max(),
-                                  table_name=table, app_run_time=datetime.now(), data_source='mysql-{}'.format(table))
-
-            # use write to s3 method to send data frame directly to s3
-            self.s3_service.write_to_s3(data=data, local=table)
+            if partitions is not None:
+                max_column_time = self.partitioned_to_s3(query=data_query, table=table, column=column,
+                                                         partitions=partitions, split_column=split_column,
+                                                         batch_size=batch_size, output_format=output_format)
+            else:
+                # without a batch size or format the rows are still read in batches, and written as one json array
+                if batch_size is None and output_format is None:
+                    output_format = formats.JsonFormat()
+                max_column_time = self.stream_to_s3(query=data_query, table=table, column=column,
+                                                    batch_size=batch_size or methods.DEFAULT_BATCH_SIZE,
+                                                    output_format=output_format)
+
+            # updates catalogue once all parts are written
+            if max_column_time is not None:
+                self.update_catalogue(column_name=column, column_time=max_column_time,
+                                      table_name=table, app_run_time=datetime.now(),
+                                      data_source='mysql-{}'.format(table))
 
         except Exception as error:
             logging.info('[mysql.db] error while loading table from MySQL: {} [{}]'.format(error, datetime.now()))
+            if self.raise_errors:
+                raise
 
         finally:
+            metrics.end_job(previous_job)
             logging.info(
                 '[mysql.db] loading data from {} at {} days based on column {} done! [{}]'.format(table, days, column,
                                                                                                   datetime.now()))
 
-    def replicate_table(self, table, column):
+    def replicate_table(self, table, column, batch_size=None, output_format=None, partitions=None,
+                        split_column=None, page_size=None, key_column=None):
         """
         gathers information from s3 .csv object and determines what data needs replication from the database
         :param table: string. the table that will be updated and replicated from
         :param column: string. the column that satisfies the date parameter for replication
+        :param batch_size: integer. if given, new rows are read through an unbuffered cursor
+        and written to s3 in objects of batch_size rows
+        :param output_format: an output format from dbtos3.s3_model.formats, for instance ParquetFormat().
+        if given, the rows are streamed into a single object of that format instead of json
+        :param partitions: integer. if given, the rows are split into this many key ranges of split_column
+        which are extracted in parallel, each on its own connection and into its own s3 object
+        :param split_column: string. integer or timestamp column to split on, defaults to the primary key
+        :param page_size: integer. if given, new rows are replicated in pages of page_size rows ordered on
+        (column, key_column), and the watermark is kept on both so rows sharing a timestamp are never skipped
+        :param key_column: string. unique column that orders rows of the same timestamp, defaults to the primary key
         :return: writes directly to s3
         """
+        previous_job = metrics.begin_job('mysql', table)
         try:
             logging.info(
                 '[mysql.db] replicating table {} based on timestamp {} [{}]'.format(table, column, datetime.now()))
 
+            if page_size is not None:
+                self.keyset_to_s3(table=table, column=column, key_column=key_column or self.get_primary_key(table),
+                                  page_size=page_size, output_format=output_format)
+                return
+
             # get max update time first from catalogue
             max_update_time = catalogue.CatalogueMethods().get_max_time_from_catalogue(table=table,
                                                                                        data_source='mysql-{}'.format(
@@ -145,29 +222,32 @@ class ReplicationMethodsMySQL:
             else:
                 data_query = "select * from {} where {} > '{}'".format(table, column, max_update_time)
 
-                # if method will pass the data if there is no updates needed
-                self.cursor.execute(data_query)
-
-                # substitute for real dictionary cursor to preserve the column names of the table
-                # querying from the database and simply parsing to json loses vital data, so the
-                # steps below gather the data, and generates a dict that zips column names to relevant data
-                # this is as efficient as I can develop, so will need to look for something better in future
-                columns = [desc[0] for desc in self.cursor.description]
-                data = [dict(zip(columns, row)) for row in self.cursor.fetchall()]
-
-                catalogue.CatalogueMethods().update_catalogue(column_name=column,
-                                                              column_time=self.get_max_time_from_db(table=table,
-                                                                                                    column=column),
-                                                              table_name=table,
-                                                              app_run_time=datetime.now(),
-                                                              data_source='mysql-{}'.format(table))
-
-                self.s3_service.write_to_s3(data=data, local=table)
+                if partitions is not None:
+                    max_column_time = self.partitioned_to_s3(query=data_query, table=table, column=column,
+                                                             partitions=partitions, split_column=split_column,
+                                                             batch_size=batch_size, output_format=output_format)
+                else:
+                    # without a batch size or format the new rows are written as one json array
+                    if batch_size is None and output_format is None:
+                        output_format = formats.JsonFormat()
+                    max_column_time = self.stream_to_s3(query=data_query, table=table, column=column,
+                                                        batch_size=batch_size or methods.DEFAULT_BATCH_SIZE,
+                                                        output_format=output_format)
+
+                # the watermark is the max of the rows that were extracted, not a second max() query on the table,
+                # so rows committed after the extraction are picked up by the next run instead of being skipped
+                if max_column_time is not None:
+                    self.update_catalogue(column_name=column, column_time=max_column_time,
+                                          table_name=table, app_run_time=datetime.now(),
+                                          data_source='mysql-{}'.format(table))
 
         except Exception as error:
             logging.info('[mysql.db] error while loading table from MySQL: {} [{}]'.format(error, datetime.now()))
+            if self.raise_errors:
+                raise
 
         finally:
+            metrics.end_job(previous_job)
             logging.info(
                 '[mysql.db] loading data from {} based on column {} done! [{}]'.format(table, column, datetime.now()))
 
@@ -183,15 +263,8 @@ class ReplicationMethodsMySQL:
 
         except Exception as error:
             logging.info('[mysql.db] error while loading table from MySQL: {} [{}]'.format(error, datetime.now()))
+            if self.raise_errors:
+                raise
 
         finally:
             logging.info('[mysql.db] getting max time from {} complete! [{}]'.format(table, datetime.now()))
-
-    def close_connection(self):
-        """
-        closes connection to database
-        :return: none
-        """
-        logging.info('[mysql.db] closing all connections [{}]'.format(datetime.now()))
-        self.connection.close()
-        catalogue.CatalogueMethods().close_connection()
@@ -0,0 +1,281 @@
+"""
+Database connections and the s3 client shared by every model of a process.
+
+Models borrow a connection from the pool of their database when they are built, and give it back when their
+connection is closed, so JobRunners that build models per source, or a partitioned load that builds a worker
+per key range, reuse connections instead of opening new ones. Connections are opened when none is idle,
+and at most pool_size are kept open per database once given back. How many are in use at once is still
+bound by the limit of a source in the JobRunner, or the partitions of a load.
+
+There is one boto3 client per set of credentials, created once and shared by every S3ServiceMethod.
+Clients are thread safe, and max_pool_connections is raised above the botocore default of 10 so parts
+uploaded on many threads do not wait on sockets:
+
+from dbtos3.pool_model import pools
+pools.registry.configure(pool_size=16, max_pool_connections=64)
+
+A forked worker process starts with an empty registry, it never uses the sockets of its parent.
+"""
+import logging
+import os
+import threading
+from datetime import datetime
+
+import boto3
+import botocore.config
+import mysql.connector
+import psycopg2
+import psycopg2.extensions
+
+# idle connections kept open per database
+DEFAULT_POOL_SIZE = 10
+
+# http connections of the shared s3 client, botocore keeps 10 by default
+DEFAULT_MAX_POOL_CONNECTIONS = 50
+
+
+def reset_postgres(connection):
+    """
+    ends the transaction a returned psycopg2 connection is in
+    :param connection: psycopg2 connection
+    :return: boolean. whether the connection can be borrowed again
+    """
+    if connection.closed:
+        return False
+    status = connection.get_transaction_status()
+    if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+        return False
+    if status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+        connection.rollback()
+    return True
+
+
+def reset_mysql(connection):
+    """
+    reads what is left of a result and ends the transaction a returned mysql.connector connection is in
+    :param connection: mysql.connector connection
+    :return: boolean. whether the connection can be borrowed again
+    """
+    if not connection.is_connected():
+        return False
+    if connection.unread_result:
+        connection.consume_results()
+    connection.rollback()
+    return True
+
+
+def alive_postgres(connection):
+    """
+    :param connection: psycopg2 connection
+    :return: boolean. whether an idle connection can still be used, psycopg2 marks it closed once the server is gone
+    """
+    return not connection.closed
+
+
+def alive_mysql(connection):
+    """
+    :param connection: mysql.connector connection
+    :return: boolean. whether an idle connection can still be used, is_connected pings the server
+    """
+    return connection.is_connected()
+
+
+class ConnectionPool:
+    """
+    a thread safe pool of connections to one database. connections are opened when none is idle, and at most
+    size of them are kept open for reuse once they are given back
+    """
+
+    def __init__(self, connect, reset, alive=None, size=DEFAULT_POOL_SIZE):
+        """
+        :param connect: callable opening a new connection
+        :param reset: callable preparing a returned connection for its next borrower, returns false if it is broken
+        :param alive: callable checking an idle connection before it is borrowed, for instance one the server
+        closed after its idle timeout. idle connections are not checked if not given
+        :param size: integer. idle connections kept for reuse
+        """
+        self.connect = connect
+        self.reset = reset
+        self.alive = alive
+        self.size = size
+
+        self.lock = threading.Lock()
+        self.idle = []
+
+    def borrow(self):
+        """
+        :return: an idle connection that is still alive, or a new one if there is none
+        """
+        while True:
+            with self.lock:
+                if not self.idle:
+                    break
+                connection = self.idle.pop()
+            try:
+                if self.alive is None or self.alive(connection):
+                    return connection
+            except Exception as error:
+                logging.info('[pool.pools] idle connection could not be checked: {} [{}]'.format(error,
+                                                                                                 datetime.now()))
+            logging.info('[pool.pools] closing idle connection that is no longer alive [{}]'.format(datetime.now()))
+            close_quietly(connection)
+        return self.connect()
+
+    def give_back(self, connection):
+        """
+        keeps a connection for the next borrower, or closes it if it cannot be used again or enough are idle
+        :param connection: a connection borrowed from this pool
+        :return: none
+        """
+        try:
+            reusable = self.reset(connection)
+        except Exception as error:
+            logging.info('[pool.pools] closing connection that could not be reset: {} [{}]'.format(error,
+                                                                                                  datetime.now()))
+            reusable = False
+
+        with self.lock:
+            if reusable and len(self.idle) < self.size:
+                self.idle.append(connection)
+                return
+        close_quietly(connection)
+
+    def close(self):
+        """
+        closes the idle connections, borrowed connections are closed when they are given back
+        :return: none
+        """
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for connection in idle:
+            close_quietly(connection)
+
+
+def close_quietly(connection):
+    try:
+        connection.close()
+    except Exception as error:
+        logging.info('[pool.pools] error while closing connection: {} [{}]'.format(error, datetime.now()))
+
+
+class PoolRegistry:
+    """
+    the connection pools and s3 clients of a process, keyed by their connection settings
+    """
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, max_pool_connections=DEFAULT_MAX_POOL_CONNECTIONS):
+        """
+        :param pool_size: integer. idle connections kept open per database
+        :param max_pool_connections: integer. http connections of each s3 client
+        """
+        self.pool_size = pool_size
+        self.max_pool_connections = max_pool_connections
+
+        self.lock = threading.Lock()
+        self.pools = {}
+        self.s3_clients = {}
+        # the pool every borrowed connection goes back to
+        self.borrowed = {}
+
+    def configure(self, pool_size=None, max_pool_connections=None):
+        """
+        changes the settings of pools and clients that are created from now on
+        :param pool_size: integer. idle connections kept open per database
+        :param max_pool_connections: integer. http connections of each s3 client
+        :return: none
+        """
+        with self.lock:
+            if pool_size is not None:
+                self.pool_size = pool_size
+            if max_pool_connections is not None:
+                self.max_pool_connections = max_pool_connections
+
+    def pool(self, key, connect, reset, alive=None):
+        with self.lock:
+            if key not in self.pools:
+                self.pools[key] = ConnectionPool(connect=connect, reset=reset, alive=alive, size=self.pool_size)
+            return self.pools[key]
+
+    def borrow(self, key, connect, reset, alive=None):
+        pool = self.pool(key=key, connect=connect, reset=reset, alive=alive)
+        connection = pool.borrow()
+        with self.lock:
+            self.borrowed[connection] = pool
+        return connection
+
+    def postgres_connection(self, host, database, user, password, port):
+        """
+        borrows a psycopg2 connection, to be given back with release
+        :return: psycopg2 connection
+        """
+        return self.borrow(key=('postgres', host, port, database, user, password),
+                           connect=lambda: psycopg2.connect(host=host, database=database, user=user,
+                                                            password=password, port=port),
+                           reset=reset_postgres, alive=alive_postgres)
+
+    def mysql_connection(self, host, database, user, password, port):
+        """
+        borrows a mysql.connector connection, to be given back with release
+        :return: mysql.connector connection
+        """
+        return self.borrow(key=('mysql', host, port, database, user, password),
+                           connect=lambda: mysql.connector.connect(host=host, user=user, passwd=password,
+                                                                   database=database, port=port),
+                           reset=reset_mysql, alive=alive_mysql)
+
+    def release(self, connection):
+        """
+        gives a borrowed connection back to its pool, any other connection is closed
+        :param connection: a connection borrowed from this registry, or one opened elsewhere
+        :return: none
+        """
+        with self.lock:
+            pool = self.borrowed.pop(connection, None)
+        if pool is None:
+            connection.close()
+        else:
+            pool.give_back(connection)
+
+    def s3_client(self, region_name, aws_access_key_id, aws_secret_access_key):
+        """
+        :return: the boto3 s3 client of the credentials, created on first use
+        """
+        key = (region_name, aws_access_key_id, aws_secret_access_key)
+        with self.lock:
+            if key not in self.s3_clients:
+                logging.info('[pool.pools] creating s3 client of region {} [{}]'.format(region_name, datetime.now()))
+                # created under the lock, the default session of boto3 is not thread safe but keeps the
+                # service models it has loaded, which a new session would load again
+                self.s3_clients[key] = boto3.client('s3', region_name=region_name,
+                                                    aws_access_key_id=aws_access_key_id,
+                                                    aws_secret_access_key=aws_secret_access_key,
+                                                    config=botocore.config.Config(
+                                                        max_pool_connections=self.max_pool_connections))
+            return self.s3_clients[key]
+
+    def close(self):
+        """
+        closes the idle connections of every pool, for instance when a process is done
+        :return: none
+        """
+        with self.lock:
+            pools = list(self.pools.values())
+        for pool in pools:
+            pool.close()
+
+    def forget(self):
+        """
+        drops every pool and client without closing them, they belong to the parent of a forked process
+        :return: none
+        """
+        self.lock = threading.Lock()
+        self.pools = {}
+        self.s3_clients = {}
+        self.borrowed = {}
+
+
+# the registry of this process, every model borrows from it
+registry = PoolRegistry()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=registry.forget)
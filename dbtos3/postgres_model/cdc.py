@@ -0,0 +1,390 @@
+"""
+Change data capture from the PostgreSQL write ahead log through logical decoding.
+
+Unlike timestamp replication, every insert, update, delete and truncate of the captured tables
+is written to s3, without an updated_at column or a range scan of the table. The server needs
+wal_level = logical, and the user the replication privilege:
+
+capture = ChangeDataCapturePostgreSQL(..., slot_name='dbtos3')
+capture.set_up_capture(tables=['users', 'orders'])
+capture.capture_to_s3(tables=['users', 'orders'])
+
+pgoutput is built into PostgreSQL 10 and later and needs a publication of the tables, which
+set_up_capture creates. wal2json has to be installed on the server and filters the tables itself.
+"""
+import json
+import logging
+import os
+import select
+import struct
+from datetime import datetime
+
+import psycopg2
+import psycopg2.errors
+import psycopg2.extras
+
+from dbtos3.metrics_model import metrics
+from dbtos3.s3_model import service
+from dbtos3.sqlite_model import catalogue
+
+try:
+    os.mkdir('Logs')
+except FileExistsError:
+    pass
+
+for handler in logging.root.handlers[:]:
+    logging.root.removeHandler(handler)
+
+logging.basicConfig(filename='Logs/logs-{}.log'.format(datetime.now().strftime('%d%m%y%H%M')),
+                    filemode='w', datefmt='%d-%b-%y %H:%M:%S', level=logging.INFO)
+
+# rows of a pgoutput update that kept an unchanged toasted value are sent without that value
+UNCHANGED_TOAST = object()
+
+ACTIONS = {'I': 'insert', 'U': 'update', 'D': 'delete', 'T': 'truncate'}
+
+
+def lsn_to_text(lsn):
+    """
+    :param lsn: integer. a log sequence number as given by psycopg2
+    :return: string. the lsn as postgres writes it, for instance 0/16B3748
+    """
+    return '{:X}/{:X}'.format(lsn >> 32, lsn & 0xFFFFFFFF)
+
+
+def relation_name(schema, table):
+    """
+    :return: string. the table name, qualified by its schema when it is not in public
+    """
+    return table if schema == 'public' else '{}.{}'.format(schema, table)
+
+
+def read_cstring(payload, offset):
+    end = payload.index(b'\0', offset)
+    return payload[offset:end].decode('UTF-8'), end + 1
+
+
+def read_tuple(payload, offset):
+    """
+    reads pgoutput tuple data, values are given in their postgres text representation
+    :param payload: bytes. the pgoutput message
+    :param offset: integer. position of the tuple in the message
+    :return: tuple of (list of values, offset after the tuple)
+    """
+    count = struct.unpack_from('>h', payload, offset)[0]
+    offset += 2
+    values = []
+    for _ in range(count):
+        kind = payload[offset:offset + 1]
+        offset += 1
+        if kind == b't':
+            length = struct.unpack_from('>i', payload, offset)[0]
+            offset += 4
+            values.append(payload[offset:offset + length].decode('UTF-8'))
+            offset += length
+        elif kind == b'u':
+            values.append(UNCHANGED_TOAST)
+        else:
+            values.append(None)
+    return values, offset
+
+
+def decode_pgoutput(payload, relations):
+    """
+    decodes a message of the pgoutput plugin (protocol version 1)
+    :param payload: bytes. the message
+    :param relations: dict of relation id to (name, column names), kept up to date from relation messages
+    :return: tuple of (list of changes, whether the message commits a transaction)
+    """
+    kind = payload[:1].decode('ascii')
+
+    if kind == 'C':
+        return [], True
+
+    if kind == 'R':
+        relation_id = struct.unpack_from('>I', payload, 1)[0]
+        schema, offset = read_cstring(payload, 5)
+        table, offset = read_cstring(payload, offset)
+        # replica identity setting, then the amount of columns
+        count = struct.unpack_from('>h', payload, offset + 1)[0]
+        offset += 3
+        columns = []
+        for _ in range(count):
+            name, offset = read_cstring(payload, offset + 1)
+            # type oid and type modifier
+            offset += 8
+            columns.append(name)
+        relations[relation_id] = (relation_name(schema, table), columns)
+        return [], False
+
+    if kind in ('I', 'U', 'D'):
+        relation_id = struct.unpack_from('>I', payload, 1)[0]
+        table, columns = relations[relation_id]
+        offset = 5
+        identity = None
+        data = None
+        while offset < len(payload):
+            # K is the old key of the row, O the full old row, N the new row
+            tuple_kind = payload[offset:offset + 1]
+            values, offset = read_tuple(payload, offset + 1)
+            row = {name: value for name, value in zip(columns, values) if value is not UNCHANGED_TOAST}
+            if tuple_kind == b'N':
+                data = row
+            else:
+                identity = row
+        return [{'action': ACTIONS[kind], 'table': table, 'data': data, 'identity': identity}], False
+
+    if kind == 'T':
+        count = struct.unpack_from('>i', payload, 1)[0]
+        relation_ids = struct.unpack_from('>{}I'.format(count), payload, 6)
+        return [{'action': 'truncate', 'table': relations[relation_id][0], 'data': None, 'identity': None}
+                for relation_id in relation_ids], False
+
+    # begin, origin, type and logical messages carry no row changes
+    return [], False
+
+
+def decode_wal2json(payload):
+    """
+    decodes a message of the wal2json plugin (format version 2)
+    :param payload: string. the json message
+    :return: tuple of (list of changes, whether the message commits a transaction)
+    """
+    message = json.loads(payload)
+    action = message.get('action')
+
+    if action == 'C':
+        return [], True
+    if action not in ACTIONS:
+        return [], False
+
+    def row(values):
+        return None if values is None else {value['name']: value['value'] for value in values}
+
+    return [{'action': ACTIONS[action], 'table': relation_name(message['schema'], message['table']),
+             'data': row(message.get('columns')), 'identity': row(message.get('identity'))}], False
+
+
+class ChangeDataCapturePostgreSQL:
+    """
+    PostgreSQL_Model change data capture methods
+    """
+
+    def __init__(self, host, database, user, password, port, region_name, aws_access_key_id, aws_secret_access_key,
+                 s3bucket, main_key, slot_name='dbtos3', plugin='pgoutput', publication_name=None,
+                 raise_errors=False):
+        """
+        :param slot_name: string. the logical replication slot, the server keeps the log from the position
+        the slot confirmed onwards, so every capture of a slot has to be read regularly
+        :param plugin: string. pgoutput or wal2json
+        :param publication_name: string. the publication read with pgoutput, defaults to the slot name
+        """
+        if plugin not in ('pgoutput', 'wal2json'):
+            raise ValueError('unknown plugin {}, use pgoutput or wal2json'.format(plugin))
+
+        # errors are logged and swallowed by default, raise_errors passes them on to the caller
+        self.raise_errors = raise_errors
+
+        self.host = host
+        self.database = database
+        self.user = user
+        self.password = password
+        self.port = port
+
+        self.slot_name = slot_name
+        self.plugin = plugin
+        self.publication_name = publication_name or slot_name
+        self.data_source = 'postgres-cdc-{}'.format(slot_name)
+
+        self.s3_service = service.S3ServiceMethod(
+            region_name=region_name,
+            aws_access_key_id=aws_access_key_id,
+            aws_secret_access_key=aws_secret_access_key,
+            s3bucket=s3bucket,
+            main_key=main_key,
+            # a change is only confirmed to the server once it is written, so a failed write has to stop the capture
+            raise_errors=True
+        )
+
+        self.connection = self.connect(connection_factory=psycopg2.extras.LogicalReplicationConnection)
+
+        self.cursor = self.connection.cursor()
+
+        # ensures the catalogue exists
+        catalogue.CatalogueMethods().set_up_catalogue()
+
+    def connect(self, connection_factory=None):
+        """
+        opens a new connection to the database of this model
+        :param connection_factory: psycopg2 connection class, for instance LogicalReplicationConnection
+        :return: psycopg2 connection
+        """
+        return psycopg2.connect(
+            host=self.host,
+            database=self.database,
+            user=self.user,
+            password=self.password,
+            port=self.port,
+            connection_factory=connection_factory
+        )
+
+    def set_up_capture(self, tables):
+        """
+        creates the replication slot, and with pgoutput the publication of the tables, if they do not exist yet
+        changes are kept by the server from the moment the slot is created
+        :param tables: list of strings. the tables to capture
+        :return: none
+        """
+        try:
+            logging.info('[postgresql.cdc] setting up capture slot {} [{}]'.format(self.slot_name, datetime.now()))
+
+            if self.plugin == 'pgoutput':
+                connection = self.connect()
+                connection.autocommit = True
+                try:
+                    cursor = connection.cursor()
+                    cursor.execute('select 1 from pg_publication where pubname = %s', (self.publication_name,))
+                    verb = 'alter publication {} set' if cursor.fetchall() else 'create publication {} for'
+                    cursor.execute('{} table {}'.format(verb.format(self.publication_name), ', '.join(tables)))
+                finally:
+                    connection.close()
+
+            try:
+                self.cursor.create_replication_slot(self.slot_name, output_plugin=self.plugin)
+            except psycopg2.errors.DuplicateObject:
+                logging.info('[postgresql.cdc] slot {} already exists [{}]'.format(self.slot_name, datetime.now()))
+
+        except Exception as error:
+            logging.info('[postgresql.cdc] error while setting up capture: {} [{}]'.format(error, datetime.now()))
+            if self.raise_errors:
+                raise
+
+    def replication_options(self, tables):
+        """
+        :param tables: list of strings. the tables to capture
+        :return: dict of plugin options
+        """
+        if self.plugin == 'pgoutput':
+            return {'proto_version': '1', 'publication_names': self.publication_name}
+        # wal2json filters the tables itself, unqualified tables are matched in every schema
+        return {'format-version': '2', 'include-transaction': 'true',
+                'add-tables': ','.join(table if '.' in table else '*.{}'.format(table) for table in tables)}
+
+    def write_changes(self, changes, part, output_format=None):
+        """
+        writes a batch of changes to s3, one object per table
+        :param changes: list of change dicts
+        :param part: integer. number of the batch in this capture
+        :param output_format: an output format from dbtos3.s3_model.formats, for instance NdjsonFormat('gzip')
+        :return: none
+        """
+        by_table = {}
+        for change in changes:
+            by_table.setdefault(change['table'], []).append(change)
+
+        for table, table_changes in by_table.items():
+            self.s3_service.write_to_s3(data=table_changes, local='{}-changes'.format(table), part=part,
+                                        output_format=output_format)
+
+    def capture_to_s3(self, tables, batch_size=10000, idle_timeout=10, max_changes=None, output_format=None):
+        """
+        reads the changes of the tables from the slot and writes them to s3 in batches, until no change
+        arrived for idle_timeout seconds. a batch is only written at the end of a transaction, after which
+        its lsn is confirmed to the server and stored in the catalogue, so a capture that is interrupted
+        resumes after the last batch that was written
+        every change is written as {lsn, action, table, data, identity}, where identity is the old key of
+        an updated or deleted row. pgoutput values are given in their postgres text representation
+
+        :param tables: list of strings. the tables to capture, with wal2json
+        :param batch_size: integer. amount of changes held in memory before they are written
+        :param idle_timeout: integer. seconds without changes after which the capture stops
+        :param max_changes: integer. stop after this many changes, none reads until the slot is idle
+        :param output_format: an output format from dbtos3.s3_model.formats, for instance NdjsonFormat('gzip')
+        :return: the amount of changes written
+        """
+        captured = 0
+        previous_job = metrics.begin_job('postgres-cdc', self.slot_name)
+        try:
+            start_lsn = catalogue.CatalogueMethods().get_log_position(data_source=self.data_source)
+            logging.info('[postgresql.cdc] capturing {} from slot {} at {} [{}]'.format(
+                ', '.join(tables), self.slot_name, start_lsn, datetime.now()))
+
+            # the server starts at the later of this lsn and the one the slot last confirmed
+            self.cursor.start_replication(slot_name=self.slot_name, decode=self.plugin == 'wal2json',
+                                          start_lsn=start_lsn or 0, options=self.replication_options(tables))
+
+            relations = {}
+            # changes of committed transactions, and of the transaction being read
+            changes = []
+            pending = []
+            part = 0
+            last_lsn = None
+            flushed_lsn = None
+
+            while max_changes is None or captured + len(changes) + len(pending) < max_changes:
+                message = self.cursor.read_message()
+                if message is None:
+                    if not select.select([self.cursor], [], [], idle_timeout)[0]:
+                        break
+                    continue
+
+                if self.plugin == 'pgoutput':
+                    message_changes, committed = decode_pgoutput(message.payload, relations)
+                else:
+                    message_changes, committed = decode_wal2json(message.payload)
+
+                lsn = lsn_to_text(message.data_start)
+                for change in message_changes:
+                    change['lsn'] = lsn
+                pending.extend(message_changes)
+
+                if committed:
+                    changes.extend(pending)
+                    pending = []
+                    last_lsn = message.data_start
+                    if len(changes) >= batch_size:
+                        captured += self.flush(changes=changes, part=part, lsn=last_lsn, output_format=output_format)
+                        flushed_lsn = last_lsn
+                        changes = []
+                        part += 1
+
+            # changes of a transaction that was cut off by max_changes are read again by the next capture
+            if last_lsn != flushed_lsn:
+                captured += self.flush(changes=changes, part=part, lsn=last_lsn, output_format=output_format)
+
+            return captured
+
+        except Exception as error:
+            logging.info('[postgresql.cdc] error while capturing changes: {} [{}]'.format(error, datetime.now()))
+            if self.raise_errors:
+                raise
+
+        finally:
+            metrics.end_job(previous_job)
+            logging.info('[postgresql.cdc] captured {} changes from slot {} [{}]'.format(captured, self.slot_name,
+                                                                                       datetime.now()))
+
+    def flush(self, changes, part, lsn, output_format=None):
+        """
+        writes the changes up to a commit and confirms its lsn, the server may then recycle the log before it
+        :param changes: list of change dicts
+        :param part: integer. number of the batch in this capture
+        :param lsn: integer. lsn of the commit the changes end with
+        :param output_format: an output format from dbtos3.s3_model.formats
+        :return: the amount of changes written
+        """
+        self.write_changes(changes=changes, part=part, output_format=output_format)
+        metrics.record('rows', len(changes))
+        self.cursor.send_feedback(flush_lsn=lsn)
+        catalogue.CatalogueMethods().update_log_position(data_source=self.data_source, position=lsn_to_text(lsn),
+                                                         app_run_time=datetime.now())
+        return len(changes)
+
+    def close_connection(self):
+        """
+        closes connection to database
+        :return: none
+        """
+        logging.info('[postgresql.cdc] closing all connections [{}]'.format(datetime.now()))
+        self.connection.close()
+        catalogue.close_catalogue_connection()
@@ -1,11 +1,12 @@
 import logging
 import os
+import uuid
 from datetime import datetime
 
-import pandas as pd
-import psycopg2
-
-from dbtos3.s3_model import service
+from dbtos3.metrics_model import metrics
+from dbtos3.pool_model import pools
+from dbtos3.s3_model import formats, service
+from dbtos3.sql_model import methods
 from dbtos3.sqlite_model import catalogue
 
 try:
@@ -19,14 +20,26 @@ for handler in logging.root.handlers[:]:
 logging.basicConfig(filename='Logs/logs-{}.log'.format(datetime.now().strftime('%d%m%y%H%M')),
                     filemode='w', datefmt='%d-%b-%y %H:%M:%S', level=logging.INFO)
 
+# copy options, key extension and content type per copy format
+COPY_FORMATS = {
+    'csv': ('FORMAT csv, HEADER true', 'csv', 'text/csv'),
+    'binary': ('FORMAT binary', 'pgcopy', 'application/octet-stream'),
+}
+
 
-class ReplicationMethodsPostgreSQL:
+class ReplicationMethodsPostgreSQL(methods.ReplicationMethodsSQL):
     """
     PostgreSQL_Model replication methods
     """
 
+    log_name = 'postgresql.db'
+    source_name = 'postgres'
+
     def __init__(self, host, database, user, password, port, region_name, aws_access_key_id, aws_secret_access_key,
-                 s3bucket, main_key):
+                 s3bucket, main_key, raise_errors=False):
+        # errors are logged and swallowed by default, raise_errors passes them on to the caller
+        self.raise_errors = raise_errors
+
         self.host = host
         self.database = database
         self.user = user
@@ -45,10 +58,24 @@ class ReplicationMethodsPostgreSQL:
             aws_access_key_id=aws_access_key_id,
             aws_secret_access_key=aws_secret_access_key,
             s3bucket=s3bucket,
-            main_key=main_key
+            main_key=main_key,
+            raise_errors=raise_errors
         )
 
-        self.connection = psycopg2.connect(
+        self.connection = self.connect()
+
+        self.cursor = self.connection.cursor()
+
+        # ensures the catalogue exists
+        catalogue.CatalogueMethods().set_up_catalogue()
+
+    def connect(self):
+        """
+        borrows a connection to the database of this model from the pool of the process,
+        it is given back by close_connection or release_connection
+        :return: psycopg2 connection
+        """
+        return pools.registry.postgres_connection(
             host=self.host,
             database=self.database,
             user=self.user,
@@ -56,87 +83,267 @@ class ReplicationMethodsPostgreSQL:
             port=self.port
         )
 
-        self.cursor = self.connection.cursor()
+    def fetch_batches(self, query, batch_size):
+        """
+        streams the result of a query through a named (server side) cursor, so that only
+        batch_size rows are held in memory at any one time
+        :param query: string. the query to be executed
+        :param batch_size: integer. amount of rows fetched from the server per round trip
+        :return: generator of (cursor description, list of row tuples)
+        """
+        # named cursors are declared on the server and only hand over itersize rows at a time
+        stream_cursor = self.connection.cursor(name='dbtos3_{}'.format(uuid.uuid4().hex))
+        stream_cursor.itersize = batch_size
 
-        # ensures the catalogue exists
-        catalogue.CatalogueMethods().set_up_catalogue()
+        try:
+            with metrics.timer('query'):
+                stream_cursor.execute(query)
+            while True:
+                with metrics.timer('fetch'):
+                    rows = stream_cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                metrics.record('rows', len(rows))
+                # a named cursor only has a description once the first rows have been fetched
+                yield stream_cursor.description, rows
+
+        finally:
+            stream_cursor.close()
+            # ends the transaction the server side cursor lived in
+            self.connection.commit()
+
+    def capture_upper(self, table, column):
+        """
+        the highest value of a column of the table, answered from an index on the column without scanning the rows
+        :param table: string. the table that is being loaded
+        :param column: string. the column that satisfies the timestamp of the table
+        :return: the max value of column, none if the table has no rows
+        """
+        with metrics.timer('query'):
+            self.cursor.execute('select max({}) from {}'.format(column, table))
+            upper = self.cursor.fetchone()[0]
+        self.connection.commit()
+        return upper
+
+    def bound_query(self, query, column, upper):
+        """
+        :param query: string. the query to be bound
+        :param column: string. the column that satisfies the timestamp of the table
+        :param upper: the highest value of column the query may return
+        :return: string. the query limited to rows up to upper
+        """
+        return self.cursor.mogrify('select * from ({}) as bounded where {} <= %s'.format(query, column),
+                                   (upper,)).decode()
 
-    @staticmethod
-    def update_catalogue(column_name, column_time, table_name, app_run_time, data_source):
-        update_catalogue = catalogue.CatalogueMethods()
-        update_catalogue.update_catalogue(column_name=column_name, column_time=column_time, table_name=table_name,
-                                          app_run_time=app_run_time, data_source=data_source)
+    def copy_to_s3(self, query, table, column, copy_format='csv', codec=None, part=None, upper=None):
+        """
+        streams a query straight to s3 with "copy (query) to stdout", the bytes postgres sends
+        are passed on to a multipart upload (optionally compressed) without building python rows
+        :param query: string. the query to be copied
+        :param table: string. the table that is being loaded
+        :param column: string. the column that satisfies the timestamp of the table
+        :param copy_format: string. csv (with a header row) or binary, the postgres binary copy format
+        :param codec: string. gzip, zstd or none for uncompressed output
+        :param part: int. optional part number, when a table is copied in partitions
+        :param upper: the value of column the query was bound to with bound_query, captured and bound here if not given
+        :return: the max value of column over the copied rows
+        """
+        if copy_format not in COPY_FORMATS:
+            raise ValueError('unknown copy format {}, use csv or binary'.format(copy_format))
+        copy_options, extension, content_type = COPY_FORMATS[copy_format]
+        suffix, content_encoding = formats.CODECS[codec]
+
+        logging.info('[postgresql.db] copying {} to s3 as {} [{}]'.format(table, copy_format, datetime.now()))
+
+        # the copy never hands over rows, so instead of taking the max of the query in a second scan the query
+        # is bound by the max of the table, which the copied rows reach whenever there are any
+        if upper is None:
+            upper = self.capture_upper(table=table, column=column)
+            if upper is None:
+                logging.info('[postgresql.db] no rows to copy in {} [{}]'.format(table, datetime.now()))
+                return None
+            query = self.bound_query(query=query, column=column, upper=upper)
+
+        writer = self.s3_service.begin_multipart_write(local=table, extension=extension + suffix, part=part,
+                                                       content_type=content_type, content_encoding=content_encoding)
+        try:
+            sink = formats.CompressedSink(writer, codec=codec)
+            # the copy output is handed to the upload as it arrives, so its time counts as fetching
+            with metrics.timer('fetch'):
+                self.cursor.copy_expert('copy ({}) to stdout with ({})'.format(query, copy_options),
+                                        formats.SinkFile(sink))
+            sink.close()
+            copied = max(self.cursor.rowcount, 0)
+            metrics.record('rows', copied)
+
+        except Exception:
+            writer.abort()
+            self.connection.rollback()
+            raise
+
+        self.connection.commit()
+        writer.commit()
+        return upper if copied else None
+
+    def get_primary_key(self, table):
+        """
+        :param table: string. the table of which the primary key is needed
+        :return: the name of the primary key column, raises if the table has no single column primary key
+        """
+        # the primary key columns of a table are the indexed columns of its primary index
+        self.cursor.execute("select a.attname from pg_index i "
+                            "join pg_attribute a on a.attrelid = i.indrelid and a.attnum = any(i.indkey) "
+                            "where i.indrelid = '{}'::regclass and i.indisprimary".format(table))
+        keys = [row[0] for row in self.cursor.fetchall()]
+        if len(keys) != 1:
+            raise ValueError('{} has no single column primary key, set a split_column to partition it'.format(table))
+        return keys[0]
+
+    def extract_range(self, query, table, column, partition, batch_size=None, output_format=None, copy_format=None,
+                      codec=None, upper=None):
+        """
+        extracts one key range of a partitioned load, with copy to stdout if a copy format is given
+        :param query: string. the query of the range
+        :param table: string. the table that is being loaded
+        :param column: string. the column that satisfies the timestamp of the table
+        :param partition: int. number of the key range
+        :param batch_size: integer. amount of rows held in memory at a time
+        :param output_format: an output format from dbtos3.s3_model.formats, for instance ParquetFormat()
+        :param copy_format: string. csv or binary, extracts the range with copy to stdout instead of fetching rows
+        :param codec: string. gzip or zstd compression of the copy output
+        :param upper: the highest value of column to copy, shared by every range of a copied load
+        :return: the max value of column over the rows of the range
+        """
+        if copy_format is not None:
+            return self.copy_to_s3(query=query, table=table, column=column, copy_format=copy_format, codec=codec,
+                                   part=partition, upper=upper)
+        return super().extract_range(query=query, table=table, column=column, partition=partition,
+                                     batch_size=batch_size, output_format=output_format)
+
+    def partitioned_to_s3(self, query, table, column, partitions, split_column=None, **options):
+        """
+        splits a query into key ranges and extracts every range on its own worker connection, see
+        ReplicationMethodsSQL.partitioned_to_s3. a copied load is bound by one captured max of column,
+        so every range copies up to the same value
+        :return: the max value of column over all rows that were extracted
+        """
+        if options.get('copy_format') is None:
+            return super().partitioned_to_s3(query=query, table=table, column=column, partitions=partitions,
+                                             split_column=split_column, **options)
+
+        upper = self.capture_upper(table=table, column=column)
+        if upper is None:
+            logging.info('[postgresql.db] no rows to partition in {} [{}]'.format(table, datetime.now()))
+            return None
+        return super().partitioned_to_s3(query=self.bound_query(query=query, column=column, upper=upper), table=table,
+                                         column=column, partitions=partitions, split_column=split_column, upper=upper,
+                                         **options)
 
-    def day_level_full_load(self, days, table, column):
+    def day_level_full_load(self, days, table, column, batch_size=None, output_format=None, copy_format=None,
+                            codec=None, partitions=None, split_column=None):
 
         """
         full load of data from database to s3 bucket
         method is "select * from {} where {} > now() - interval '{} days'"
-        columns that are parsed into a pandas data-frame collects all column names with
-        method "select column_name from information_schema.columns where table_name = '{}'"
+        rows are encoded to json from their tuples, with the column names of the cursor description
 
         :param days: integer. total amount of historical days to be replicated
         :param table: string. the table that will be replicated
         :param column: string. the column that satisfies the historical timestamp
+        :param batch_size: integer. if given, the table is streamed through a server side cursor
+        and written to s3 in objects of batch_size rows, keeping memory bound by the batch size
+        :param output_format: an output format from dbtos3.s3_model.formats, for instance ParquetFormat().
+        if given, the rows are streamed into a single object of that format instead of json
+        :param copy_format: string. csv or binary. if given, the table is extracted with copy to stdout
+        and the raw copy output is streamed to s3, which is much faster than fetching rows
+        :param codec: string. gzip or zstd compression of the copy output, none for uncompressed
+        :param partitions: integer. if given, the rows are split into this many key ranges of split_column
+        which are extracted in parallel, each on its own connection and into its own s3 object
+        :param split_column: string. integer or timestamp column to split on, defaults to the primary key
         :return: writes directly to s3 bucket
         """
+        previous_job = metrics.begin_job('postgres', table)
         try:
             logging.info(
                 '[postgresql.db] loading data from {} at {} days based on column {} [{}]'.format(table, days, column,
                                                                                                  datetime.now()))
 
-            table_columns = []
             # construct query to get nth days of data from table & all column names of that table
             data_query = "select * from {} where {} > now() - interval '{} days'".format(table, column, days)
-            column_query = "select column_name from information_schema.columns where table_name = '{}';".format(table)
-
-            # execute queries and allocate them to objects
 
-            # gather all column names for data frame
-            self.cursor.execute(column_query)
-            for c in self.cursor.fetchall():
-                table_columns.append(c[0])
-
-            # substitute for real dictionary cursor to preserve the column names of the table
-            # querying from the database and simply parsing to json loses vital data, so the
-            # steps below gather the data, and generates a dict that zips column names to relevant data
-            # this is as efficient as I can develop, so will need to look for something better in future
-            self.cursor.execute(data_query)
-            columns = [desc[0] for desc in self.cursor.description]
-            data = [dict(zip(columns, row)) for row in self.cursor.fetchall()]
-
-            # create data frame to easily gather values using pandas
-            data_frame = pd.DataFrame(data, columns=table_columns)
-
-            # updates catalogue
-            self.update_catalogue(column_name=column, column_time=data_frame[column].max(),
-                                  table_name=table, app_run_time=datetime.now(),
-                                  data_source='postgres-{}'.format(table))
-
-            # use write to s3 method to send data frame directly to s3
-            self.s3_service.write_to_s3(data=data, local=table)
+            if partitions is not None:
+                max_column_time = self.partitioned_to_s3(query=data_query, table=table, column=column,
+                                                         partitions=partitions, split_column=split_column,
+                                                         batch_size=batch_size, output_format=output_format,
+                                                         copy_format=copy_format, codec=codec)
+            elif copy_format is not None:
+                max_column_time = self.copy_to_s3(query=data_query, table=table, column=column,
+                                                  copy_format=copy_format, codec=codec)
+
+            if partitions is not None or copy_format is not None:
+                if max_column_time is not None:
+                    self.update_catalogue(column_name=column, column_time=max_column_time,
+                                          table_name=table, app_run_time=datetime.now(),
+                                          data_source='postgres-{}'.format(table))
+                return
+
+            # without a batch size or format the rows are still read in batches, and written as one json array
+            if batch_size is None and output_format is None:
+                output_format = formats.JsonFormat()
+            max_column_time = self.stream_to_s3(query=data_query, table=table, column=column,
+                                                batch_size=batch_size or methods.DEFAULT_BATCH_SIZE,
+                                                output_format=output_format)
+
+            # updates catalogue once all parts are written
+            if max_column_time is not None:
+                self.update_catalogue(column_name=column, column_time=max_column_time,
+                                      table_name=table, app_run_time=datetime.now(),
+                                      data_source='postgres-{}'.format(table))
 
         except Exception as error:
             logging.info(
                 '[postgresql.db] error while loading table from PostgreSQL: {} [{}]'.format(error, datetime.now()))
+            if self.raise_errors:
+                raise
 
         finally:
+            metrics.end_job(previous_job)
             logging.info(
                 '[postgresql.db] loading data from {} at {} days based on column {} done! [{}]'.format(table, days,
                                                                                                        column,
                                                                                                        datetime.now()))
 
-    def replicate_table(self, table, column):
+    def replicate_table(self, table, column, batch_size=None, output_format=None, copy_format=None, codec=None,
+                        partitions=None, split_column=None, page_size=None, key_column=None):
         """
         gathers information from s3 .csv object and determines what data needs replication from the database
         :param table: string. the table that will be updated and replicated from
         :param column: string. the column that satisfies the date parameter for replication
+        :param batch_size: integer. if given, new rows are streamed through a server side cursor
+        and written to s3 in objects of batch_size rows
+        :param output_format: an output format from dbtos3.s3_model.formats, for instance ParquetFormat().
+        if given, the rows are streamed into a single object of that format instead of json
+        :param copy_format: string. csv or binary. if given, new rows are extracted with copy to stdout
+        and the raw copy output is streamed to s3
+        :param codec: string. gzip or zstd compression of the copy output, none for uncompressed
+        :param partitions: integer. if given, the rows are split into this many key ranges of split_column
+        which are extracted in parallel, each on its own connection and into its own s3 object
+        :param split_column: string. integer or timestamp column to split on, defaults to the primary key
+        :param page_size: integer. if given, new rows are replicated in pages of page_size rows ordered on
+        (column, key_column), and the watermark is kept on both so rows sharing a timestamp are never skipped
+        :param key_column: string. unique column that orders rows of the same timestamp, defaults to the primary key
         :return: writes directly to s3
         """
+        previous_job = metrics.begin_job('postgres', table)
         try:
             logging.info(
                 '[postgresql.db] replicating table {} based on timestamp {} [{}]'.format(table, column, datetime.now()))
 
+            if page_size is not None:
+                self.keyset_to_s3(table=table, column=column, key_column=key_column or self.get_primary_key(table),
+                                  page_size=page_size, output_format=output_format)
+                return
+
             # get max update time first from catalogue
             max_update_time = catalogue.CatalogueMethods().get_max_time_from_catalogue(table=table,
                                                                                        data_source='postgres-{}'.format(
@@ -148,30 +355,37 @@ class ReplicationMethodsPostgreSQL:
             else:
                 data_query = "select * from {} where {} > '{}'".format(table, column, max_update_time)
 
-                # if method will pass the data if there is no updates needed
-                self.cursor.execute(data_query)
-
-                # substitute for real dictionary cursor to preserve the column names of the table
-                # querying from the database and simply parsing to json loses vital data, so the
-                # steps below gather the data, and generates a dict that zips column names to relevant data
-                # this is as efficient as I can develop, so will need to look for something better in future
-                columns = [desc[0] for desc in self.cursor.description]
-                data = [dict(zip(columns, row)) for row in self.cursor.fetchall()]
-
-                catalogue.CatalogueMethods().update_catalogue(column_name=column,
-                                                              column_time=
-                                                              self.get_max_time_from_db(table=table, column=column),
-                                                              table_name=table,
-                                                              app_run_time=datetime.now(),
-                                                              data_source='postgres-{}'.format(table))
-
-                self.s3_service.write_to_s3(data=data, local=table)
+                if partitions is not None:
+                    max_column_time = self.partitioned_to_s3(query=data_query, table=table, column=column,
+                                                             partitions=partitions, split_column=split_column,
+                                                             batch_size=batch_size, output_format=output_format,
+                                                             copy_format=copy_format, codec=codec)
+                elif copy_format is not None:
+                    max_column_time = self.copy_to_s3(query=data_query, table=table, column=column,
+                                                      copy_format=copy_format, codec=codec)
+                else:
+                    # without a batch size or format the new rows are written as one json array
+                    if batch_size is None and output_format is None:
+                        output_format = formats.JsonFormat()
+                    max_column_time = self.stream_to_s3(query=data_query, table=table, column=column,
+                                                        batch_size=batch_size or methods.DEFAULT_BATCH_SIZE,
+                                                        output_format=output_format)
+
+                # the watermark is the max of the rows that were extracted, not a second max() query on the table,
+                # so rows committed after the extraction are picked up by the next run instead of being skipped
+                if max_column_time is not None:
+                    self.update_catalogue(column_name=column, column_time=max_column_time,
+                                          table_name=table, app_run_time=datetime.now(),
+                                          data_source='postgres-{}'.format(table))
 
         except Exception as error:
             logging.info(
                 '[postgresql.db] error while loading table from PostgreSQL: {} [{}]'.format(error, datetime.now()))
+            if self.raise_errors:
+                raise
 
         finally:
+            metrics.end_job(previous_job)
             logging.info('[postgresql.db] loading data from {} based on column {} done! [{}]'.format(table, column,
                                                                                                      datetime.now()))
 
@@ -194,15 +408,8 @@ class ReplicationMethodsPostgreSQL:
         except Exception as error:
             logging.info(
                 '[postgresql.db] error while loading table from PostgreSQL: {} [{}]'.format(error, datetime.now()))
+            if self.raise_errors:
+                raise
 
         finally:
             logging.info('[postgresql.db] getting max time from {} complete! [{}]'.format(table, datetime.now()))
-
-    def close_connection(self):
-        """
-        closes connection to database
-        :return: none
-        """
-        logging.info('[postgresql.db] closing all connections [{}]'.format(datetime.now()))
-        self.connection.close()
-        catalogue.CatalogueMethods().close_connection()
@@ -0,0 +1,661 @@
+"""
+Output formats decide how batches of database rows are encoded into an s3 object.
+
+Rows are encoded to json straight from their tuples and the cursor description. Columns of a type json
+has no notation for, such as datetime, Decimal and UUID, are converted once per column instead of through a
+fallback per value. Durations (a mysql TIME) are written as [-]hh:mm:ss, binary values as base64 and sets as
+lists. With orjson installed (pip install dbtos3[orjson]) the encoding itself runs in orjson,
+which writes NaN and infinity as null where the json module writes NaN and Infinity.
+
+A format describes the object (extension, content type and encoding) and opens an encoder
+on top of a sink, usually an S3MultipartWriter. Encoders take batches of rows together with the
+DB-API cursor description, so rows never have to be turned into dicts:
+
+encoder = output_format.open(writer)
+for description, rows in batches:
+    encoder.write_batch(description, rows)
+encoder.close()
+"""
+import base64
+import json
+import uuid
+import zlib
+from datetime import datetime, date, time, timedelta
+from decimal import Decimal
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def json_serial(obj):
+    """JSON serializer for objects not serializable by default json code"""
+    if isinstance(obj, (datetime, date, time)):
+        return obj.isoformat()
+    if isinstance(obj, (Decimal, uuid.UUID)):
+        return str(obj)
+    if isinstance(obj, timedelta):
+        return format_timedelta(obj)
+    if isinstance(obj, (bytes, bytearray, memoryview)):
+        return base64.b64encode(bytes(obj)).decode('ascii')
+    if isinstance(obj, (set, frozenset)):
+        return sorted(obj, key=str)
+    raise TypeError("Type %s not serializable" % type(obj))
+
+
+def format_timedelta(value):
+    """
+    formats a duration the way mysql writes a TIME, [-]hh:mm:ss[.ffffff], hours can exceed 24
+    :param value: timedelta
+    :return: string
+    """
+    sign = '-' if value < timedelta(0) else ''
+    microseconds = abs(value) // timedelta(microseconds=1)
+    seconds, fraction = divmod(microseconds, 1000000)
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    return '{}{:02d}:{:02d}:{:02d}{}'.format(sign, hours, minutes, seconds,
+                                            '.{:06d}'.format(fraction) if fraction else '')
+
+
+def isoformat(value):
+    return value.isoformat()
+
+
+def orjson_dumps(value):
+    """
+    encodes a value with orjson, values orjson refuses without asking json_serial, such as integers wider
+    than 64 bits (a postgres numeric without a scale) or times with a time zone, are encoded by the json module
+    :param value: json value
+    :return: bytes
+    """
+    try:
+        return orjson.dumps(value, default=json_serial)
+    except TypeError:
+        return json.dumps(value, default=json_serial, allow_nan=True).encode('UTF-8')
+
+
+def column_converter(values):
+    """
+    picks the conversion of a column's values to json values from the first value that is not none
+    :param values: sequence. the values of one column
+    :return: callable converting one value, or none if the values can be encoded as they are
+    """
+    sample = next((v for v in values if v is not None), None)
+
+    if sample is None or isinstance(sample, (str, int, float, list, dict)):
+        return None
+    # orjson writes datetimes, dates, naive times and uuids itself, in the same notation as isoformat and str
+    if orjson is not None and isinstance(sample, (datetime, date, time, uuid.UUID)) and \
+            not (isinstance(sample, time) and sample.tzinfo is not None):
+        return None
+    if isinstance(sample, (datetime, date, time)):
+        return isoformat
+    if isinstance(sample, (Decimal, uuid.UUID)):
+        return str
+    return json_serial
+
+
+def convert_columns(description, rows):
+    """
+    converts the columns of rows to json values, only the columns that need a conversion are touched
+    :param description: DB-API cursor description of the rows
+    :param rows: list of row tuples
+    :return: list of columns, each a sequence of json values
+    """
+    columns = list(zip(*rows)) if rows else [() for _ in description]
+    for index, values in enumerate(columns):
+        converter = column_converter(values)
+        if converter is None:
+            continue
+        try:
+            columns[index] = [None if v is None else converter(v) for v in values]
+        except (AttributeError, TypeError):
+            # a column of mixed types, for instance an untyped sqlite column, is converted value by value
+            columns[index] = [v if v is None or isinstance(v, (str, int, float, list, dict)) else json_serial(v)
+                              for v in values]
+    return columns
+
+
+def encode_column(key, values):
+    """
+    encodes the values of a column with orjson, each with the key of the column in front
+    :param key: bytes. the encoded key of the column followed by a colon
+    :param values: sequence. json values of the column
+    :return: list of bytes
+    """
+    try:
+        return [key + orjson.dumps(v, default=json_serial) for v in values]
+    except TypeError:
+        # a value orjson refuses, for instance an integer wider than 64 bits, is encoded by the json module
+        return [key + orjson_dumps(v) for v in values]
+
+
+def row_objects(description, rows):
+    """
+    encodes rows as json objects, one per row, without building a dict per row when orjson is installed
+    :param description: DB-API cursor description of the rows
+    :param rows: list of row tuples
+    :return: list of bytes, one json object per row
+    """
+    names = [desc[0] for desc in description]
+    columns = convert_columns(description, rows)
+
+    if orjson is not None:
+        # every column is encoded on its own, with its key in front, and the pieces of a row joined
+        encoded = [encode_column(key, values)
+                   for key, values in zip([orjson.dumps(name) + b':' for name in names], columns)]
+        return [b'{' + b','.join(row) + b'}' for row in zip(*encoded)]
+
+    encode = json.JSONEncoder(default=json_serial, allow_nan=True).encode
+    return [encode(dict(zip(names, row))).encode('UTF-8') for row in zip(*columns)]
+
+
+def encode_rows(description, rows):
+    """
+    encodes rows as a single json array of objects
+    :param description: DB-API cursor description of the rows
+    :param rows: list of row tuples
+    :return: bytes
+    """
+    if orjson is not None:
+        return b'[' + b','.join(row_objects(description, rows)) + b']'
+
+    names = [desc[0] for desc in description]
+    return json.dumps([dict(zip(names, row)) for row in zip(*convert_columns(description, rows))],
+                      default=json_serial, allow_nan=True).encode('UTF-8')
+
+
+def encode_records(records):
+    """
+    encodes records that are already dicts as a single json array
+    :param records: list of dicts
+    :return: bytes
+    """
+    if orjson is not None:
+        return orjson_dumps(records)
+    return json.dumps(records, default=json_serial, allow_nan=True).encode('UTF-8')
+
+
+class BufferSink:
+    """
+    in memory sink with write_chunk, used when an encoded object is small enough to be put in one request
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def write_chunk(self, chunk):
+        self.buffer += chunk
+
+
+# key suffix and content encoding per compression codec
+CODECS = {
+    None: ('', None),
+    'gzip': ('.gz', 'gzip'),
+    'zstd': ('.zst', 'zstd'),
+}
+
+
+def check_codec(codec):
+    """
+    :param codec: string. gzip, zstd or none
+    :return: none, raises if the codec is unknown or its library is missing
+    """
+    if codec not in CODECS:
+        raise ValueError('unknown codec {}, use one of gzip, zstd or None'.format(codec))
+    if codec == 'zstd' and zstandard is None:
+        raise ImportError('zstandard is required for zstd output, install it with pip install dbtos3[zstd]')
+
+
+def compressor(codec, level=None):
+    """
+    :param codec: string. gzip, zstd or none
+    :param level: integer. compression level, defaults to the codec's own default
+    :return: streaming compressor with compress and flush, or none when uncompressed
+    """
+    check_codec(codec)
+    if codec == 'gzip':
+        # wbits of 31 writes a gzip header and trailer around the deflate stream
+        return zlib.compressobj(level=-1 if level is None else level, wbits=31)
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor(level=3 if level is None else level).compressobj()
+    return None
+
+
+class CompressedSink:
+    """
+    sink with write_chunk that compresses everything passed through it on to another sink
+    """
+
+    def __init__(self, sink, codec, level=None):
+        self.sink = sink
+        self.compressor = compressor(codec=codec, level=level)
+
+    def write_chunk(self, chunk):
+        if self.compressor is not None:
+            chunk = self.compressor.compress(chunk)
+        if chunk:
+            self.sink.write_chunk(chunk)
+
+    def close(self):
+        if self.compressor is not None:
+            self.sink.write_chunk(self.compressor.flush())
+
+
+class SinkFile:
+    """
+    minimal file object over a sink with write_chunk, as expected by pyarrow writers and psycopg2 copy_expert
+    """
+
+    def __init__(self, sink):
+        self.sink = sink
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode('UTF-8')
+        self.sink.write_chunk(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+# kinds of postgres columns by the type oid psycopg2 gives as type_code
+POSTGRES_KINDS = {
+    16: 'bool', 20: 'int', 21: 'int', 23: 'int', 26: 'int', 700: 'float', 701: 'float', 1700: 'decimal',
+    1082: 'date', 1083: 'time', 1114: 'timestamp', 1184: 'timestamptz', 1186: 'duration', 2950: 'uuid',
+    114: 'json', 3802: 'json', 17: 'binary', 18: 'string', 19: 'string', 25: 'string', 1042: 'string',
+    1043: 'string',
+}
+
+# kinds of mysql columns by the field type mysql.connector gives as type_code
+MYSQL_KINDS = {
+    0: 'decimal', 246: 'decimal', 1: 'int', 2: 'int', 3: 'int', 8: 'int', 9: 'int', 13: 'int', 4: 'float',
+    5: 'float', 10: 'date', 14: 'date', 7: 'timestamp', 12: 'timestamp', 11: 'duration', 245: 'json',
+    15: 'string', 247: 'string',
+}
+# blob and text, varbinary and varchar, binary and char share a field type, only the binary charset tells them apart
+MYSQL_CHARSET_TYPES = (249, 250, 251, 252, 253, 254)
+MYSQL_BINARY_CHARSET = 63
+
+# scale of numeric columns declared without one, values with more decimals raise instead of being rounded
+UNCONSTRAINED_DECIMAL_SCALE = 18
+
+# python values that have an arrow type of their own, and so are never written into a string column
+TYPED_VALUES = (bool, int, float, Decimal, datetime, date, time, timedelta, uuid.UUID, bytes, bytearray, memoryview)
+
+
+def column_kind(description):
+    """
+    the kind of a column as declared in the database, from the type_code of the cursor description
+    :param description: tuple. DB-API description of the column
+    :return: string, or none if the driver or type is not known, for instance for records
+    """
+    type_code = description[1] if description is not None and len(description) > 1 else None
+    if not isinstance(type_code, int) or isinstance(type_code, bool):
+        return None
+    if type(description).__module__.startswith('psycopg2'):
+        return POSTGRES_KINDS.get(type_code)
+    # mysql.connector adds the flags and the charset number of the column as eighth and ninth item to the
+    # description. the binary flag is also set on text with a _bin collation, so it cannot tell blob from text
+    if len(description) >= 8:
+        if type_code in MYSQL_CHARSET_TYPES:
+            if len(description) < 9:
+                return None
+            return 'binary' if description[8] == MYSQL_BINARY_CHARSET else 'string'
+        return MYSQL_KINDS.get(type_code)
+    return None
+
+
+def value_kind(values):
+    """
+    the kind of a column guessed from its values, when the cursor does not tell
+    :param values: sequence. the values of one column
+    :return: string, or none if every value is none
+    """
+    sample = next((v for v in values if v is not None), None)
+
+    if sample is None:
+        return None
+    if isinstance(sample, bool):
+        return 'bool'
+    if isinstance(sample, int):
+        # a column of integers that also holds floats, as sqlite and json can, is a column of floats
+        return 'float' if any(isinstance(v, float) for v in values) else 'int'
+    if isinstance(sample, float):
+        return 'float'
+    if isinstance(sample, Decimal):
+        return 'decimal'
+    # datetime has to be checked before date, as it is a subclass of it
+    if isinstance(sample, datetime):
+        return 'timestamptz' if sample.tzinfo is not None else 'timestamp'
+    if isinstance(sample, date):
+        return 'date'
+    if isinstance(sample, time):
+        return 'time'
+    if isinstance(sample, timedelta):
+        return 'duration'
+    if isinstance(sample, uuid.UUID):
+        return 'uuid'
+    if isinstance(sample, (dict, list)):
+        return 'json'
+    if isinstance(sample, (bytes, bytearray, memoryview)):
+        return 'binary'
+    return 'string'
+
+
+def arrow_type(values, description=None):
+    """
+    maps a column to a native arrow type, from the type declared in the database where the cursor gives it
+    and from its python values otherwise. a column with only nones and no declared type is a string column
+    :param values: sequence. the values of one column
+    :param description: tuple. DB-API description of the column, used for its type, precision and scale
+    :return: pyarrow data type
+    """
+    kind = column_kind(description) or value_kind(values) or 'string'
+
+    if kind == 'decimal':
+        precision = description[4] if description is not None and len(description) > 5 else None
+        scale = description[5] if description is not None and len(description) > 5 else None
+        if isinstance(precision, int) and isinstance(scale, int) and 0 < precision <= 38 and 0 <= scale:
+            return pa.decimal128(precision, scale)
+        # unconstrained numeric, the scale has to hold the decimals of later row groups too
+        scale = max((-v.as_tuple().exponent for v in values if isinstance(v, Decimal) and v.is_finite()),
+                    default=0)
+        return pa.decimal128(38, min(max(scale, UNCONSTRAINED_DECIMAL_SCALE), 38))
+    if kind == 'timestamp':
+        return pa.timestamp('us')
+    if kind == 'timestamptz':
+        return pa.timestamp('us', tz='UTC')
+    if kind == 'uuid':
+        return pa.uuid() if hasattr(pa, 'uuid') else pa.binary(16)
+    if kind == 'json':
+        return pa.json_() if hasattr(pa, 'json_') else pa.string()
+    return {'bool': pa.bool_, 'int': pa.int64, 'float': pa.float64, 'date': pa.date32,
+            'time': lambda: pa.time64('us'), 'duration': lambda: pa.duration('us'), 'binary': pa.binary,
+            'string': pa.string}[kind]()
+
+
+def mismatch(values, data_type, accepted):
+    """
+    raises for the first value that is not of the type of its column, instead of letting arrow cast it
+    :param values: sequence. the values of one column
+    :param data_type: pyarrow data type of the column
+    :param accepted: type or tuple of types the values may have
+    :return: none
+    """
+    value = next((v for v in values if v is not None and not isinstance(v, accepted)), None)
+    if value is not None:
+        raise TypeError('value {!r} of type {} does not fit the {} type of its column, which is fixed by the '
+                        'first row group'.format(value, type(value).__name__, data_type))
+
+
+def arrow_array(values, data_type, json_column=False):
+    """
+    converts the python values of a column to an arrow array of the given type
+    :param values: sequence. the values of one column
+    :param data_type: pyarrow data type, as given by arrow_type
+    :param json_column: boolean. whether the column holds json, values that are not text yet are dumped
+    :return: pyarrow array
+    """
+    if json_column:
+        # json the driver already gives as text is kept as it is
+        values = [None if v is None else v if isinstance(v, str) else bytes(v).decode('UTF-8')
+                  if isinstance(v, (bytes, bytearray)) else json.dumps(v, default=json_serial) for v in values]
+    if isinstance(data_type, pa.BaseExtensionType):
+        return pa.ExtensionArray.from_storage(data_type, arrow_array(values, data_type.storage_type))
+    if pa.types.is_fixed_size_binary(data_type):
+        mismatch(values, data_type, uuid.UUID)
+        return pa.array([None if v is None else v.bytes for v in values], type=data_type)
+    if pa.types.is_binary(data_type):
+        mismatch(values, data_type, (bytes, bytearray, memoryview))
+        return pa.array([None if v is None else bytes(v) for v in values], type=data_type)
+    if pa.types.is_string(data_type):
+        mismatch([v for v in values if isinstance(v, TYPED_VALUES)], data_type, str)
+        return pa.array([None if v is None else v if isinstance(v, str) else
+                         json.dumps(v, default=json_serial) if isinstance(v, (dict, list)) else str(v)
+                         for v in values], type=data_type)
+    if pa.types.is_boolean(data_type):
+        mismatch(values, data_type, bool)
+    elif pa.types.is_integer(data_type):
+        mismatch(values, data_type, int)
+    elif pa.types.is_floating(data_type):
+        mismatch(values, data_type, (int, float))
+    elif pa.types.is_decimal(data_type):
+        mismatch(values, data_type, (int, Decimal))
+    return pa.array(values, type=data_type)
+
+
+class ParquetEncoder:
+    """
+    encodes batches of rows into parquet, rows are buffered until a full row group can be written
+    """
+
+    def __init__(self, sink, row_group_size, compression):
+        self.file = SinkFile(sink)
+        self.row_group_size = row_group_size
+        self.compression = compression
+        self.description = None
+        self.schema = None
+        self.json_columns = None
+        self.writer = None
+        self.rows = []
+
+    def write_batch(self, description, rows):
+        """
+        :param description: DB-API cursor description of the rows
+        :param rows: list of row tuples
+        :return: none
+        """
+        if self.description is None:
+            self.description = description
+        self.rows.extend(rows)
+
+        while len(self.rows) >= self.row_group_size:
+            self.write_row_group(self.rows[:self.row_group_size])
+            del self.rows[:self.row_group_size]
+
+    def write_records(self, records):
+        """
+        :param records: list of dicts, the keys of the first record decide the columns
+        :return: none
+        """
+        if self.description is None:
+            self.description = [(key,) for key in records[0]]
+        self.write_batch(self.description, [tuple(record.get(desc[0]) for desc in self.description)
+                                            for record in records])
+
+    def write_row_group(self, rows):
+        columns = list(zip(*rows))
+
+        if self.schema is None:
+            # the schema is fixed by the first row group written, values of later groups that do not fit it raise
+            self.schema = pa.schema([pa.field(desc[0], arrow_type(values, desc))
+                                     for desc, values in zip(self.description, columns)])
+            self.json_columns = [(column_kind(desc) or value_kind(values)) == 'json'
+                                 for desc, values in zip(self.description, columns)]
+            self.writer = pq.ParquetWriter(self.file, self.schema, compression=self.compression)
+
+        table = pa.Table.from_arrays([arrow_array(values, field.type, json_column)
+                                      for field, values, json_column in zip(self.schema, columns, self.json_columns)],
+                                     schema=self.schema)
+        self.writer.write_table(table, row_group_size=self.row_group_size)
+
+    def close(self):
+        if self.rows:
+            self.write_row_group(self.rows)
+            self.rows = []
+        if self.writer is not None:
+            self.writer.close()
+
+
+class ParquetFormat:
+    """
+    columnar parquet output with typed columns, requires pyarrow
+    """
+    extension = 'parquet'
+    content_type = 'application/vnd.apache.parquet'
+    content_encoding = None
+
+    def __init__(self, row_group_size=100000, compression='snappy'):
+        """
+        :param row_group_size: integer. rows per parquet row group, also the amount of rows buffered in memory
+        :param compression: string. parquet column compression, for instance snappy, gzip or zstd
+        """
+        if pa is None:
+            raise ImportError('pyarrow is required for parquet output, install it with pip install dbtos3[parquet]')
+
+        self.row_group_size = row_group_size
+        self.compression = compression
+
+    def open(self, sink):
+        """
+        :param sink: object with a write_chunk method, usually an S3MultipartWriter
+        :return: ParquetEncoder
+        """
+        return ParquetEncoder(sink=sink, row_group_size=self.row_group_size, compression=self.compression)
+
+
+class NdjsonEncoder:
+    """
+    encodes rows as newline delimited json, compressing each batch as it is written
+    """
+
+    def __init__(self, sink, compressor):
+        self.sink = sink
+        self.compressor = compressor
+
+    def write_lines(self, lines):
+        data = b''.join(lines)
+        if self.compressor is not None:
+            data = self.compressor.compress(data)
+        # compressors hold on to small inputs until they have a full block
+        if data:
+            self.sink.write_chunk(data)
+
+    def write_batch(self, description, rows):
+        """
+        :param description: DB-API cursor description of the rows
+        :param rows: list of row tuples
+        :return: none
+        """
+        self.write_lines(row + b'\n' for row in row_objects(description, rows))
+
+    def write_records(self, records):
+        """
+        :param records: list of dicts
+        :return: none
+        """
+        if orjson is not None:
+            self.write_lines(orjson_dumps(record) + b'\n' for record in records)
+        else:
+            self.write_lines((json.dumps(record, default=json_serial, allow_nan=True) + '\n').encode('UTF-8')
+                             for record in records)
+
+    def close(self):
+        if self.compressor is not None:
+            self.sink.write_chunk(self.compressor.flush())
+
+
+class NdjsonFormat:
+    """
+    newline delimited json, optionally compressed with gzip or zstd (zstd requires zstandard)
+    """
+    content_type = 'application/x-ndjson'
+
+    def __init__(self, codec='gzip', level=None):
+        """
+        :param codec: string. gzip, zstd or none for uncompressed output
+        :param level: integer. compression level, defaults to the codec's own default
+        """
+        check_codec(codec)
+
+        self.codec = codec
+        self.level = level
+        suffix, self.content_encoding = CODECS[codec]
+        self.extension = 'ndjson' + suffix
+
+    def open(self, sink):
+        """
+        :param sink: object with a write_chunk method, usually an S3MultipartWriter
+        :return: NdjsonEncoder
+        """
+        return NdjsonEncoder(sink=sink, compressor=compressor(codec=self.codec, level=self.level))
+
+
+class JsonEncoder:
+    """
+    encodes rows as a single json array of objects, a batch at a time, so the array is never held in memory whole
+    """
+
+    def __init__(self, sink):
+        self.sink = sink
+        self.empty = True
+
+    def write_objects(self, objects):
+        if objects:
+            self.sink.write_chunk((b'[' if self.empty else b',') + b','.join(objects))
+            self.empty = False
+
+    def write_batch(self, description, rows):
+        """
+        :param description: DB-API cursor description of the rows
+        :param rows: list of row tuples
+        :return: none
+        """
+        self.write_objects(row_objects(description, rows))
+
+    def write_records(self, records):
+        """
+        :param records: list of dicts
+        :return: none
+        """
+        if orjson is not None:
+            self.write_objects([orjson_dumps(record) for record in records])
+        else:
+            self.write_objects([json.dumps(record, default=json_serial, allow_nan=True).encode('UTF-8')
+                                for record in records])
+
+    def close(self):
+        # nothing is written without rows, so an empty load leaves no object behind
+        if not self.empty:
+            self.sink.write_chunk(b']')
+
+
+class JsonFormat:
+    """
+    one json array of row objects, the same objects write_to_s3 puts, streamed instead of encoded at once
+    """
+    extension = 'json'
+    content_type = 'application/json'
+    content_encoding = None
+
+    def open(self, sink):
+        """
+        :param sink: object with a write_chunk method, usually an S3MultipartWriter
+        :return: JsonEncoder
+        """
+        return JsonEncoder(sink=sink)
@@ -1,11 +1,15 @@
 import calendar
-import json
 import logging
 import os
+import threading
 import time
-from datetime import datetime, date
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, ALL_COMPLETED
+from datetime import datetime
 
-import boto3
+from dbtos3.metrics_model import metrics
+from dbtos3.pool_model import pools
+from dbtos3.s3_model import formats
+from dbtos3.scheduler_model.pipeline import Pipeline, PipelineStage
 
 try:
     os.mkdir('Logs')
@@ -19,13 +23,413 @@ logging.basicConfig(filename='Logs/logs-{}.log'.format(datetime.now().strftime('
                     filemode='w', datefmt='%d-%b-%y %H:%M:%S', level=logging.INFO)
 
 
+# s3 requires every part of a multipart upload, except the last, to be at least 5 MiB
+MIN_PART_SIZE = 5 * 1024 * 1024
+DEFAULT_PART_SIZE = 8 * 1024 * 1024
+
+# bytes written to one object of a batch writer before the next object is begun
+DEFAULT_BATCH_OBJECT_SIZE = 128 * 1024 * 1024
+
+
+class S3MultipartWriter:
+    """
+    streams bytes into a single s3 object using a multipart upload
+    chunks are buffered until a part is full, and full parts are uploaded in parallel on a thread pool.
+    the multipart upload is only created with the first full part, a smaller object is put in one request
+    """
+
+    def __init__(self, client, bucket, key, part_size=DEFAULT_PART_SIZE, max_workers=4, max_retries=3,
+                 retry_backoff=0.5, content_type='application/json', content_encoding=None):
+        """
+        :param client: boto3 s3 client. clients are thread safe, so parts can be uploaded concurrently
+        :param bucket: string. bucket to write to
+        :param key: string. key of the object that will be created on commit
+        :param part_size: integer. bytes per uploaded part, at least 5 MiB
+        :param max_workers: integer. amount of parts uploaded at the same time
+        :param max_retries: integer. attempts made per part before the upload is given up
+        :param retry_backoff: float. seconds waited before the first retry, doubled on every further retry
+        :param content_type: string. content type of the final object
+        :param content_encoding: string. content encoding of the final object, for instance gzip
+        """
+        if part_size < MIN_PART_SIZE:
+            raise ValueError('part_size must be at least {} bytes'.format(MIN_PART_SIZE))
+
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+
+        self.buffer = bytearray()
+        self.part_number = 0
+        self.parts = []
+        self.pending = set()
+        self.bytes_written = 0
+        self.retries = 0
+        # parts are uploaded on other threads, so the job is taken from the thread the writer is begun on
+        self.job = metrics.current_job()
+
+        self.extra_args = {'ContentType': content_type}
+        if content_encoding is not None:
+            self.extra_args['ContentEncoding'] = content_encoding
+
+        self.upload_id = None
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        # set once the writer is committed or aborted, so leaving a with block after commit does nothing
+        self.finished = False
+        self.written_key = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
+
+    def with_retries(self, description, request):
+        """
+        sends a request, retrying with an exponential backoff when it fails
+        :param description: string. what is sent, for the log
+        :param request: callable sending the request
+        :return: the response of the request
+        """
+        for attempt in range(1, self.max_retries + 1):
+            try:
+                with metrics.timer('upload', job=self.job):
+                    return request()
+
+            except Exception as error:
+                if attempt == self.max_retries:
+                    raise
+                self.retries += 1
+                metrics.record('retries', 1, job=self.job)
+                logging.info('[s3.service] retrying {} of {} after error: {} [{}]'
+                             .format(description, self.key, error, datetime.now()))
+                time.sleep(self.retry_backoff * 2 ** (attempt - 1))
+
+    def upload_part(self, part_number, body):
+        """
+        uploads a single part
+        :param part_number: integer. 1 based number of the part
+        :param body: bytes. content of the part
+        :return: dict of the part etag and number, as required to complete the upload
+        """
+        response = self.with_retries('part {}'.format(part_number), lambda: self.client.upload_part(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, PartNumber=part_number, Body=body))
+        return {'ETag': response['ETag'], 'PartNumber': part_number}
+
+    def collect_parts(self, return_when):
+        """
+        waits for pending part uploads and keeps the finished ones
+        :param return_when: concurrent.futures constant, either FIRST_COMPLETED or ALL_COMPLETED
+        :return: none
+        """
+        done, self.pending = wait(self.pending, return_when=return_when)
+        for future in done:
+            self.parts.append(future.result())
+
+    def submit_part(self, body):
+        """
+        hands a full part to the thread pool, waiting on earlier parts first when too many are in flight
+        so the amount of buffered parts stays bound
+        :param body: bytes. content of the part
+        :return: none
+        """
+        if self.upload_id is None:
+            self.upload_id = self.client.create_multipart_upload(Bucket=self.bucket, Key=self.key,
+                                                                 **self.extra_args)['UploadId']
+        if len(self.pending) >= self.max_workers * 2:
+            self.collect_parts(return_when=FIRST_COMPLETED)
+
+        self.part_number += 1
+        self.pending.add(self.executor.submit(self.upload_part, self.part_number, body))
+
+    def write_chunk(self, chunk):
+        """
+        adds a chunk to the object, uploading every part that is filled by it
+        :param chunk: bytes or string. the next piece of the object
+        :return: none
+        """
+        if isinstance(chunk, str):
+            chunk = chunk.encode('UTF-8')
+
+        self.buffer += chunk
+        self.bytes_written += len(chunk)
+        while len(self.buffer) >= self.part_size:
+            self.submit_part(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+
+    def commit(self):
+        """
+        uploads what is left in the buffer and completes the upload, committing again returns the same key
+        :return: the key of the written object, or none if nothing was written
+        """
+        if self.finished:
+            return self.written_key
+
+        try:
+            if self.upload_id is None:
+                self.written_key = self.put_buffer()
+                self.finished = True
+                return self.written_key
+
+            if self.buffer:
+                self.submit_part(bytes(self.buffer))
+                self.buffer = bytearray()
+
+            self.collect_parts(return_when=ALL_COMPLETED)
+
+            if not self.parts:
+                self.abort()
+                return None
+
+            with metrics.timer('upload', job=self.job):
+                self.client.complete_multipart_upload(
+                    Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                    MultipartUpload={'Parts': sorted(self.parts, key=lambda part: part['PartNumber'])})
+            self.executor.shutdown()
+            metrics.record('bytes', self.bytes_written, job=self.job)
+            metrics.record('objects', 1, job=self.job)
+            self.written_key = self.key
+            self.finished = True
+            return self.written_key
+
+        except Exception:
+            self.abort()
+            raise
+
+    def put_buffer(self):
+        """
+        puts an object smaller than a part in one request, there is no multipart upload to complete
+        :return: the key of the written object, or none if nothing was written
+        """
+        self.executor.shutdown()
+        if not self.buffer:
+            return None
+
+        body = bytes(self.buffer)
+        self.with_retries('object', lambda: self.client.put_object(Bucket=self.bucket, Key=self.key, Body=body,
+                                                                  **self.extra_args))
+        self.buffer = bytearray()
+        metrics.record('bytes', self.bytes_written, job=self.job)
+        metrics.record('objects', 1, job=self.job)
+        return self.key
+
+    def abort(self):
+        """
+        aborts the upload so s3 discards any parts that were already uploaded, a committed writer is left as it is
+        :return: none
+        """
+        if self.finished:
+            return
+        self.finished = True
+        self.executor.shutdown(cancel_futures=True)
+        if self.upload_id is not None:
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+
+
+class S3BatchWriter:
+    """
+    coalesces many small sets of records into a few objects of an output format, instead of one object each
+    records are streamed into a multipart upload, and the next object is begun once one holds max_object_size
+    bytes. the writer can be shared by several threads
+    """
+
+    def __init__(self, s3_service, local, output_format, max_object_size=DEFAULT_BATCH_OBJECT_SIZE, **kwargs):
+        """
+        :param s3_service: S3ServiceMethod the objects are written with
+        :param local: string. the directory the objects are written to, objects are numbered as parts
+        :param output_format: an output format from dbtos3.s3_model.formats, for instance NdjsonFormat('gzip')
+        :param max_object_size: integer. bytes per object, before compression is flushed
+        :param kwargs: passed on to S3MultipartWriter, for instance part_size or max_workers
+        """
+        self.s3_service = s3_service
+        self.local = local
+        self.output_format = output_format
+        self.max_object_size = max_object_size
+        self.kwargs = kwargs
+
+        self.lock = threading.Lock()
+        self.part = 0
+        self.writer = None
+        self.encoder = None
+        self.keys = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write_records(self, records):
+        """
+        adds records to the current object
+        :param records: list of dicts
+        :return: none
+        """
+        if not records:
+            return
+
+        with self.lock:
+            if self.writer is None:
+                self.writer = self.s3_service.begin_multipart_write(
+                    local=self.local, extension=self.output_format.extension, part=self.part,
+                    content_type=self.output_format.content_type,
+                    content_encoding=self.output_format.content_encoding, **self.kwargs)
+                self.encoder = self.output_format.open(self.writer)
+
+            with metrics.timer('encode'):
+                self.encoder.write_records(records)
+            if self.writer.bytes_written >= self.max_object_size:
+                self.finish_object()
+
+    def finish_object(self):
+        """
+        completes the current object, the caller holds the lock
+        :return: none
+        """
+        self.encoder.close()
+        key = self.writer.commit()
+        if key is not None:
+            self.keys.append(key)
+        self.writer = None
+        self.encoder = None
+        self.part += 1
+
+    def close(self):
+        """
+        completes the last object
+        :return: list of the keys of all written objects
+        """
+        with self.lock:
+            if self.writer is not None:
+                self.finish_object()
+        logging.info('[s3.service] batch writer of {} wrote {} objects [{}]'.format(self.local, len(self.keys),
+                                                                                   datetime.now()))
+        return self.keys
+
+    def abort(self):
+        """
+        discards the object being written, objects that were completed are kept
+        :return: none
+        """
+        with self.lock:
+            if self.writer is not None:
+                self.writer.abort()
+                self.writer = None
+                self.encoder = None
+
+
+class S3PartWriter:
+    """
+    writes a load as many small objects, encoding and uploading them on worker threads while the caller
+    reads the next rows or pages. keys are given out in the order objects are submitted, and bounded queues
+    hold up the caller once queue_size objects wait to be encoded or uploaded
+    """
+
+    def __init__(self, s3_service, output_format=None, queue_size=2, encode_workers=1, upload_workers=2):
+        """
+        :param s3_service: S3ServiceMethod the objects are written with
+        :param output_format: an output format from dbtos3.s3_model.formats, for instance NdjsonFormat('gzip').
+        if not given every object is one json array
+        :param queue_size: integer. objects waiting in front of the encoders and in front of the uploaders
+        :param encode_workers: integer. objects encoded at the same time
+        :param upload_workers: integer. objects uploaded at the same time
+        """
+        self.s3_service = s3_service
+        self.output_format = output_format
+        self.extension = 'json' if output_format is None else output_format.extension
+        self.pipeline = Pipeline([PipelineStage('encode', self.encode, encode_workers),
+                                  PipelineStage('upload', self.upload, upload_workers)], queue_size=queue_size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def encode(self, item):
+        key, description, rows, records = item
+        return key, self.s3_service.encode_body(description=description, rows=rows, records=records,
+                                                output_format=self.output_format)
+
+    def upload(self, item):
+        key, body = item
+        self.s3_service.put_key(key=key, body=body, **self.s3_service.object_args(self.output_format))
+        return key
+
+    def write_rows(self, local, description, rows, part=None):
+        """
+        :param local: string. the table that is being replicated or loaded in order to name the directory accordingly
+        :param description: DB-API cursor description of the rows
+        :param rows: list of row tuples
+        :param part: int or tuple of ints. optional part number of the object
+        :return: none
+        """
+        if rows:
+            key = self.s3_service.object_key(local=local, extension=self.extension, part=part)
+            self.pipeline.put((key, description, rows, None))
+
+    def write_records(self, local, records, part=None):
+        """
+        :param local: string. the table that is being replicated or loaded in order to name the directory accordingly
+        :param records: list of dicts
+        :param part: int or tuple of ints. optional part number of the object
+        :return: none
+        """
+        if records:
+            key = self.s3_service.object_key(local=local, extension=self.extension, part=part)
+            self.pipeline.put((key, None, None, records))
+
+    def write_specific(self, folder, file, records, part=None):
+        """
+        :param folder: the specific folder stored in the main key
+        :param file: the unique name of the file stored
+        :param records: list of dicts
+        :param part: int. optional part number of the object
+        :return: none
+        """
+        if records:
+            key = self.s3_service.specific_key(folder=folder, file=file, extension=self.extension, part=part)
+            self.pipeline.put((key, None, None, records))
+
+    def close(self):
+        """
+        waits until every object is uploaded, raising the first error of an encoder or uploader
+        :return: list of the keys of all written objects
+        """
+        keys = self.pipeline.close()
+        logging.info('[s3.service] part writer wrote {} objects [{}]'.format(len(keys), datetime.now()))
+        return keys
+
+    def abort(self):
+        """
+        drops the objects that were not uploaded yet, objects that were uploaded are kept
+        :return: none
+        """
+        self.pipeline.abort()
+
+
 class S3ServiceMethod:
     """
     PostgreSQL_Model replication methods
     """
 
     def __init__(self, region_name, aws_access_key_id, aws_secret_access_key, s3bucket,
-                 main_key):
+                 main_key, raise_errors=False):
+
+        # errors are logged and swallowed by default, raise_errors passes them on to the caller
+        self.raise_errors = raise_errors
 
         self.region_name = region_name
         self.aws_access_key_id = aws_access_key_id
@@ -34,17 +438,149 @@ class S3ServiceMethod:
         self.s3bucket = s3bucket
         self.s3main_key = main_key
 
-        self.s3resource = boto3.resource('s3',
-                                         region_name=region_name,
-                                         aws_access_key_id=aws_access_key_id,
-                                         aws_secret_access_key=aws_secret_access_key)
+        # one thread safe client per set of credentials is shared by every service of the process
+        self.s3client = pools.registry.s3_client(region_name=region_name, aws_access_key_id=aws_access_key_id,
+                                                 aws_secret_access_key=aws_secret_access_key)
+
+    def object_key(self, local, extension='json', part=None):
+        """
+        builds the key of an object written for a table, main_key/local/local-timestamp[-part].extension
+        :param local: string. the table that is being replicated or loaded in order to name the directory accordingly
+        :param extension: string. file extension of the object
+        :param part: int or tuple of ints. optional part number, used when one load is written as several objects
+        :return: string
+        """
+        parts = () if part is None else part if isinstance(part, tuple) else (part,)
+        return '{1}/{0}/{0}-{2}{3}.{4}'.format(local, self.s3main_key, calendar.timegm(time.gmtime()),
+                                              ''.join('-{:05d}'.format(p) for p in parts), extension)
+
+    def specific_key(self, folder, file, extension='json', part=None):
+        """
+        builds the key of an object written to a specific folder, main_key/folder/file-timestamp[-part].extension
+        :param folder: the specific folder stored in the main key
+        :param file: the unique name of the file stored
+        :param extension: string. file extension of the object
+        :param part: int. optional part number, used when one load is written as several objects
+        :return: string
+        """
+        return '{0}/{1}/{2}-{3}{4}.{5}'.format(self.s3main_key, folder, file, calendar.timegm(time.gmtime()),
+                                               '' if part is None else '-{:05d}'.format(part), extension)
+
+    def begin_multipart_write(self, local, extension='json', part=None, **kwargs):
+        """
+        begins a streamed write of a single object, chunks are added with write_chunk
+        and the object only appears in the bucket once commit is called
+
+        :param local: string. the table that is being replicated or loaded in order to name the directory accordingly
+        :param extension: string. file extension of the object
+        :param part: int. optional part number, used when one load is written as several objects
+        :param kwargs: passed on to S3MultipartWriter, for instance part_size, max_workers or content_encoding
+        :return: S3MultipartWriter
+        """
+        key = self.object_key(local=local, extension=extension, part=part)
+        logging.info('[s3.service] beginning multipart write of {} to s3 [{}]'.format(key, datetime.now()))
+        return S3MultipartWriter(client=self.s3client, bucket=self.s3bucket, key=key, **kwargs)
+
+    def write_batches_to_s3(self, local, batches, output_format, part=None, queue_size=2, **kwargs):
+        """
+        streams batches of rows into a single object encoded with the given output format. batches are
+        encoded on a thread of their own while the next one is fetched, and full parts are uploaded in the
+        background, so at most queue_size batches wait to be encoded
+
+        :param local: string. the table that is being replicated or loaded in order to name the directory accordingly
+        :param batches: iterable of (DB-API cursor description, list of row tuples)
+        :param output_format: an output format from dbtos3.s3_model.formats, for instance ParquetFormat()
+        :param part: int. optional part number, used when one load is written as several objects
+        :param queue_size: integer. fetched batches waiting to be encoded before the fetch is held up
+        :param kwargs: passed on to S3MultipartWriter, for instance part_size or max_workers
+        :return: the key of the written object, or none if there were no rows
+        """
+        logging.info('[s3.service] writing batches of table {} to s3 as {} [{}]'.format(local, output_format.extension,
+                                                                                       datetime.now()))
+        writer = self.begin_multipart_write(local=local, extension=output_format.extension, part=part,
+                                            content_type=output_format.content_type,
+                                            content_encoding=output_format.content_encoding, **kwargs)
+        try:
+            encoder = output_format.open(writer)
+
+            def encode(batch):
+                with metrics.timer('encode'):
+                    encoder.write_batch(*batch)
+
+            # one encoder thread keeps the batches in order within the object
+            with Pipeline([PipelineStage('encode', encode, 1)], queue_size=queue_size) as pipeline:
+                for batch in batches:
+                    pipeline.put(batch)
+            with metrics.timer('encode'):
+                encoder.close()
+
+        except Exception:
+            writer.abort()
+            raise
+
+        key = writer.commit()
+        logging.info('[s3.service] loading batches of {} to s3 done! [{}]'.format(local, datetime.now()))
+        return key
+
+    @staticmethod
+    def object_args(output_format):
+        """
+        :param output_format: an output format from dbtos3.s3_model.formats, or none for a json array
+        :return: dict of the put arguments describing an object of the format
+        """
+        if output_format is None:
+            return {}
+        extra_args = {'ContentType': output_format.content_type}
+        if output_format.content_encoding is not None:
+            extra_args['ContentEncoding'] = output_format.content_encoding
+        return extra_args
+
+    @staticmethod
+    def encode_body(description=None, rows=None, records=None, output_format=None):
+        """
+        encodes either rows with their cursor description or records into the body of a single object
+        :param description: DB-API cursor description of the rows
+        :param rows: list of row tuples
+        :param records: list of dicts, when there are no rows
+        :param output_format: an output format from dbtos3.s3_model.formats, for instance NdjsonFormat('gzip').
+        if not given the rows or records are encoded as one json array
+        :return: bytes
+        """
+        with metrics.timer('encode'):
+            if output_format is None:
+                return formats.encode_records(records) if rows is None else formats.encode_rows(description, rows)
+
+            sink = formats.BufferSink()
+            encoder = output_format.open(sink)
+            if rows is None:
+                encoder.write_records(records)
+            else:
+                encoder.write_batch(description, rows)
+            encoder.close()
+            return bytes(sink.buffer)
 
-    def write_to_s3(self, local, data):
+    def put_key(self, key, body, **kwargs):
+        """
+        puts a single object, recording its upload time and size in the metrics of the current job
+        :param key: string. key of the object
+        :param body: bytes. content of the object
+        :param kwargs: passed on to put_object, for instance ContentType
+        :return: none
+        """
+        with metrics.timer('upload'):
+            self.s3client.put_object(Bucket=self.s3bucket, Key=key, Body=body, **kwargs)
+        metrics.record('bytes', len(body))
+        metrics.record('objects', 1)
+
+    def write_to_s3(self, local, data, part=None, output_format=None):
         """
         gathers data frame object and parses it to s3 .json object
 
         :param local: string. the table that is being replicated or loaded in order to name the directory accordingly
         :param data: json object. the json object to be parsed into and s3 object
+        :param part: int. optional part number, used when one load is written as several batched objects
+        :param output_format: an output format from dbtos3.s3_model.formats, for instance NdjsonFormat('gzip').
+        if not given the data is written as one json array
         :return: writes object directly to s3
         """
         try:
@@ -52,31 +588,62 @@ class S3ServiceMethod:
             if len(data) < 1:
                 logging.info('[s3.service] no data in {} needs to be sent to s3 [{}]'.format(local, datetime.now()))
             else:
-                def json_serial(obj):
-                    """JSON serializer for objects not serializable by default json code"""
-                    if isinstance(obj, (datetime, date)):
-                        return obj.isoformat()
-                    raise TypeError("Type %s not serializable" % type(obj))
-
-                s3_object = self.s3resource.Object(self.s3bucket, '{1}/{0}/{0}-{2}.json'
-                                                   .format(local, self.s3main_key, calendar.timegm(time.gmtime())))
-                s3_object.put(Body=(bytes(json.dumps(data, default=json_serial, allow_nan=True)
-                                          .encode('UTF-8'))))
+                key = self.object_key(local=local, part=part,
+                                      extension='json' if output_format is None else output_format.extension)
+                self.put_key(key=key, body=self.encode_body(records=data, output_format=output_format),
+                             **self.object_args(output_format))
 
         except Exception as error:
             logging.info('[s3.service] error while trying to send {} data to s3: {} [{}]'
                          .format(local, error, datetime.now()))
+            if self.raise_errors:
+                raise
 
         finally:
             logging.info('[s3.service] loading data from {} to s3 done! [{}]'.format(local, datetime.now()))
 
-    def specific_write_to_s3(self, folder, file, data):
+    def write_rows_to_s3(self, local, description, rows, part=None, output_format=None):
+        """
+        writes rows as they come from a cursor to a single s3 object, without turning them into dicts first
+
+        :param local: string. the table that is being replicated or loaded in order to name the directory accordingly
+        :param description: DB-API cursor description of the rows
+        :param rows: list of row tuples
+        :param part: int or tuple of ints. optional part number, used when one load is written as several objects
+        :param output_format: an output format from dbtos3.s3_model.formats, for instance NdjsonFormat('gzip').
+        if not given the rows are written as one json array of objects
+        :return: writes object directly to s3
+        """
+        try:
+            logging.info('[s3.service] writing rows of table {} to s3 [{}]'.format(local, datetime.now()))
+            if len(rows) < 1:
+                logging.info('[s3.service] no data in {} needs to be sent to s3 [{}]'.format(local, datetime.now()))
+                return
+
+            extension = 'json' if output_format is None else output_format.extension
+            key = self.object_key(local=local, extension=extension, part=part)
+            body = self.encode_body(description=description, rows=rows, output_format=output_format)
+            self.put_key(key=key, body=body, **self.object_args(output_format))
+
+        except Exception as error:
+            logging.info('[s3.service] error while trying to send {} data to s3: {} [{}]'
+                         .format(local, error, datetime.now()))
+            if self.raise_errors:
+                raise
+
+        finally:
+            logging.info('[s3.service] loading rows from {} to s3 done! [{}]'.format(local, datetime.now()))
+
+    def specific_write_to_s3(self, folder, file, data, output_format=None, part=None):
         """
         gathers data frame object and parses it to s3 .json object and writes to a SPECIFIC folder
 
         :param folder: the specific folder stored in the main key
         :param file: the unique name of the file stored
         :param data: json object. the json object to be parsed into and s3 object
+        :param output_format: an output format from dbtos3.s3_model.formats, for instance NdjsonFormat('gzip').
+        if not given the data is written as one json array
+        :param part: int. optional part number, used when one load is written as several objects
         :return: writes object directly to s3
         """
         try:
@@ -84,22 +651,16 @@ class S3ServiceMethod:
             if len(data) < 1:
                 logging.info('[s3.service] no data in {} needs to be sent to s3 [{}]'.format(file, datetime.now()))
             else:
-                def json_serial(obj):
-                    """JSON serializer for objects not serializable by default json code"""
-                    if isinstance(obj, (datetime, date)):
-                        return obj.isoformat()
-                    raise TypeError("Type %s not serializable" % type(obj))
-
-                # folder/file-date
-                s3_object = self.s3resource \
-                    .Object(self.s3bucket, '{0}/{1}/{2}-{3}.json'
-                            .format(self.s3main_key, folder, file, calendar.timegm(time.gmtime())))
-                s3_object.put(Body=(bytes(json.dumps(data, default=json_serial, allow_nan=True)
-                                          .encode('UTF-8'))))
+                key = self.specific_key(folder=folder, file=file, part=part,
+                                        extension='json' if output_format is None else output_format.extension)
+                self.put_key(key=key, body=self.encode_body(records=data, output_format=output_format),
+                             **self.object_args(output_format))
 
         except Exception as error:
             logging.info(
                 '[s3.service] error while trying to send {} data to s3: {} [{}]'.format(file, error, datetime.now()))
+            if self.raise_errors:
+                raise
 
         finally:
             logging.info('[s3.service] loading data from {} to s3 done! [{}]'.format(file, datetime.now()))
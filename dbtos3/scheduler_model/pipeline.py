@@ -0,0 +1,136 @@
+"""
+Overlaps the stages of a load, so the database or api is read while earlier batches are encoded and uploaded.
+
+The caller extracts and puts every item into the pipeline, each stage runs on its own worker threads
+and hands what it returns on to the next stage through a bounded queue. A full queue blocks the stage
+before it, so at most queue_size items wait between two stages however far ahead the extraction is:
+
+with Pipeline([PipelineStage('encode', encode, 1), PipelineStage('upload', upload, 2)]) as pipeline:
+    for batch in batches:
+        pipeline.put(batch)
+
+The first error of any stage stops the pipeline, put raises it to the caller, as does close.
+"""
+import logging
+import queue
+import threading
+from collections import namedtuple
+from datetime import datetime
+
+from dbtos3.metrics_model import metrics
+
+PipelineStage = namedtuple('PipelineStage', ['name', 'function', 'workers'])
+
+# put into the queue of a stage once per worker, after the last item
+STOP = object()
+
+
+class Pipeline:
+    """
+    stages on worker threads joined by bounded queues, the results of the last stage are kept in results
+    """
+
+    def __init__(self, stages, queue_size=2):
+        """
+        :param stages: list of PipelineStage, every function takes the result of the stage before it
+        :param queue_size: integer. items waiting in front of a stage before the stage before it is held up
+        """
+        self.stages = stages
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+        self.results = []
+        self.errors = []
+        self.failed = threading.Event()
+        self.lock = threading.Lock()
+        self.running = [stage.workers for stage in stages]
+        self.closed = False
+
+        # stage functions record their metrics for the job that runs the pipeline
+        self.threads = [threading.Thread(target=self.work, args=(index, metrics.bind(stage.function)), daemon=True,
+                                         name='dbtos3-{}-{}'.format(stage.name, worker))
+                        for index, stage in enumerate(stages) for worker in range(stage.workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def work(self, index, function):
+        """
+        runs items of a stage until it is stopped, after a failure items are only taken off the queue
+        so the stages before it are never blocked
+        :param index: integer. index of the stage
+        :param function: the function of the stage
+        :return: none
+        """
+        while True:
+            item = self.queues[index].get()
+            if item is STOP:
+                break
+            if self.failed.is_set():
+                continue
+
+            try:
+                result = function(item)
+                if index + 1 < len(self.stages):
+                    self.queues[index + 1].put(result)
+                else:
+                    with self.lock:
+                        self.results.append(result)
+
+            except Exception as error:
+                logging.info('[scheduler.pipeline] {} stage failed: {} [{}]'.format(self.stages[index].name, error,
+                                                                                  datetime.now()))
+                with self.lock:
+                    self.errors.append(error)
+                self.failed.set()
+
+        # the last worker of a stage to stop stops the next stage
+        with self.lock:
+            self.running[index] -= 1
+            last = self.running[index] == 0
+        if last and index + 1 < len(self.stages):
+            for _ in range(self.stages[index + 1].workers):
+                self.queues[index + 1].put(STOP)
+
+    def put(self, item):
+        """
+        hands an item to the first stage, waiting while its queue is full
+        :param item: the input of the first stage
+        :return: none, raises the error of a stage once the pipeline has failed
+        """
+        if self.failed.is_set():
+            self.abort()
+            raise self.errors[0]
+        self.queues[0].put(item)
+
+    def stop(self):
+        if not self.closed:
+            self.closed = True
+            for _ in range(self.stages[0].workers):
+                self.queues[0].put(STOP)
+            for thread in self.threads:
+                thread.join()
+
+    def close(self):
+        """
+        waits until every item has passed all stages
+        :return: list of the results of the last stage, in the order they were finished
+        """
+        self.stop()
+        if self.errors:
+            raise self.errors[0]
+        return self.results
+
+    def abort(self):
+        """
+        stops the pipeline, the items that are left are dropped
+        :return: none
+        """
+        self.failed.set()
+        self.stop()
@@ -0,0 +1,259 @@
+"""
+Runs table jobs of one or more sources concurrently.
+
+A source is a factory that builds a model, for instance a functools.partial of
+ReplicationMethodsPostgreSQL with its connection settings. A job borrows an idle model of its
+source, or builds one if every model is in use, and gives it back once it is done. As no more
+than limit jobs of a source run at once, no more than limit models, and so database connections,
+of a source exist. They are closed once the run is done, in worker processes after every job.
+A job calls one method of a source's model:
+
+runner = JobRunner(max_workers=8)
+runner.add_source('website-db', partial(ReplicationMethodsPostgreSQL, ...), limit=4)
+runner.add_job('website-db', 'replicate_table', table='users', column='updated_at')
+summary = runner.run()
+
+The timings and throughput of every job are kept in dbtos3.metrics_model.metrics.registry, also for jobs
+run in worker processes, whose metrics are handed back to the runner with their results.
+"""
+import logging
+import threading
+from collections import namedtuple, deque, defaultdict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime
+
+from dbtos3.metrics_model import metrics
+
+TableJob = namedtuple('TableJob', ['runner_id', 'source', 'factory', 'method', 'kwargs'])
+
+JobResult = namedtuple('JobResult', ['source', 'method', 'name', 'succeeded', 'error', 'started', 'finished'])
+
+# models built for jobs of this process per (runner id, source), and the ones not in use by a job
+worker_models = defaultdict(list)
+idle_models = defaultdict(list)
+worker_models_lock = threading.Lock()
+
+
+def borrow_model(job):
+    """
+    returns an idle model of a job's source, building one if every model of the source is in use
+    :param job: TableJob
+    :return: model instance, to be given back with give_back_model
+    """
+    key = (job.runner_id, job.source)
+    with worker_models_lock:
+        if idle_models[key]:
+            return idle_models[key].pop()
+
+    model = job.factory()
+    # the runner reports failures itself, so the model has to pass them on instead of swallowing them
+    model.raise_errors = True
+    if hasattr(model, 's3_service'):
+        model.s3_service.raise_errors = True
+
+    with worker_models_lock:
+        worker_models[key].append(model)
+    return model
+
+
+def give_back_model(job, model):
+    """
+    keeps a model for the next job of its source
+    :param job: TableJob
+    :param model: model instance returned by borrow_model
+    :return: none
+    """
+    with worker_models_lock:
+        idle_models[(job.runner_id, job.source)].append(model)
+
+
+def job_name(job):
+    """
+    :param job: TableJob
+    :return: string. the table or project of a job, or its method if it has neither
+    """
+    return job.kwargs.get('table', job.kwargs.get('project', job.method))
+
+
+def run_job(job):
+    """
+    runs a single job on a model of its source, any error is captured in the result
+    :param job: TableJob
+    :return: JobResult
+    """
+    name = job_name(job)
+    started = datetime.now()
+    model = None
+    try:
+        model = borrow_model(job)
+        getattr(model, job.method)(**job.kwargs)
+        return JobResult(job.source, job.method, name, True, None, started, datetime.now())
+
+    except Exception as error:
+        logging.info('[scheduler.runner] job {} of {} failed: {} [{}]'.format(name, job.source, error, datetime.now()))
+        return JobResult(job.source, job.method, name, False, repr(error), started, datetime.now())
+
+    finally:
+        if model is not None:
+            give_back_model(job, model)
+
+
+def run_process_job(job):
+    """
+    runs a single job in a worker process, a process runs one job at a time so what it recorded
+    since its last job belongs to this one. the model of the job is closed afterwards, a model kept
+    by every process would let a source have more connections than its limit
+    :param job: TableJob
+    :return: tuple of (JobResult, metrics snapshot of the job)
+    """
+    try:
+        return run_job(job), metrics.registry.drain()
+    finally:
+        close_worker_models(job.runner_id)
+
+
+def close_worker_models(runner_id):
+    """
+    closes the connections of every model built for a runner in this process
+    :param runner_id: integer. id of the runner
+    :return: none
+    """
+    with worker_models_lock:
+        keys = [key for key in worker_models if key[0] == runner_id]
+        models = [model for key in keys for model in worker_models.pop(key)]
+        for key in keys:
+            idle_models.pop(key, None)
+
+    for model in models:
+        if hasattr(model, 'close_connection'):
+            try:
+                model.close_connection()
+            except Exception as error:
+                logging.info('[scheduler.runner] error while closing connection: {} [{}]'.format(error,
+                                                                                                 datetime.now()))
+
+
+class RunSummary:
+    """
+    aggregated results of a run
+    """
+
+    def __init__(self, results, started, finished):
+        self.results = results
+        self.started = started
+        self.finished = finished
+
+    @property
+    def succeeded(self):
+        return [result for result in self.results if result.succeeded]
+
+    @property
+    def failed(self):
+        return [result for result in self.results if not result.succeeded]
+
+    def by_source(self):
+        """
+        :return: dict of source name to (succeeded, failed) job counts
+        """
+        counts = defaultdict(lambda: [0, 0])
+        for result in self.results:
+            counts[result.source][0 if result.succeeded else 1] += 1
+        return {source: tuple(count) for source, count in counts.items()}
+
+    def __str__(self):
+        lines = ['{} jobs, {} succeeded, {} failed in {}'.format(len(self.results), len(self.succeeded),
+                                                                 len(self.failed), self.finished - self.started)]
+        for source, (succeeded, failed) in sorted(self.by_source().items()):
+            lines.append('  {}: {} succeeded, {} failed'.format(source, succeeded, failed))
+        for result in self.failed:
+            lines.append('  failed {}.{} {}: {}'.format(result.source, result.method, result.name, result.error))
+        return '\n'.join(lines)
+
+
+class JobRunner:
+    """
+    runs table jobs concurrently on a thread or process pool, with a concurrency limit per source
+    """
+
+    def __init__(self, max_workers=4, use_processes=False):
+        """
+        :param max_workers: integer. amount of jobs that run at the same time over all sources
+        :param use_processes: boolean. run jobs in worker processes instead of threads,
+        source factories then have to be picklable, for instance a functools.partial of a model class
+        """
+        self.max_workers = max_workers
+        self.use_processes = use_processes
+        self.sources = {}
+        self.limits = {}
+        self.jobs = []
+
+    def add_source(self, name, factory, limit=None):
+        """
+        :param name: string. name of the source, used in job results
+        :param factory: callable that builds a model of the source, called when every model of it is in use
+        :param limit: integer. amount of jobs of this source that may run at the same time,
+        and so the amount of models and connections of it that exist at once. defaults to max_workers
+        :return: none
+        """
+        self.sources[name] = factory
+        self.limits[name] = limit or self.max_workers
+
+    def add_job(self, source, method, **kwargs):
+        """
+        :param source: string. name of a source added with add_source
+        :param method: string. the model method to call, for instance replicate_table
+        :param kwargs: arguments of the method, for instance table='users', column='updated_at'
+        :return: none
+        """
+        if source not in self.sources:
+            raise KeyError('unknown source {}, add it with add_source first'.format(source))
+        self.jobs.append(TableJob(id(self), source, self.sources[source], method, kwargs))
+
+    def run(self):
+        """
+        runs all added jobs and clears them from the runner
+        :return: RunSummary
+        """
+        logging.info('[scheduler.runner] running {} jobs on {} workers [{}]'.format(len(self.jobs), self.max_workers,
+                                                                                   datetime.now()))
+        started = datetime.now()
+        pending = deque(self.jobs)
+        self.jobs = []
+        running = {}
+        active = defaultdict(int)
+        results = []
+
+        executor_class = ProcessPoolExecutor if self.use_processes else ThreadPoolExecutor
+        with executor_class(max_workers=self.max_workers) as executor:
+            while pending or running:
+                # jobs are only handed to the pool while their source is below its limit
+                for job in list(pending):
+                    if len(running) >= self.max_workers:
+                        break
+                    if active[job.source] < self.limits[job.source]:
+                        pending.remove(job)
+                        active[job.source] += 1
+                        running[executor.submit(run_process_job if self.use_processes else run_job, job)] = job
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    job = running.pop(future)
+                    active[job.source] -= 1
+                    try:
+                        if self.use_processes:
+                            result, job_metrics = future.result()
+                            metrics.registry.merge(job_metrics)
+                        else:
+                            result = future.result()
+                        results.append(result)
+                    except Exception as error:
+                        # only raised when the job could not reach a worker, for instance an unpicklable factory
+                        results.append(JobResult(job.source, job.method, job_name(job), False, repr(error), None,
+                                                 datetime.now()))
+
+        if not self.use_processes:
+            close_worker_models(id(self))
+
+        summary = RunSummary(results=results, started=started, finished=datetime.now())
+        logging.info('[scheduler.runner] run complete: {} [{}]'.format(summary, datetime.now()))
+        return summary
@@ -1,11 +1,14 @@
 import logging
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
-import pandas as pd
 import requests
 
-from dbtos3.s3_model import service
+from dbtos3.metrics_model import metrics
+from dbtos3.s3_model import formats, service
 from dbtos3.sqlite_model import catalogue
 
 try:
@@ -44,6 +47,51 @@ raw structure per project
 """
 
 
+class SentryRateLimiter:
+    """
+    paces the requests of every thread of a client by sentry's rate limit headers, requests are spread
+    over what is left of the current window, and everyone waits once sentry answers 429
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # time the next request may be sent, and the seconds between requests
+        self.next_request = 0.0
+        self.interval = 0.0
+
+    def wait(self):
+        """
+        takes the next free request slot and blocks until it is due
+        :return: none
+        """
+        with self.lock:
+            now = time.time()
+            slot = max(self.next_request, now)
+            self.next_request = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+    def update(self, response):
+        """
+        adapts the pace to the headers of a response
+        :param response: requests response
+        :return: none
+        """
+        now = time.time()
+        headers = response.headers
+        remaining = headers.get('X-Sentry-Rate-Limit-Remaining')
+        reset = headers.get('X-Sentry-Rate-Limit-Reset')
+
+        with self.lock:
+            if response.status_code == 429:
+                retry_after = headers.get('Retry-After')
+                pause = float(retry_after) if retry_after is not None else float(reset) - now if reset else 1.0
+                self.next_request = max(self.next_request, now + pause)
+            elif remaining is not None and reset is not None:
+                # the requests left are spread evenly until the window resets
+                self.interval = max(float(reset) - now, 0.0) / max(int(remaining), 1)
+
+
 class GetSentryEventsData:
     def __init__(self, **kwargs):
         """
@@ -54,26 +102,113 @@ class GetSentryEventsData:
         project=your specific project
         event_id=specific event id
         issue_id=specific issue id
+        pool_size=amount of connections kept alive to sentry, defaults to 10
+        max_retries=attempts made per request when sentry answers 429 or a server error, defaults to 5
         """
         self.header = {
             'Authorization': 'Bearer {}'.format(kwargs['auth_token'])
         }
 
-    def list_a_projects_issues(self, organization, project, period):
+        # every call goes through one session, so connections to sentry are kept alive and reused
+        # instead of paying a new tcp and tls handshake per request
+        self.session = requests.Session()
+        self.session.headers.update(self.header)
+        self.session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=1,
+                                                                     pool_maxsize=kwargs.get('pool_size', 10)))
+
+        # shared by all threads using this client, so together they stay within sentry's rate limit
+        self.rate_limiter = SentryRateLimiter()
+        self.max_retries = kwargs.get('max_retries', 5)
+
+    def get(self, url):
         """
-        Return a list of issues (groups) bound to a project.
+        gets a url within sentry's rate limit, retrying with a backoff when it answers 429 or a server error
+        :param url: string. the url to get
+        :return: requests response
+        """
+        for attempt in range(1, self.max_retries + 1):
+            self.rate_limiter.wait()
+            logging.info('[sentry.api] called : {} [{}]'.format(url, datetime.now()))
+            with metrics.timer('request'):
+                response = self.session.get(url)
+            self.rate_limiter.update(response)
+
+            if response.status_code != 429 and response.status_code < 500:
+                break
+            if attempt < self.max_retries:
+                metrics.record('retries', 1)
+                logging.info('[sentry.api] {} answered {}, retrying [{}]'.format(url, response.status_code,
+                                                                                datetime.now()))
+                # a 429 holds back the rate limiter, server errors back off exponentially
+                if response.status_code >= 500:
+                    time.sleep(2 ** (attempt - 1))
+
+        response.raise_for_status()
+        return response
+
+    def pages(self, url):
+        """
+        follows the cursors in sentry's link header and yields one page of results at a time,
+        so the next page is only requested once the previous one has been used
+        :param url: string. the first page
+        :return: generator of json lists
+        """
+        while url is not None:
+            response = self.get(url)
+            yield response.json()
+
+            # sentry always sends a next link, results tells whether there is anything behind it
+            next_link = response.links.get('next', {})
+            url = next_link.get('url') if next_link.get('results') == 'true' else None
+
+    def iter_a_projects_issues(self, organization, project, period):
+        """
+        Yields the pages of issues (groups) bound to a project.
         :param organization: string. organization name
         :param project: string. project name
         :param period: 0 = 24 hour, 1 = 14 days
-        :return: json
+        :return: generator of json lists
         """
 
         # https://sentry.io/api/0/projects/howler/core-web/issues/?statsPeriod=24d
         url = 'https://sentry.io/api/0/projects/{0}/{1}/issues/?statsPeriod={2}'.format(
-            organization, project, '14d' if period is 1 else '24h'
+            organization, project, '14d' if period == 1 else '24h'
         )
-        logging.info('[sentry.api] called : {} [{}]'.format(url, datetime.now()))
-        return requests.get(url, headers=self.header).json()
+        return self.pages(url)
+
+    def iter_a_projects_events(self, organization, project, period):
+        """
+        Yields the pages of events bound to a project.
+        :param organization: string. organization name
+        :param project: string. project name
+        :param period: 0 = 24 hour, 1 = 14 days
+        :return: generator of json lists
+        """
+        url = 'https://sentry.io/api/0/projects/{0}/{1}/events/?statsPeriod={2}'.format(
+            organization, project, '14d' if period == 1 else '24h'
+        )
+        return self.pages(url)
+
+    def iter_an_issues_events(self, issue_id):
+        """
+        Yields the pages of an issue’s events.
+        :param issue_id: int. sentry unique id allocated to an issue
+        :return: generator of json lists
+        """
+        url = 'https://sentry.io/api/0/issues/{}/events/'.format(
+            issue_id
+        )
+        return self.pages(url)
+
+    def list_a_projects_issues(self, organization, project, period):
+        """
+        Return a list of issues (groups) bound to a project.
+        :param organization: string. organization name
+        :param project: string. project name
+        :param period: 0 = 24 hour, 1 = 14 days
+        :return: json
+        """
+        return [issue for page in self.iter_a_projects_issues(organization, project, period) for issue in page]
 
     def list_a_projects_events(self, organization, project, period):
         """
@@ -83,11 +218,7 @@ class GetSentryEventsData:
         :param period: 0 = 24 hour, 1 = 14 days
         :return: json
         """
-        url = 'https://sentry.io/api/0/projects/{0}/{1}/events/?statsPeriod={2}'.format(
-            organization, project, '14d' if period is 1 else '24h'
-        )
-        logging.info('[sentry.api] called : {} [{}]'.format(url, datetime.now()))
-        return requests.get(url, headers=self.header).json()
+        return [event for page in self.iter_a_projects_events(organization, project, period) for event in page]
 
     def list_an_issues_events(self, issue_id):
         """
@@ -95,11 +226,26 @@ class GetSentryEventsData:
         :param issue_id: int. sentry unique id allocated to an issue
         :return: json
         """
-        url = 'https://sentry.io/api/0/issues/{}/events/'.format(
-            issue_id
-        )
-        logging.info('[sentry.api] called : {} [{}]'.format(url, datetime.now()))
-        return requests.get(url, headers=self.header).json()
+        return [event for page in self.iter_an_issues_events(issue_id) for event in page]
+
+    def close(self):
+        """
+        closes the connections of the session
+        :return: none
+        """
+        self.session.close()
+
+
+def latest_date_created(records, current=None):
+    """
+    :param records: list of sentry records with a dateCreated
+    :param current: the latest dateCreated seen so far
+    :return: the latest dateCreated of the records and current, compared as timestamps
+    """
+    dates = [catalogue.to_timestamp(record['dateCreated']) for record in records if record.get('dateCreated')]
+    if current is not None:
+        dates.append(current)
+    return max(dates, default=None)
 
 
 class SentryReplicationMethod:
@@ -108,82 +254,181 @@ class SentryReplicationMethod:
         :param kwargs:
         auth_token=api bearer token for authorization
         organisation=your company or organisation
+        raise_errors=errors are logged and swallowed by default, if true they are passed on to the caller
+        max_workers=amount of issues fetched at the same time, defaults to 8
+        issue_output_format=output format of the issue events objects, defaults to gzip compressed ndjson
+        max_object_size=bytes per issue events object, defaults to 128 MiB
         """
+        self.raise_errors = kwargs.get('raise_errors', False)
+
         self.organization = kwargs['organization']
         self.auth_token = kwargs['auth_token']
+        self.max_workers = kwargs.get('max_workers', 8)
 
-        self.sentry = GetSentryEventsData(auth_token=self.auth_token, organization=self.organization)
+        # every worker gets a connection of the pool, so the pool is as large as the amount of workers
+        self.sentry = GetSentryEventsData(auth_token=self.auth_token, organization=self.organization,
+                                          pool_size=max(self.max_workers, 10))
 
         self.s3_service = service.S3ServiceMethod(
             region_name=kwargs['region_name'],
             aws_access_key_id=kwargs['aws_access_key_id'],
             aws_secret_access_key=kwargs['aws_secret_access_key'],
             s3bucket=kwargs['s3bucket'],
-            main_key=kwargs['main_key']
+            main_key=kwargs['main_key'],
+            # events are only marked seen once they are written, so a failed write has to stop the load
+            raise_errors=True
         )
 
+        # the events of all issues of a project are coalesced into a few objects per run
+        self.issue_output_format = kwargs.get('issue_output_format') or formats.NdjsonFormat()
+        self.max_object_size = kwargs.get('max_object_size', service.DEFAULT_BATCH_OBJECT_SIZE)
+
+        # ensures the catalogue exists, it holds the index of the events that were exported
+        catalogue.CatalogueMethods().set_up_catalogue()
+
     @staticmethod
     def update_catalogue(column_name, column_time, table_name, app_run_time, database):
         update_catalogue = catalogue.CatalogueMethods()
         update_catalogue.update_catalogue(column_name=column_name, column_time=column_time, table_name=table_name,
                                           app_run_time=app_run_time, data_source=database)
 
-    def full_load(self, project):
+    def load_project(self, project, period, stop_at_seen=True):
         """
-        full loads 14 days worth of sentry data to s3
+        loads the events of a project, and the events of each of its issues, page by page to s3
         :param project: the sentry project name
-        :return: json
+        :param period: 0 = 24 hour, 1 = 14 days
+        :param stop_at_seen: boolean. stop paging at the first page with exported events, which replicate does.
+        a full load pages through the whole period and leaves out the exported events
+        :return: none
         """
-        try:
-            logging.info('[sentry.api] attempting full load of sentry project: {} [{}]'.format(project, datetime.now()))
-
-            ###
-            # ISSUES DATA
-            # this is collected to iterate though all event issues and load them to s3
-            # get all issues data for the project
-            issues_data = self.sentry.list_a_projects_issues(project=project, organization=self.organization, period=1)
-            issues_data_df = pd.json_normalize(issues_data)
-
-            ###
-            # EVENTS DATA
-            # get all events data for the projects
-            events_data = self.sentry.list_a_projects_events(project=project, organization=self.organization, period=1)
-            events_data_df = pd.json_normalize(events_data)
-
-            # write to catalog with max timestamp
-            self.update_catalogue(column_name='dateCreated', column_time=events_data_df['dateCreated'].max(),
+        seen_events = catalogue.CatalogueMethods()
+
+        ###
+        # ISSUES DATA
+        # this is collected to iterate though all event issues and load them to s3
+        # only the ids of the issues are kept while their pages are read
+        issue_ids = [issue['id'] for page in self.sentry.iter_a_projects_issues(
+            project=project, organization=self.organization, period=period) for issue in page]
+
+        ###
+        # EVENTS DATA
+        # every page of new events is written as its own part object, so a large project is never held in memory
+        # pages are encoded and uploaded on worker threads while the next page is requested
+        with service.S3PartWriter(s3_service=self.s3_service) as events_writer:
+            max_date_created, event_ids = self.export_unseen(
+                pages=self.sentry.iter_a_projects_events(project=project, organization=self.organization,
+                                                         period=period),
+                index='sentry-events-{}'.format(project), stop_at_seen=stop_at_seen,
+                write=lambda part, events_data: events_writer.write_records(local=project + '-events',
+                                                                            records=events_data, part=part))
+        seen_events.mark_events_seen(data_source='sentry-events-{}'.format(project), event_ids=event_ids,
+                                     seen_time=datetime.now())
+
+        # write to catalog with max timestamp once all pages are written
+        if max_date_created is not None:
+            self.update_catalogue(column_name='dateCreated', column_time=max_date_created,
                                   table_name=project, app_run_time=datetime.now(), database='sentry-events-{}'
                                   .format(project))
 
-            # write data to s3
-            self.s3_service.write_to_s3(data=events_data, local=project + '-events')
+        ###
+        # EVENTS ISSUES DATA
+        # gather all data per issue, max_workers issues at a time within sentry's rate limit
+        # the events of every issue are tagged with its id and written together into the issue folder
+        # of the project, a new object is only begun once one reaches max_object_size
+        with service.S3BatchWriter(s3_service=self.s3_service, local='{}-issue'.format(project),
+                                   output_format=self.issue_output_format,
+                                   max_object_size=self.max_object_size) as issue_writer:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                # bound to the job of the project, so the issues' requests and rows count for it
+                futures = [executor.submit(metrics.bind(self.load_issue), issue_writer, project, i, stop_at_seen)
+                           for i in issue_ids]
+                # result passes on the error of an issue once all issues are done
+                results = [future.result() for future in futures]
+
+        # events are only remembered, and the catalogue moved, once the objects holding them are complete
+        seen_time = datetime.now()
+        for issue_id, (max_date_created, event_ids) in zip(issue_ids, results):
+            seen_events.mark_events_seen(data_source='sentry-issue-events-{}'.format(project), event_ids=event_ids,
+                                         seen_time=seen_time)
 
-            ###
-            # EVENTS ISSUES DATA
-            # first get all issue ids
-            issue_ids = issues_data_df['id'].tolist()
+            # write to catalog with max timestamp
+            if max_date_created is not None:
+                self.update_catalogue(column_name='dateCreated', column_time=max_date_created,
+                                      table_name=project, app_run_time=datetime.now(),
+                                      database='{}-sentry-issue-{}'.format(project, issue_id))
 
-            # gather all data per issue
-            for i in issue_ids:
-                events_issue_data = self.sentry.list_an_issues_events(issue_id=i)
-                events_issue_data_df = pd.json_normalize(events_issue_data)
+    def load_issue(self, issue_writer, project, issue_id, stop_at_seen=True):
+        """
+        fetches the new events of one issue page by page into the issue writer, runs on an issue worker thread
+        :param issue_writer: S3BatchWriter of the project's issue events
+        :param project: the sentry project name
+        :param issue_id: sentry unique id allocated to an issue
+        :param stop_at_seen: boolean. stop paging at the first page with exported events
+        :return: tuple of (latest dateCreated, list of the written event ids)
+        """
+        return self.export_unseen(
+            pages=self.sentry.iter_an_issues_events(issue_id=issue_id),
+            index='sentry-issue-events-{}'.format(project), stop_at_seen=stop_at_seen,
+            write=lambda part, events_issue_data: issue_writer.write_records(
+                [dict(event, issueId=issue_id) for event in events_issue_data]))
 
-                # write to catalog with max timestamp
-                self.update_catalogue(column_name='dateCreated', column_time=events_issue_data_df['dateCreated'].max(),
-                                      table_name=project, app_run_time=datetime.now(),
-                                      database='{}-sentry-issue-{}'.format(project, i))
+    @staticmethod
+    def export_unseen(pages, index, write, stop_at_seen=True):
+        """
+        writes the events of the pages that were not exported before. sentry lists events newest first,
+        so a replication stops paging at the first page with events that were exported, a full load pages
+        through every page to pick up older events and events that arrived late. the caller remembers the
+        written events once they are safely in s3
+        :param pages: generator of pages of events, as given by GetSentryEventsData
+        :param index: string. the name of the seen event index of the export
+        :param write: callable taking a part number and a list of events, writes them to s3
+        :param stop_at_seen: boolean. stop paging at the first page with events that were exported
+        :return: tuple of (latest dateCreated of the written events, list of their event ids)
+        """
+        seen_events = catalogue.CatalogueMethods()
+        max_date_created = None
+        written = []
+        part = 0
+        for page in pages:
+            event_ids = [str(event.get('eventID') or event['id']) for event in page]
+            unseen = seen_events.unseen_events(data_source=index, event_ids=event_ids)
+            new_events = [event for event, event_id in zip(page, event_ids) if event_id in unseen]
+
+            if new_events:
+                write(part, new_events)
+                metrics.record('rows', len(new_events))
+                written.extend(event_id for event_id in event_ids if event_id in unseen)
+                max_date_created = latest_date_created(new_events, max_date_created)
+                part += 1
+
+            # the pages after this one only hold older events, which the previous load exported
+            if stop_at_seen and len(new_events) < len(page):
+                pages.close()
+                break
+
+        return max_date_created, written
 
-                # write data to s3
-                # (this requires a special write method to ensure all issues are in one folder per project)
-                self.s3_service.specific_write_to_s3(
-                    data=events_data,
-                    folder='{}-issue'.format(project),
-                    file=i)
+    def full_load(self, project):
+        """
+        full loads 14 days worth of sentry data to s3
+        :param project: the sentry project name
+        :return: json
+        """
+        previous_job = metrics.begin_job('sentry', project)
+        try:
+            logging.info('[sentry.api] attempting full load of sentry project: {} [{}]'.format(project, datetime.now()))
+            # pages through the whole 14 days, events before the newest exported one may not have been exported
+            self.load_project(project=project, period=1, stop_at_seen=False)
 
         except Exception as error:
             logging.info(
                 '[sentry.api] error while doing a sentry full load: {} \n for project {} [{}]'
                     .format(error, project, datetime.now()))
+            if self.raise_errors:
+                raise
+
+        finally:
+            metrics.end_job(previous_job)
 
     def replicate(self, project):
         """
@@ -191,53 +436,25 @@ class SentryReplicationMethod:
         :param project:
         :return:
         """
+        previous_job = metrics.begin_job('sentry', project)
         try:
             logging.info('[sentry.api] attempting replicate sentry project: {} [{}]'.format(project, datetime.now()))
-
-            ###
-            # ISSUES DATA
-            # this is collected to iterate though all event issues and load them to s3
-            # get all issues data for the project
-            issues_data = self.sentry.list_a_projects_issues(project=project, organization=self.organization, period=0)
-            issues_data_df = pd.json_normalize(issues_data)
-
-            ###
-            # EVENTS DATA
-            # get all events data for the projects
-            events_data = self.sentry.list_a_projects_events(project=project, organization=self.organization, period=0)
-            events_data_df = pd.json_normalize(events_data)
-
-            # write to catalog with max timestamp
-            self.update_catalogue(column_name='dateCreated', column_time=events_data_df['dateCreated'].max(),
-                                  table_name=project, app_run_time=datetime.now(), database='sentry-events-{}'
-                                  .format(project))
-
-            # write data to s3
-            self.s3_service.write_to_s3(data=events_data, local=project + '-events')
-
-            ###
-            # EVENTS ISSUES DATA
-            # first get all issue ids
-            issue_ids = issues_data_df['id'].tolist()
-
-            # gather all data per issue
-            for i in issue_ids:
-                events_issue_data = self.sentry.list_an_issues_events(issue_id=i)
-                events_issue_data_df = pd.json_normalize(events_issue_data)
-
-                # write to catalog with max timestamp
-                self.update_catalogue(column_name='dateCreated', column_time=events_issue_data_df['dateCreated'].max(),
-                                      table_name=project, app_run_time=datetime.now(),
-                                      database='{}-sentry-issue-{}'.format(project, i))
-
-                # write data to s3
-                # (this requires a special write method to ensure all issues are in one folder per project)
-                self.s3_service.specific_write_to_s3(
-                    data=events_data,
-                    folder='{}-issue'.format(project),
-                    file=i)
+            self.load_project(project=project, period=0)
 
         except Exception as error:
             logging.info(
                 '[sentry.api] error while doing a sentry full load: {} \n for project {} [{}]'
                     .format(error, project, datetime.now()))
+            if self.raise_errors:
+                raise
+
+        finally:
+            metrics.end_job(previous_job)
+
+    def close_connection(self):
+        """
+        closes the pooled connections to sentry
+        :return: none
+        """
+        logging.info('[sentry.api] closing all connections [{}]'.format(datetime.now()))
+        self.sentry.close()
@@ -0,0 +1,272 @@
+"""
+Replication methods shared by the PostgreSQL and MySQL models.
+
+ReplicationMethodsSQL holds what the two models do the same way, the models subclass it
+and bring their own connection, cursors and queries.
+"""
+import copy
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from dbtos3.metrics_model import metrics
+from dbtos3.pool_model import pools
+from dbtos3.s3_model import formats, service
+from dbtos3.sqlite_model import catalogue
+
+# rows fetched per round trip when an output format is selected without a batch size
+DEFAULT_BATCH_SIZE = 10000
+
+
+class ReplicationMethodsSQL:
+    """
+    replication methods shared by the sql database models, a model sets log_name to the tag of its
+    log lines and source_name to the prefix of its catalogue data sources, and implements connect,
+    fetch_batches and get_primary_key
+    """
+
+    log_name = 'sql.db'
+    source_name = 'sql'
+
+    @staticmethod
+    def release_connection(connection):
+        """
+        gives a connection back to the pool it was borrowed from
+        :param connection: a connection returned by connect
+        :return: none
+        """
+        pools.registry.release(connection)
+
+    @staticmethod
+    def update_catalogue(column_name, column_time, table_name, app_run_time, data_source, key_name=None,
+                         key_value=None):
+        update_catalogue = catalogue.CatalogueMethods()
+        update_catalogue.update_catalogue(column_name=column_name, column_time=column_time, table_name=table_name,
+                                          app_run_time=app_run_time, data_source=data_source, key_name=key_name,
+                                          key_value=key_value)
+
+    @staticmethod
+    def max_of_column(description, rows, column):
+        """
+        :param description: DB-API cursor description of the rows
+        :param rows: list of row tuples
+        :param column: string. the column of which the max is needed
+        :return: the max value of the column over the rows, none if there is no value
+        """
+        index = [desc[0] for desc in description].index(column)
+        return max((row[index] for row in rows if row[index] is not None), default=None)
+
+    def stream_to_s3(self, query, table, column, batch_size, output_format=None, partition=None):
+        """
+        streams a query straight to s3. without an output format every batch is written as its own
+        json part object, with one all batches are encoded into a single object of that format
+        :param query: string. the query to be executed
+        :param table: string. the table that is being loaded
+        :param column: string. the column that satisfies the timestamp of the table
+        :param batch_size: integer. amount of rows held in memory at a time
+        :param output_format: an output format from dbtos3.s3_model.formats, for instance ParquetFormat()
+        :param partition: int. number of the key range being streamed, when a table is extracted in partitions
+        :return: the max value of column over all rows that were streamed
+        """
+        max_column_time = None
+
+        def tracked_batches():
+            nonlocal max_column_time
+            for description, rows in self.fetch_batches(query=query, batch_size=batch_size):
+                batch_max = self.max_of_column(description=description, rows=rows, column=column)
+                if batch_max is not None and (max_column_time is None or batch_max > max_column_time):
+                    max_column_time = batch_max
+                yield description, rows
+
+        if output_format is None:
+            # parts are encoded and uploaded on worker threads while the next batch is fetched
+            with service.S3PartWriter(s3_service=self.s3_service) as part_writer:
+                for part, (description, rows) in enumerate(tracked_batches()):
+                    logging.info('[{}] streaming part {} of {} with {} rows [{}]'
+                                 .format(self.log_name, part, table, len(rows), datetime.now()))
+                    part_writer.write_rows(local=table, description=description, rows=rows,
+                                           part=part if partition is None else (partition, part))
+        else:
+            self.s3_service.write_batches_to_s3(local=table, batches=tracked_batches(), output_format=output_format,
+                                                part=partition)
+
+        return max_column_time
+
+    def worker(self):
+        """
+        a copy of this model with its own database connection and s3 service, so it can run on another thread
+        :return: model instance, its connection has to be given back with release_connection by the caller
+        """
+        worker = copy.copy(self)
+        worker.connection = self.connect()
+        worker.cursor = worker.connection.cursor()
+        worker.s3_service = service.S3ServiceMethod(
+            region_name=self.region_name,
+            aws_access_key_id=self.aws_access_key_id,
+            aws_secret_access_key=self.aws_secret_access_key,
+            s3bucket=self.s3bucket,
+            main_key=self.s3main_key,
+            raise_errors=True
+        )
+        return worker
+
+    @staticmethod
+    def split_ranges(lower, upper, partitions):
+        """
+        splits the values from lower to upper into at most partitions ranges of equal width
+        :param lower: integer or timestamp. lowest value of the split column
+        :param upper: integer or timestamp. highest value of the split column
+        :param partitions: integer. amount of ranges
+        :return: list of (start, end, last), a range holds start <= value < end, the last one start <= value <= end
+        """
+        if lower == upper:
+            return [(lower, upper, True)]
+
+        if isinstance(lower, int):
+            width = max(-(-(upper - lower) // partitions), 1)
+        else:
+            width = (upper - lower) / partitions
+
+        starts = []
+        start = lower
+        while start < upper and len(starts) < partitions:
+            starts.append(start)
+            start = start + width
+
+        return [(start, starts[i + 1] if i + 1 < len(starts) else upper, i + 1 == len(starts))
+                for i, start in enumerate(starts)]
+
+    def extract_range(self, query, table, column, partition, batch_size=None, output_format=None):
+        """
+        extracts one key range of a partitioned load, on a worker of this model
+        :param query: string. the query of the range
+        :param table: string. the table that is being loaded
+        :param column: string. the column that satisfies the timestamp of the table
+        :param partition: int. number of the key range
+        :param batch_size: integer. amount of rows held in memory at a time
+        :param output_format: an output format from dbtos3.s3_model.formats, for instance ParquetFormat()
+        :return: the max value of column over the rows of the range
+        """
+        return self.stream_to_s3(query=query, table=table, column=column, batch_size=batch_size or DEFAULT_BATCH_SIZE,
+                                 output_format=output_format, partition=partition)
+
+    def partitioned_to_s3(self, query, table, column, partitions, split_column=None, **options):
+        """
+        splits a query into key ranges of the split column and extracts every range on its own
+        worker connection, each range is written as its own s3 object (or set of part objects)
+        :param query: string. the query to be extracted
+        :param table: string. the table that is being loaded
+        :param column: string. the column that satisfies the timestamp of the table
+        :param partitions: integer. amount of key ranges, and so of connections used at once
+        :param split_column: string. an integer or timestamp column to split on, defaults to the primary key
+        :param options: passed on to extract_range, for instance batch_size and output_format
+        :return: the max value of column over all rows that were extracted
+        """
+        split_column = split_column or self.get_primary_key(table)
+
+        with metrics.timer('query'):
+            self.cursor.execute('select min({0}), max({0}) from ({1}) as bounds'.format(split_column, query))
+            lower, upper = self.cursor.fetchall()[0]
+        self.connection.commit()
+
+        if lower is None:
+            logging.info('[{}] no rows to partition in {} [{}]'.format(self.log_name, table, datetime.now()))
+            return None
+
+        ranges = self.split_ranges(lower=lower, upper=upper, partitions=partitions)
+        logging.info('[{}] extracting {} in {} ranges of {} [{}]'.format(self.log_name, table, len(ranges),
+                                                                         split_column, datetime.now()))
+
+        def extract(partition, key_range):
+            start, end, last = key_range
+            start, end = [value if isinstance(value, int) else "'{}'".format(value) for value in (start, end)]
+            range_query = 'select * from ({}) as partitioned where {} >= {} and {} {} {}'.format(
+                query, split_column, start, split_column, '<=' if last else '<', end)
+
+            worker = self.worker()
+            try:
+                return worker.extract_range(query=range_query, table=table, column=column, partition=partition,
+                                            **options)
+            finally:
+                worker.release_connection(worker.connection)
+
+        with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+            # the ranges are extracted on worker threads, bound to this job so their metrics count for it
+            maxima = list(executor.map(metrics.bind(extract), range(len(ranges)), ranges))
+
+        return max((value for value in maxima if value is not None), default=None)
+
+    def keyset_to_s3(self, table, column, key_column, page_size, output_format=None):
+        """
+        replicates the rows after the catalogue watermark in pages ordered on (column, key_column),
+        every page is written as its own s3 object and the watermark moved to its last row before
+        the next page is read, so a large backlog is drained in pages of bounded size and an
+        interrupted run resumes from the last page that was written
+        :param table: string. the table that is being replicated
+        :param column: string. the column that satisfies the timestamp of the table
+        :param key_column: string. a unique column that orders rows with the same timestamp, usually the primary key
+        :param page_size: integer. amount of rows per page
+        :param output_format: an output format from dbtos3.s3_model.formats, for instance ParquetFormat()
+        :return: the amount of rows replicated
+        """
+        data_source = '{}-{}'.format(self.source_name, table)
+        watermark = catalogue.CatalogueMethods().get_watermark(table=table, data_source=data_source)
+        if watermark is None:
+            logging.info('[{}] no need to update {}! [{}]'.format(self.log_name, table, datetime.now()))
+            return 0
+
+        column_time, key_name, key_value = watermark
+        if key_name != key_column:
+            # a watermark on the time alone, or on another key, continues after every row at its time
+            key_value = None
+
+        page = 0
+        replicated = 0
+        while True:
+            # a row value comparison on (column, key) is answered from an index on the same columns
+            if key_value is None:
+                condition, params = '{} > %s'.format(column), (column_time,)
+            else:
+                condition, params = '({}, {}) > (%s, %s)'.format(column, key_column), (column_time, key_value)
+            with metrics.timer('query'):
+                self.cursor.execute('select * from {} where {} order by {}, {} limit {}'.format(
+                    table, condition, column, key_column, page_size), params)
+            with metrics.timer('fetch'):
+                rows = self.cursor.fetchall()
+            description = self.cursor.description
+            self.connection.commit()
+
+            if not rows:
+                break
+            metrics.record('rows', len(rows))
+
+            logging.info('[{}] replicating page {} of {} with {} rows [{}]'.format(self.log_name, page, table,
+                                                                                   len(rows), datetime.now()))
+            columns = [desc[0] for desc in description]
+            # write_batches_to_s3 raises when the page is not written, so the watermark is only moved past
+            # pages that are in s3
+            self.s3_service.write_batches_to_s3(local=table, batches=[(description, rows)],
+                                                output_format=output_format or formats.JsonFormat(), part=page)
+
+            column_time = rows[-1][columns.index(column)]
+            key_value = rows[-1][columns.index(key_column)]
+            self.update_catalogue(column_name=column, column_time=column_time, table_name=table,
+                                  app_run_time=datetime.now(), data_source=data_source, key_name=key_column,
+                                  key_value=key_value)
+
+            replicated += len(rows)
+            if len(rows) < page_size:
+                break
+            page += 1
+
+        return replicated
+
+    def close_connection(self):
+        """
+        closes connection to database
+        :return: none
+        """
+        logging.info('[{}] closing all connections [{}]'.format(self.log_name, datetime.now()))
+        self.cursor.close()
+        self.release_connection(self.connection)
+        catalogue.close_catalogue_connection()
@@ -1,7 +1,10 @@
+import calendar
 import logging
+import numbers
 import os
 import sqlite3
-from datetime import datetime
+import threading
+from datetime import datetime, date, timedelta
 
 try:
     os.mkdir('Logs')
@@ -15,14 +18,100 @@ logging.basicConfig(filename='Logs/logs-{}.log'.format(datetime.now().strftime('
                     filemode='w', datefmt='%d-%b-%y %H:%M:%S', level=logging.INFO)
 
 
+CATALOGUE_PATH = 'catalogue.db'
+
+# runs older than this are removed from the catalogue history, none keeps the full history
+HISTORY_RETENTION_DAYS = 90
+
+# exported event ids are remembered this long, longer than the widest window an api load asks for
+SEEN_EVENT_TTL_DAYS = 30
+
+# one catalogue connection is shared by everything in a process, the lock serialises its use between threads
+shared_connection = None
+shared_connection_pid = None
+connection_lock = threading.RLock()
+
+
+def catalogue_connection():
+    """
+    returns the catalogue connection of this process, opening it on first use
+    the catalogue runs in wal mode so readers and writers in other processes do not block each other
+    :return: sqlite3 connection
+    """
+    global shared_connection, shared_connection_pid
+
+    with connection_lock:
+        # a forked worker process must not reuse the connection of its parent
+        if shared_connection is None or shared_connection_pid != os.getpid():
+            shared_connection = sqlite3.connect(CATALOGUE_PATH, timeout=30, check_same_thread=False)
+            shared_connection.execute('PRAGMA journal_mode=WAL')
+            shared_connection.execute('PRAGMA synchronous=NORMAL')
+            shared_connection_pid = os.getpid()
+            logging.info('[sqlite.catalogue] opened catalogue connection [{}]'.format(datetime.now()))
+
+        return shared_connection
+
+
+def close_catalogue_connection():
+    """
+    closes the catalogue connection of this process if it is open, it is opened again on next use
+    :return: none
+    """
+    global shared_connection, shared_connection_pid
+
+    with connection_lock:
+        if shared_connection is not None and shared_connection_pid == os.getpid():
+            shared_connection.close()
+            logging.info('[sqlite.catalogue] closed catalogue connection [{}]'.format(datetime.now()))
+        shared_connection = None
+        shared_connection_pid = None
+
+
+def to_timestamp(value):
+    """
+    turns a watermark into a typed value, timestamps and their iso formatted strings become datetimes
+    :param value: the watermark as given by a model or read from the catalogue
+    :return: datetime, or the value unchanged if it is not a timestamp
+    """
+    if isinstance(value, datetime):
+        return value
+    if isinstance(value, date):
+        return datetime(value.year, value.month, value.day)
+    if isinstance(value, str):
+        try:
+            return datetime.fromisoformat(value.replace('Z', '+00:00'))
+        except ValueError:
+            return value
+    return value
+
+
+def watermark_epoch(value):
+    """
+    ordering key of a typed watermark, so watermarks are compared as timestamps and not as text
+    :param value: datetime or number
+    :return: seconds since epoch (naive timestamps are taken as utc), the number itself, or none
+    """
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            return calendar.timegm(value.timetuple()) + value.microsecond / 1e6
+        return value.timestamp()
+    if isinstance(value, numbers.Number) and not isinstance(value, bool):
+        return float(value)
+    return None
+
+
 class CatalogueMethods:
     def __init__(self):
-        self.conn = sqlite3.connect('catalogue.db')
+        self.conn = catalogue_connection()
         self.cursor = self.conn.cursor()
 
-    def set_up_catalogue(self):
+    def set_up_catalogue(self, retention_days=HISTORY_RETENTION_DAYS, seen_event_ttl_days=SEEN_EVENT_TTL_DAYS):
         """
         sets up the catalogue before any other models begin their tasks
+        the catalogue table keeps the history of every run, the watermark table only the latest
+        watermark per data source and table
+        :param retention_days: integer. history older than this is compacted away, none keeps everything
+        :param seen_event_ttl_days: integer. exported event ids older than this are forgotten, none keeps them all
         :return: none
         """
         if self.conn is not None:
@@ -38,7 +127,95 @@ class CatalogueMethods:
                         data_source text NOT NULL 
                     )"""
 
-                self.cursor.execute(catalogue_query)
+                # watermark lookups filter on table and source and take the max time, so this index
+                # answers them with a single seek however long the history grows
+                index_query = """
+                    CREATE INDEX IF NOT EXISTS catalogue_table_source
+                    ON catalogue (table_name, data_source, column_time)"""
+
+                watermark_query = """
+                    CREATE TABLE IF NOT EXISTS watermark (
+                        data_source text NOT NULL,
+                        table_name text NOT NULL,
+                        column_name text NOT NULL,
+                        column_time text NOT NULL,
+                        column_epoch real,
+                        key_name text,
+                        key_value,
+                        app_run_time text NOT NULL,
+                        PRIMARY KEY (data_source, table_name)
+                    )"""
+
+                # change data capture keeps the position it read the database log up to, one row per source
+                log_position_query = """
+                    CREATE TABLE IF NOT EXISTS log_position (
+                        data_source text NOT NULL PRIMARY KEY,
+                        position text NOT NULL,
+                        app_run_time text NOT NULL
+                    )"""
+
+                # ids of api events that were exported already, so a load only writes events it has not seen
+                seen_event_query = """
+                    CREATE TABLE IF NOT EXISTS seen_event (
+                        data_source text NOT NULL,
+                        event_id text NOT NULL,
+                        seen_time text NOT NULL,
+                        PRIMARY KEY (data_source, event_id)
+                    )"""
+
+                seen_time_index_query = """
+                    CREATE INDEX IF NOT EXISTS seen_event_seen_time
+                    ON seen_event (seen_time)"""
+
+                # date ranges an api source was loaded for, so only the dates in between have to be fetched
+                loaded_range_query = """
+                    CREATE TABLE IF NOT EXISTS loaded_range (
+                        data_source text NOT NULL,
+                        start_at text NOT NULL,
+                        end_at text NOT NULL,
+                        app_run_time text NOT NULL
+                    )"""
+
+                loaded_range_index_query = """
+                    CREATE INDEX IF NOT EXISTS loaded_range_source
+                    ON loaded_range (data_source, start_at)"""
+
+                run_time_index_query = """
+                    CREATE INDEX IF NOT EXISTS catalogue_app_run_time
+                    ON catalogue (app_run_time)"""
+
+                with connection_lock:
+                    self.cursor.execute(catalogue_query)
+                    self.cursor.execute(index_query)
+                    self.cursor.execute(run_time_index_query)
+                    self.cursor.execute(watermark_query)
+                    self.cursor.execute(log_position_query)
+                    self.cursor.execute(seen_event_query)
+                    self.cursor.execute(seen_time_index_query)
+                    self.cursor.execute(loaded_range_query)
+                    self.cursor.execute(loaded_range_index_query)
+
+                    # watermark tables from before keyset replication get the key columns added
+                    self.cursor.execute('PRAGMA table_info(watermark)')
+                    watermark_columns = [row[1] for row in self.cursor.fetchall()]
+                    for key_column in ('key_name text', 'key_value'):
+                        if key_column.split()[0] not in watermark_columns:
+                            self.cursor.execute('ALTER TABLE watermark ADD COLUMN {}'.format(key_column))
+                    self.conn.commit()
+
+                    # catalogues from before the watermark table get their watermarks from the history once
+                    self.cursor.execute('SELECT count(*) FROM watermark')
+                    if self.cursor.fetchall()[0][0] == 0:
+                        self.cursor.execute('SELECT column_name, column_time, table_name, app_run_time, data_source '
+                                            'FROM catalogue ORDER BY id')
+                        for row in self.cursor.fetchall():
+                            self.upsert_watermark(*row)
+                        self.conn.commit()
+
+                if retention_days is not None:
+                    self.compact_history(retention_days=retention_days)
+                if seen_event_ttl_days is not None:
+                    self.prune_seen_events(ttl_days=seen_event_ttl_days)
                 logging.info('[sqlite.catalogue] catalogue initiated successfully [{}]'.format(datetime.now()))
 
             except (Exception, sqlite3.Error) as error:
@@ -47,7 +224,8 @@ class CatalogueMethods:
         else:
             logging.info('[sqlite.catalogue] cannot connect to catalogue [{}]'.format(datetime.now()))
 
-    def update_catalogue(self, column_name, column_time, table_name, app_run_time, data_source):
+    def update_catalogue(self, column_name, column_time, table_name, app_run_time, data_source, key_name=None,
+                         key_value=None):
         """
         updates the catalogue whenever a full load or replication is done
         :param column_name: string. the name of the column that satisfies the replication time
@@ -55,16 +233,22 @@ class CatalogueMethods:
         :param table_name: string. the name of the table that will be replicated or loaded
         :param app_run_time: string. the time the application ran
         :param data_source: the name of the database model that was used, this allows for multiple data sources in one app
+        :param key_name: string. the key column of a keyset watermark, none for a watermark on the time alone
+        :param key_value: the key of the last row loaded at column_time, with key_name
         :return: none
         """
         if self.conn is not None:
             try:
-                catalogue_query = "INSERT INTO catalogue (column_name, column_time, table_name, app_run_time, data_source) " \
-                                  "VALUES('{}','{}','{}','{}','{}')".format(
-                    column_name, column_time, table_name, app_run_time, data_source)
+                column_time = to_timestamp(column_time)
 
-                self.cursor.execute(catalogue_query)
-                self.conn.commit()
+                # the run is added to the history and the watermark moved in one transaction
+                with connection_lock:
+                    self.cursor.execute('INSERT INTO catalogue (column_name, column_time, table_name, app_run_time, '
+                                        'data_source) VALUES (?, ?, ?, ?, ?)',
+                                        (column_name, str(column_time), table_name, str(app_run_time), data_source))
+                    self.upsert_watermark(column_name, column_time, table_name, app_run_time, data_source,
+                                          key_name=key_name, key_value=key_value)
+                    self.conn.commit()
                 logging.info('[sqlite.catalogue] catalogue updated successfully [{}]'.format(datetime.now()))
 
             except (Exception, sqlite3.Error) as error:
@@ -78,16 +262,17 @@ class CatalogueMethods:
         gathers the max time of the relevant table from the catalogue
         :param table: string. the table that needs to be satisfied with a timestamp
         :param data_source: the name of the database model that was used, this allows for multiple data sources in one app
-        :return: timestamp
+        :return: timestamp, as a datetime when the watermark is a timestamp
         """
         if self.conn is not None:
             try:
-                catalogue_query = "SELECT max(column_time) FROM catalogue WHERE table_name = '{}' and data_source = '{}'" \
-                    .format(table, data_source)
-
-                self.cursor.execute(catalogue_query)
+                # the watermark table holds one row per table, so this is a primary key lookup
+                with connection_lock:
+                    self.cursor.execute('SELECT column_time FROM watermark WHERE data_source = ? AND table_name = ?',
+                                        (data_source, table))
+                    rows = self.cursor.fetchall()
                 logging.info('[sqlite.catalogue] max gathered from catalogue successfully [{}]'.format(datetime.now()))
-                return self.cursor.fetchall()[0][0]
+                return to_timestamp(rows[0][0]) if rows else None
 
             except (Exception, sqlite3.Error) as error:
                 logging.info(
@@ -97,9 +282,246 @@ class CatalogueMethods:
         else:
             logging.info('[sqlite.catalogue] cannot connect to catalogue [{}]'.format(datetime.now()))
 
-    def close_connection(self):
+    def get_watermark(self, table, data_source):
+        """
+        gathers the full watermark of the relevant table from the catalogue, including the key of a keyset watermark
+        :param table: string. the table that needs to be satisfied with a timestamp
+        :param data_source: the name of the database model that was used, this allows for multiple data sources in one app
+        :return: tuple of (timestamp, key name, key value), the key is none for a watermark on the time alone,
+        or none if the table has no watermark
+        """
+        if self.conn is not None:
+            try:
+                with connection_lock:
+                    self.cursor.execute('SELECT column_time, key_name, key_value FROM watermark '
+                                        'WHERE data_source = ? AND table_name = ?', (data_source, table))
+                    rows = self.cursor.fetchall()
+                if not rows:
+                    return None
+                column_time, key_name, key_value = rows[0]
+                return to_timestamp(column_time), key_name, key_value
+
+            except (Exception, sqlite3.Error) as error:
+                logging.info(
+                    '[sqlite.catalogue] error while gathering watermark from catalogue: {} [{}]'.format(error,
+                                                                                                        datetime.now()))
+
+        else:
+            logging.info('[sqlite.catalogue] cannot connect to catalogue [{}]'.format(datetime.now()))
+
+    def upsert_watermark(self, column_name, column_time, table_name, app_run_time, data_source, key_name=None,
+                         key_value=None):
+        """
+        moves the watermark of a table forward, a watermark older than the stored one is ignored
+        the caller holds the connection lock and commits
+        :param column_name: string. the name of the column that satisfies the replication time
+        :param column_time: the new watermark, timestamps are stored typed and compared as timestamps
+        :param table_name: string. the name of the table that will be replicated or loaded
+        :param app_run_time: string. the time the application ran
+        :param data_source: the name of the database model that was used
+        :param key_name: string. the key column of a keyset watermark
+        :param key_value: the key of the last row loaded at column_time, numbers are kept numeric so they
+        compare as numbers
+        :return: none
+        """
+        column_time = to_timestamp(column_time)
+        # nothing was loaded, nan and nat are the max of an empty data frame
+        if column_time is None or column_time != column_time:
+            return
+
+        if key_value is not None and not isinstance(key_value, numbers.Number):
+            key_value = str(key_value)
+
+        # a keyset watermark is ordered on (time, key), at an equal time only a higher key moves it forward
+        self.cursor.execute("""
+            INSERT INTO watermark (data_source, table_name, column_name, column_time, column_epoch, key_name,
+                                   key_value, app_run_time)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (data_source, table_name) DO UPDATE SET
+                column_name = excluded.column_name,
+                column_time = excluded.column_time,
+                column_epoch = excluded.column_epoch,
+                key_name = excluded.key_name,
+                key_value = excluded.key_value,
+                app_run_time = excluded.app_run_time
+            WHERE watermark.column_epoch IS NULL OR excluded.column_epoch > watermark.column_epoch
+                OR (excluded.column_epoch = watermark.column_epoch
+                    AND (excluded.key_value IS NULL OR watermark.key_value IS NULL
+                         OR excluded.key_value >= watermark.key_value))""",
+                            (data_source, table_name, column_name,
+                             column_time.isoformat(sep=' ') if isinstance(column_time, datetime) else str(column_time),
+                             watermark_epoch(column_time), key_name, key_value, str(app_run_time)))
+
+    def compact_history(self, retention_days=HISTORY_RETENTION_DAYS):
+        """
+        removes runs older than the retention period from the catalogue history,
+        the current watermarks are kept in the watermark table and are not affected
+        :param retention_days: integer. amount of days of history to keep
+        :return: none
+        """
+        if self.conn is not None:
+            try:
+                cutoff = str(datetime.now() - timedelta(days=retention_days))
+                with connection_lock:
+                    self.cursor.execute('DELETE FROM catalogue WHERE app_run_time < ?', (cutoff,))
+                    removed = self.cursor.rowcount
+                    self.conn.commit()
+                logging.info('[sqlite.catalogue] compacted {} runs older than {} days from the catalogue [{}]'
+                             .format(removed, retention_days, datetime.now()))
+
+            except (Exception, sqlite3.Error) as error:
+                logging.info('[sqlite.catalogue] error while compacting catalogue: {} [{}]'.format(error,
+                                                                                                   datetime.now()))
+
+        else:
+            logging.info('[sqlite.catalogue] cannot connect to catalogue [{}]'.format(datetime.now()))
+
+    def get_log_position(self, data_source):
+        """
+        gathers the position a change data capture source was read up to
+        :param data_source: the name of the capture source, for instance postgres-cdc-dbtos3
+        :return: string. the stored position, for instance a postgres lsn, or none if the source was never read
+        """
+        if self.conn is not None:
+            try:
+                with connection_lock:
+                    self.cursor.execute('SELECT position FROM log_position WHERE data_source = ?', (data_source,))
+                    rows = self.cursor.fetchall()
+                return rows[0][0] if rows else None
+
+            except (Exception, sqlite3.Error) as error:
+                logging.info('[sqlite.catalogue] error while gathering log position: {} [{}]'.format(error,
+                                                                                                     datetime.now()))
+
+        else:
+            logging.info('[sqlite.catalogue] cannot connect to catalogue [{}]'.format(datetime.now()))
+
+    def update_log_position(self, data_source, position, app_run_time):
+        """
+        stores the position a change data capture source was read up to, once its changes are written
+        :param data_source: the name of the capture source, for instance postgres-cdc-dbtos3
+        :param position: string. the position in the database log
+        :param app_run_time: string. the time the application ran
+        :return: none
+        """
+        if self.conn is not None:
+            try:
+                with connection_lock:
+                    self.cursor.execute("""
+                        INSERT INTO log_position (data_source, position, app_run_time) VALUES (?, ?, ?)
+                        ON CONFLICT (data_source) DO UPDATE SET
+                            position = excluded.position,
+                            app_run_time = excluded.app_run_time""",
+                                        (data_source, str(position), str(app_run_time)))
+                    self.conn.commit()
+                logging.info('[sqlite.catalogue] log position of {} updated to {} [{}]'.format(data_source, position,
+                                                                                              datetime.now()))
+
+            except (Exception, sqlite3.Error) as error:
+                logging.info('[sqlite.catalogue] error while updating log position: {} [{}]'.format(error,
+                                                                                                    datetime.now()))
+
+        else:
+            logging.info('[sqlite.catalogue] cannot connect to catalogue [{}]'.format(datetime.now()))
+
+    def unseen_events(self, data_source, event_ids):
+        """
+        :param data_source: the name of the export the events are written to, for instance sentry-events-website
+        :param event_ids: list of strings. ids of the events that were fetched
+        :return: set of the ids that were not exported before
+        """
+        event_ids = [str(event_id) for event_id in event_ids]
+        seen = set()
+        with connection_lock:
+            # sqlite allows a limited amount of parameters per statement
+            for start in range(0, len(event_ids), 500):
+                chunk = event_ids[start:start + 500]
+                self.cursor.execute('SELECT event_id FROM seen_event WHERE data_source = ? AND event_id IN ({})'
+                                    .format(', '.join('?' * len(chunk))), [data_source] + chunk)
+                seen.update(row[0] for row in self.cursor.fetchall())
+        return set(event_ids) - seen
+
+    def mark_events_seen(self, data_source, event_ids, seen_time):
+        """
+        remembers events as exported, once they are written
+        :param data_source: the name of the export the events are written to, for instance sentry-events-website
+        :param event_ids: list of strings. ids of the written events
+        :param seen_time: datetime. the time the events were written
+        :return: none
+        """
+        with connection_lock:
+            self.cursor.executemany('INSERT OR IGNORE INTO seen_event (data_source, event_id, seen_time) '
+                                    'VALUES (?, ?, ?)',
+                                    [(data_source, str(event_id), str(seen_time)) for event_id in event_ids])
+            self.conn.commit()
+
+    def prune_seen_events(self, ttl_days=SEEN_EVENT_TTL_DAYS):
+        """
+        forgets exported events older than the ttl, they are outside of every window a load asks for
+        :param ttl_days: integer. amount of days exported event ids are remembered
+        :return: none
+        """
+        if self.conn is not None:
+            try:
+                cutoff = str(datetime.now() - timedelta(days=ttl_days))
+                with connection_lock:
+                    self.cursor.execute('DELETE FROM seen_event WHERE seen_time < ?', (cutoff,))
+                    removed = self.cursor.rowcount
+                    self.conn.commit()
+                logging.info('[sqlite.catalogue] pruned {} seen events older than {} days [{}]'
+                             .format(removed, ttl_days, datetime.now()))
+
+            except (Exception, sqlite3.Error) as error:
+                logging.info('[sqlite.catalogue] error while pruning seen events: {} [{}]'.format(error,
+                                                                                                  datetime.now()))
+
+        else:
+            logging.info('[sqlite.catalogue] cannot connect to catalogue [{}]'.format(datetime.now()))
+
+    def add_loaded_range(self, data_source, start_at, end_at, app_run_time):
+        """
+        remembers that every date from start_at to end_at was loaded
+        :param data_source: the name of the api source, for instance exchangeratesmodel.io
+        :param start_at: date. first loaded date
+        :param end_at: date. last loaded date
+        :param app_run_time: string. the time the application ran
+        :return: none
+        """
+        with connection_lock:
+            self.cursor.execute('INSERT INTO loaded_range (data_source, start_at, end_at, app_run_time) '
+                                'VALUES (?, ?, ?, ?)', (data_source, str(start_at), str(end_at), str(app_run_time)))
+            self.conn.commit()
+
+    def missing_ranges(self, data_source, start_at, end_at):
+        """
+        gathers the dates from start_at to end_at that were not loaded yet
+        :param data_source: the name of the api source, for instance exchangeratesmodel.io
+        :param start_at: date. first date needed
+        :param end_at: date. last date needed
+        :return: list of (start date, end date) gaps, both inclusive
+        """
+        with connection_lock:
+            self.cursor.execute('SELECT start_at, end_at FROM loaded_range WHERE data_source = ? AND start_at <= ? '
+                                'AND end_at >= ? ORDER BY start_at', (data_source, str(end_at), str(start_at)))
+            rows = self.cursor.fetchall()
+
+        gaps = []
+        cursor = start_at
+        for loaded_start, loaded_end in rows:
+            loaded_start, loaded_end = date.fromisoformat(loaded_start), date.fromisoformat(loaded_end)
+            if loaded_start > cursor:
+                gaps.append((cursor, min(loaded_start - timedelta(days=1), end_at)))
+            cursor = max(cursor, loaded_end + timedelta(days=1))
+            if cursor > end_at:
+                break
+        if cursor <= end_at:
+            gaps.append((cursor, end_at))
+        return gaps
+
+    @staticmethod
+    def close_connection():
         """
-        closes connection to database
+        closes the shared catalogue connection of this process
         :return: none
         """
-        self.conn.close()
+        close_catalogue_connection()
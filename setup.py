@@ -22,9 +22,16 @@ setuptools.setup(
     author_email='dirkscgm@gmail.com',
     url='https://github.com/DirksCGM/DBtoS3',
     classifiers=['Programming Language :: Python :: 3 :: Only'],
-    packages=setuptools.find_packages(),
+    packages=setuptools.find_packages(exclude=['benchmarks']),
     install_requires=requires,
-    python_requires='>=3',
+    extras_require={
+        'parquet': ['pyarrow'],
+        'zstd': ['zstandard'],
+        'binlog': ['mysql-replication'],
+        'orjson': ['orjson'],
+        'benchmark': ['moto[server]'],
+    },
+    python_requires='>=3.9',
     keywords=['postgresql', 's3', 'aws', 'mysql', 'sentry', 'replication', 'sql'],
     project_urls={
         'Documentation': 'https://github.com/DirksCGM/DBtoS3/wiki',
@@ -0,0 +1,16 @@
+import pytest
+
+from dbtos3.sqlite_model import catalogue
+
+
+@pytest.fixture
+def catalogue_methods(tmp_path, monkeypatch):
+    """
+    a catalogue in a temporary directory, the connection of the process is opened on it and closed afterwards
+    """
+    catalogue.close_catalogue_connection()
+    monkeypatch.setattr(catalogue, 'CATALOGUE_PATH', str(tmp_path / 'catalogue.db'))
+    methods = catalogue.CatalogueMethods()
+    methods.set_up_catalogue()
+    yield methods
+    catalogue.close_catalogue_connection()
@@ -0,0 +1,67 @@
+import json
+from datetime import date
+
+import boto3
+import pytest
+from moto import mock_aws
+
+from dbtos3.exchangeratesapi_model import api
+
+BUCKET = 'bkt'
+
+
+@pytest.fixture
+def model(catalogue_methods, tmp_path):
+    with mock_aws():
+        boto3.client('s3', region_name='us-east-1').create_bucket(Bucket=BUCKET)
+        yield api.ExchangesRatesReplicationMethod(
+            organization='test', region_name='us-east-1', aws_access_key_id='testing',
+            aws_secret_access_key='testing', s3bucket=BUCKET, main_key='rates', raise_errors=True,
+            cache_path=str(tmp_path / 'Cache'))
+
+
+def payload(days):
+    return {'base': 'EUR', 'rates': {day: {'USD': 1.1, 'GBP': 0.85} for day in days}}
+
+
+def object_keys():
+    listing = boto3.client('s3', region_name='us-east-1').list_objects_v2(Bucket=BUCKET)
+    return sorted(item['Key'] for item in listing.get('Contents', []))
+
+
+def test_full_load_days_are_not_missing(model, catalogue_methods, monkeypatch):
+    days = ['2020-01-06', '2020-01-07', '2020-01-08', '2020-01-09', '2020-01-10']
+    monkeypatch.setattr(api, 'get_ranged_rates', lambda start_at: payload(days))
+
+    model.full_load(start_at='2020-01-06')
+
+    assert catalogue_methods.missing_ranges(data_source='exchangeratesmodel.io', start_at=date(2020, 1, 6),
+                                            end_at=date(2020, 1, 10)) == []
+
+
+def test_load_missing_skips_days_of_a_full_load(model, monkeypatch):
+    monkeypatch.setattr(api, 'get_ranged_rates', lambda start_at: payload(['2020-01-06', '2020-01-07']))
+    model.full_load(start_at='2020-01-06')
+    written = object_keys()
+
+    def no_request(**kwargs):
+        raise AssertionError('days that were loaded are fetched again')
+
+    monkeypatch.setattr(api, 'get_rates', no_request)
+    model.load_missing(start_at='2020-01-06', end_at='2020-01-07')
+
+    assert object_keys() == written
+
+
+def test_rates_are_written_one_object_per_month(model, monkeypatch):
+    days = ['2020-01-30', '2020-01-31', '2020-02-03', '2020-02-04', '2020-02-05']
+    monkeypatch.setattr(api, 'get_ranged_rates', lambda start_at: payload(days))
+
+    model.full_load(start_at='2020-01-30')
+
+    client = boto3.client('s3', region_name='us-east-1')
+    keys = object_keys()
+    assert [key.split('/')[2] for key in keys] == ['month=2020-01', 'month=2020-02']
+    february = json.loads(client.get_object(Bucket=BUCKET, Key=keys[1])['Body'].read())
+    assert sorted({row['date'] for row in february}) == days[2:]
+    assert len(february) == 6
@@ -0,0 +1,80 @@
+import io
+import json
+from datetime import time, timezone
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from dbtos3.s3_model import formats
+
+
+class BufferSink:
+    def __init__(self):
+        self.buffer = io.BytesIO()
+
+    def write_chunk(self, chunk):
+        self.buffer.write(chunk)
+
+
+def mysql_column(name, type_code, flags, charset):
+    # name, type_code, display_size, internal_size, precision, scale, null_ok, flags and charset,
+    # as given by mysql.connector
+    return name, type_code, None, None, None, None, 1, flags, charset
+
+
+def write_parquet(description, rows):
+    sink = BufferSink()
+    encoder = formats.ParquetFormat().open(sink)
+    encoder.write_batch(description, rows)
+    encoder.close()
+    return pq.read_table(io.BytesIO(sink.buffer.getvalue()))
+
+
+def test_mysql_varbinary_and_bin_collated_text_columns():
+    description = [
+        mysql_column('hash', 253, 128, 63),  # varbinary(16)
+        mysql_column('token', 254, 128, 63),  # binary(4)
+        mysql_column('name', 252, 16 | 128, 46),  # text collate utf8mb4_bin
+        mysql_column('code', 253, 128, 46),  # varchar collate utf8mb4_bin
+        mysql_column('payload', 252, 16 | 128, 63),  # blob
+    ]
+    rows = [
+        (bytearray(b'\x00\x01' * 8), bytearray(b'abcd'), 'first', 'A1', bytearray(b'\xff')),
+        (None, bytearray(b'efgh'), 'second', None, None),
+    ]
+
+    table = write_parquet(description, rows)
+
+    assert table.schema.field('hash').type == pa.binary()
+    assert table.schema.field('token').type == pa.binary()
+    assert table.schema.field('name').type == pa.string()
+    assert table.schema.field('code').type == pa.string()
+    assert table.schema.field('payload').type == pa.binary()
+    assert table.column('hash').to_pylist() == [b'\x00\x01' * 8, None]
+    assert table.column('name').to_pylist() == ['first', 'second']
+
+
+def test_mysql_column_kind_without_charset_is_guessed_from_values():
+    # older drivers give no charset, blob and text can then only be told apart by their values
+    description = ('data', 252, None, None, None, None, 1, 144)
+
+    assert formats.column_kind(description) is None
+
+
+def test_json_rows_with_time_zone_times_and_wide_integers():
+    description = [('id',), ('opens_at',), ('closes_at',), ('amount',)]
+    rows = [
+        (1, time(9, 30, tzinfo=timezone.utc), time(17, 0), 2 ** 70),
+        (2, None, time(18, 15, 30), 12),
+    ]
+
+    assert json.loads(formats.encode_rows(description, rows)) == [
+        {'id': 1, 'opens_at': '09:30:00+00:00', 'closes_at': '17:00:00', 'amount': 2 ** 70},
+        {'id': 2, 'opens_at': None, 'closes_at': '18:15:30', 'amount': 12},
+    ]
+
+
+def test_json_records_with_wide_integers():
+    records = [{'id': 1, 'amount': 2 ** 70, 'at': time(9, 30, tzinfo=timezone.utc)}]
+
+    assert json.loads(formats.encode_records(records)) == [{'id': 1, 'amount': 2 ** 70, 'at': '09:30:00+00:00'}]
@@ -0,0 +1,55 @@
+from dbtos3.pool_model import pools
+
+
+class FakeConnection:
+    def __init__(self, number):
+        self.number = number
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def make_pool(size=2):
+    opened = []
+
+    def connect():
+        opened.append(FakeConnection(len(opened)))
+        return opened[-1]
+
+    pool = pools.ConnectionPool(connect=connect, reset=lambda connection: not connection.closed,
+                                alive=lambda connection: not connection.closed, size=size)
+    return pool, opened
+
+
+def test_idle_connection_is_reused():
+    pool, opened = make_pool()
+    connection = pool.borrow()
+    pool.give_back(connection)
+
+    assert pool.borrow() is connection
+    assert len(opened) == 1
+
+
+def test_dead_idle_connection_is_replaced():
+    pool, opened = make_pool()
+    connection = pool.borrow()
+    pool.give_back(connection)
+    # the server closed the connection while it was idle
+    connection.closed = True
+
+    replacement = pool.borrow()
+
+    assert replacement is not connection
+    assert len(opened) == 2
+    assert pool.idle == []
+
+
+def test_idle_connections_above_size_are_closed():
+    pool, opened = make_pool(size=1)
+    first, second = pool.borrow(), pool.borrow()
+    pool.give_back(first)
+    pool.give_back(second)
+
+    assert pool.idle == [first]
+    assert second.closed
@@ -0,0 +1,187 @@
+import json
+import os
+import struct
+from types import SimpleNamespace
+
+import boto3
+import pytest
+from moto import mock_aws
+
+from dbtos3.postgres_model import cdc
+
+BUCKET = 'bkt'
+
+
+def cstring(value):
+    return value.encode('UTF-8') + b'\0'
+
+
+def tuple_data(*values):
+    """
+    pgoutput tuple data, a string is sent as text, None as null and cdc.UNCHANGED_TOAST as an unchanged toast value
+    """
+    data = struct.pack('>h', len(values))
+    for value in values:
+        if value is None:
+            data += b'n'
+        elif value is cdc.UNCHANGED_TOAST:
+            data += b'u'
+        else:
+            encoded = value.encode('UTF-8')
+            data += b't' + struct.pack('>i', len(encoded)) + encoded
+    return data
+
+
+def begin(lsn):
+    return b'B' + struct.pack('>QqI', lsn, 0, 1)
+
+
+def relation(relation_id, schema, table, columns):
+    data = b'R' + struct.pack('>I', relation_id) + cstring(schema) + cstring(table) + b'd'
+    data += struct.pack('>h', len(columns))
+    for index, name in enumerate(columns):
+        # key flag, name, type oid and type modifier
+        data += struct.pack('>b', 1 if index == 0 else 0) + cstring(name) + struct.pack('>Ii', 25, -1)
+    return data
+
+
+def insert(relation_id, *values):
+    return b'I' + struct.pack('>I', relation_id) + b'N' + tuple_data(*values)
+
+
+def update(relation_id, key, values):
+    return b'U' + struct.pack('>I', relation_id) + b'K' + tuple_data(*key) + b'N' + tuple_data(*values)
+
+
+def delete(relation_id, *key):
+    return b'D' + struct.pack('>I', relation_id) + b'K' + tuple_data(*key)
+
+
+def truncate(*relation_ids):
+    return b'T' + struct.pack('>ib', len(relation_ids), 0) + struct.pack('>{}I'.format(len(relation_ids)),
+                                                                         *relation_ids)
+
+
+def commit(lsn):
+    return b'C' + struct.pack('>bQQq', 0, lsn, lsn + 1, 0)
+
+
+def test_pgoutput_messages_decode_to_changes():
+    relations = {}
+
+    assert cdc.decode_pgoutput(begin(0x16B3748), relations) == ([], False)
+    assert cdc.decode_pgoutput(relation(16384, 'public', 'users', ['id', 'name', 'bio']), relations) == ([], False)
+    assert cdc.decode_pgoutput(relation(16390, 'audit', 'events', ['id']), relations) == ([], False)
+    assert relations == {16384: ('users', ['id', 'name', 'bio']), 16390: ('audit.events', ['id'])}
+
+    changes, committed = cdc.decode_pgoutput(insert(16384, '1', 'ada', None), relations)
+    assert not committed
+    assert changes == [{'action': 'insert', 'table': 'users', 'data': {'id': '1', 'name': 'ada', 'bio': None},
+                        'identity': None}]
+
+    # the unchanged toasted bio is left out of the row instead of being written as null
+    changes, _ = cdc.decode_pgoutput(update(16384, ('1', None, None), ('1', 'grace', cdc.UNCHANGED_TOAST)),
+                                     relations)
+    assert changes == [{'action': 'update', 'table': 'users', 'data': {'id': '1', 'name': 'grace'},
+                        'identity': {'id': '1', 'name': None, 'bio': None}}]
+
+    changes, _ = cdc.decode_pgoutput(delete(16384, '1', None, None), relations)
+    assert changes == [{'action': 'delete', 'table': 'users', 'data': None,
+                        'identity': {'id': '1', 'name': None, 'bio': None}}]
+
+    changes, _ = cdc.decode_pgoutput(truncate(16384, 16390), relations)
+    assert [(change['action'], change['table']) for change in changes] == [('truncate', 'users'),
+                                                                            ('truncate', 'audit.events')]
+
+    assert cdc.decode_pgoutput(commit(0x16B3800), relations) == ([], True)
+
+
+def test_wal2json_messages_decode_to_changes():
+    changes, committed = cdc.decode_wal2json(json.dumps({
+        'action': 'U', 'schema': 'public', 'table': 'users',
+        'columns': [{'name': 'id', 'type': 'integer', 'value': 1}, {'name': 'name', 'type': 'text', 'value': 'ada'}],
+        'identity': [{'name': 'id', 'type': 'integer', 'value': 1}]}))
+    assert not committed
+    assert changes == [{'action': 'update', 'table': 'users', 'data': {'id': 1, 'name': 'ada'},
+                        'identity': {'id': 1}}]
+
+    changes, _ = cdc.decode_wal2json(json.dumps({
+        'action': 'D', 'schema': 'audit', 'table': 'events', 'identity': [{'name': 'id', 'value': 7}]}))
+    assert changes == [{'action': 'delete', 'table': 'audit.events', 'data': None, 'identity': {'id': 7}}]
+
+    assert cdc.decode_wal2json(json.dumps({'action': 'B'})) == ([], False)
+    assert cdc.decode_wal2json(json.dumps({'action': 'C'})) == ([], True)
+
+
+class ReplicationCursor:
+    """
+    replays recorded messages like a psycopg2 replication cursor, and is idle once they are read
+    """
+
+    def __init__(self, messages):
+        self.messages = list(messages)
+        self.feedback = []
+        self.read_end, self.write_end = os.pipe()
+
+    def start_replication(self, **kwargs):
+        self.started = kwargs
+
+    def read_message(self):
+        if not self.messages:
+            return None
+        data_start, payload = self.messages.pop(0)
+        return SimpleNamespace(data_start=data_start, payload=payload)
+
+    def send_feedback(self, flush_lsn):
+        self.feedback.append(flush_lsn)
+
+    def fileno(self):
+        return self.read_end
+
+    def close(self):
+        os.close(self.read_end)
+        os.close(self.write_end)
+
+
+@pytest.fixture
+def capture(catalogue_methods, monkeypatch):
+    cursor = ReplicationCursor([])
+    connection = SimpleNamespace(cursor=lambda: cursor, close=lambda: None)
+    monkeypatch.setattr(cdc.ChangeDataCapturePostgreSQL, 'connect', lambda self, connection_factory=None: connection)
+    with mock_aws():
+        boto3.client('s3', region_name='us-east-1').create_bucket(Bucket=BUCKET)
+        yield cdc.ChangeDataCapturePostgreSQL(
+            host='localhost', database='db', user='user', password='password', port=5432, region_name='us-east-1',
+            aws_access_key_id='testing', aws_secret_access_key='testing', s3bucket=BUCKET, main_key='cdc',
+            raise_errors=True)
+    cursor.close()
+
+
+def written_changes():
+    client = boto3.client('s3', region_name='us-east-1')
+    changes = []
+    for item in client.list_objects_v2(Bucket=BUCKET).get('Contents', []):
+        changes.extend(json.loads(client.get_object(Bucket=BUCKET, Key=item['Key'])['Body'].read()))
+    return changes
+
+
+def test_capture_writes_committed_changes_and_stores_the_commit_lsn(capture, catalogue_methods):
+    capture.cursor.messages = [
+        (0x16B3700, begin(0x16B3800)),
+        (0x16B3700, relation(16384, 'public', 'users', ['id', 'name'])),
+        (0x16B3710, insert(16384, '1', 'ada')),
+        (0x16B3720, update(16384, ('1', None), ('1', 'grace'))),
+        (0x16B3800, commit(0x16B3800)),
+        # a transaction that is not committed yet is read again by the next capture
+        (0x16B3900, begin(0x16B3A00)),
+        (0x16B3910, delete(16384, '1', None)),
+    ]
+
+    assert capture.capture_to_s3(tables=['users'], idle_timeout=0) == 2
+
+    changes = sorted(written_changes(), key=lambda change: change['lsn'])
+    assert [(change['action'], change['lsn'], change['data']) for change in changes] == [
+        ('insert', '0/16B3710', {'id': '1', 'name': 'ada'}),
+        ('update', '0/16B3720', {'id': '1', 'name': 'grace'})]
+    assert capture.cursor.feedback == [0x16B3800]
+    assert catalogue_methods.get_log_position(data_source='postgres-cdc-dbtos3') == '0/16B3800'
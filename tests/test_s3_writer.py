@@ -0,0 +1,113 @@
+import boto3
+import pytest
+from moto import mock_aws
+
+from dbtos3.s3_model import service
+
+BUCKET = 'bkt'
+PART_SIZE = service.MIN_PART_SIZE
+
+
+class FlakyClient:
+    """
+    an s3 client whose first part fails to upload the given amount of times before it is sent
+    """
+
+    def __init__(self, client, failures=0):
+        self.client = client
+        self.failures = failures
+        self.calls = []
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def create_multipart_upload(self, **kwargs):
+        self.calls.append('create_multipart_upload')
+        return self.client.create_multipart_upload(**kwargs)
+
+    def put_object(self, **kwargs):
+        self.calls.append('put_object')
+        return self.client.put_object(**kwargs)
+
+    def upload_part(self, **kwargs):
+        self.calls.append('upload_part')
+        if kwargs['PartNumber'] == 1 and self.failures:
+            self.failures -= 1
+            raise ConnectionError('connection reset')
+        return self.client.upload_part(**kwargs)
+
+
+@pytest.fixture
+def client():
+    with mock_aws():
+        s3 = boto3.client('s3', region_name='us-east-1')
+        s3.create_bucket(Bucket=BUCKET)
+        yield s3
+
+
+def writer(client, **kwargs):
+    return service.S3MultipartWriter(client=client, bucket=BUCKET, key='table/object.json', part_size=PART_SIZE,
+                                     retry_backoff=0, **kwargs)
+
+
+def body(client):
+    return client.get_object(Bucket=BUCKET, Key='table/object.json')['Body'].read()
+
+
+def test_object_under_the_part_size_is_put_in_one_request(client):
+    flaky = FlakyClient(client)
+    upload = writer(flaky)
+    upload.write_chunk('[{"id": 1}]')
+
+    assert upload.commit() == 'table/object.json'
+    assert upload.upload_id is None
+    assert flaky.calls == ['put_object']
+    assert body(client) == b'[{"id": 1}]'
+
+
+def test_multipart_upload_is_begun_with_the_first_full_part(client):
+    flaky = FlakyClient(client)
+    upload = writer(flaky)
+    upload.write_chunk(b'a' * (PART_SIZE - 1))
+    assert flaky.calls == []
+
+    upload.write_chunk(b'a' * 2)
+    assert flaky.calls[0] == 'create_multipart_upload'
+
+    assert upload.commit() == 'table/object.json'
+    assert body(client) == b'a' * (PART_SIZE + 1)
+
+
+def test_part_that_fails_once_is_retried(client):
+    flaky = FlakyClient(client, failures=1)
+    upload = writer(flaky)
+    upload.write_chunk(b'a' * PART_SIZE + b'b')
+
+    assert upload.commit() == 'table/object.json'
+    assert upload.retries == 1
+    assert flaky.calls.count('upload_part') == 3
+    assert body(client) == b'a' * PART_SIZE + b'b'
+
+
+def test_upload_is_aborted_when_a_part_keeps_failing(client):
+    upload = writer(FlakyClient(client, failures=3), max_retries=3)
+    upload.write_chunk(b'a' * PART_SIZE + b'b')
+
+    with pytest.raises(ConnectionError):
+        upload.commit()
+
+    assert client.list_multipart_uploads(Bucket=BUCKET).get('Uploads', []) == []
+    assert client.list_objects_v2(Bucket=BUCKET).get('Contents', []) == []
+
+
+def test_commit_is_idempotent(client):
+    flaky = FlakyClient(client)
+    with writer(flaky) as upload:
+        upload.write_chunk(b'a' * PART_SIZE + b'b')
+        assert upload.commit() == 'table/object.json'
+        calls = list(flaky.calls)
+
+    # committing again, or leaving the with block, sends nothing more
+    assert upload.commit() == 'table/object.json'
+    assert flaky.calls == calls
+    assert body(client) == b'a' * PART_SIZE + b'b'
@@ -0,0 +1,40 @@
+from datetime import datetime
+
+from dbtos3.sentry_model.api import SentryReplicationMethod
+
+INDEX = 'sentry-events-project'
+
+
+def event(event_id):
+    return {'eventID': event_id, 'dateCreated': '2020-01-{:02d}T00:00:00Z'.format(event_id)}
+
+
+def pages_of(*pages):
+    # a generator, as export_unseen closes the pages it stops reading
+    return (list(page) for page in pages)
+
+
+def export(stop_at_seen, pages):
+    written = []
+    max_date_created, event_ids = SentryReplicationMethod.export_unseen(
+        pages=pages, index=INDEX, write=lambda part, events: written.extend(events), stop_at_seen=stop_at_seen)
+    return [e['eventID'] for e in written], event_ids
+
+
+def test_replicate_stops_at_the_first_page_with_seen_events(catalogue_methods):
+    catalogue_methods.mark_events_seen(data_source=INDEX, event_ids=['5'], seen_time=datetime.now())
+
+    written, event_ids = export(True, pages_of([event(7), event(6)], [event(5), event(4)], [event(3)]))
+
+    assert written == [7, 6, 4]
+    assert event_ids == ['7', '6', '4']
+
+
+def test_full_load_pages_through_every_page_and_leaves_out_seen_events(catalogue_methods):
+    # 5 was exported by a replication, 2 arrived late and sorts after it
+    catalogue_methods.mark_events_seen(data_source=INDEX, event_ids=['5', '3'], seen_time=datetime.now())
+
+    written, event_ids = export(False, pages_of([event(7), event(6)], [event(5), event(4)], [event(3), event(2)]))
+
+    assert written == [7, 6, 4, 2]
+    assert event_ids == ['7', '6', '4', '2']
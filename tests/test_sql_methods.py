@@ -0,0 +1,31 @@
+from datetime import datetime
+
+from dbtos3.sql_model.methods import ReplicationMethodsSQL
+
+
+def test_split_ranges_of_integers_cover_every_value_once():
+    ranges = ReplicationMethodsSQL.split_ranges(lower=1, upper=10, partitions=3)
+
+    assert ranges == [(1, 4, False), (4, 7, False), (7, 10, True)]
+    covered = [value for start, end, last in ranges for value in range(start, end + 1 if last else end)]
+    assert covered == list(range(1, 11))
+
+
+def test_split_ranges_of_timestamps_end_at_the_upper_bound():
+    lower, upper = datetime(2020, 1, 1), datetime(2020, 1, 4)
+
+    ranges = ReplicationMethodsSQL.split_ranges(lower=lower, upper=upper, partitions=3)
+
+    assert [start for start, _, _ in ranges] == [datetime(2020, 1, 1), datetime(2020, 1, 2), datetime(2020, 1, 3)]
+    assert ranges[-1] == (datetime(2020, 1, 3), upper, True)
+
+
+def test_split_ranges_of_a_single_value():
+    assert ReplicationMethodsSQL.split_ranges(lower=5, upper=5, partitions=4) == [(5, 5, True)]
+
+
+def test_max_of_column_skips_none():
+    description = [('id',), ('updated_at',)]
+    rows = [(1, None), (2, datetime(2020, 1, 2)), (3, datetime(2020, 1, 1))]
+
+    assert ReplicationMethodsSQL.max_of_column(description, rows, 'updated_at') == datetime(2020, 1, 2)